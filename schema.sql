@@ -67,3 +67,380 @@ CREATE INDEX IF NOT EXISTS idx_playlists_created_by ON playlists(created_by);
 CREATE INDEX IF NOT EXISTS idx_follows_playlist_id ON follows(playlist_id);
 CREATE INDEX IF NOT EXISTS idx_follows_user_id ON follows(user_id);
 CREATE INDEX IF NOT EXISTS idx_playlist_songs_playlist_id ON playlist_songs(playlist_id);
+
+CREATE INDEX IF NOT EXISTS idx_playlist_songs_song_id ON playlist_songs(song_id);
+
+CREATE TABLE IF NOT EXISTS song_play_counts (
+    song_id INTEGER PRIMARY KEY REFERENCES songs(id) ON DELETE CASCADE,
+    play_count BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS song_daily_plays (
+    song_id INTEGER REFERENCES songs(id) ON DELETE CASCADE,
+    day DATE NOT NULL,
+    play_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (song_id, day)
+);
+
+CREATE TABLE IF NOT EXISTS playlist_play_counts (
+    playlist_id INTEGER PRIMARY KEY REFERENCES playlists(id) ON DELETE CASCADE,
+    play_count BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_song_play_counts_play_count ON song_play_counts(play_count DESC);
+CREATE INDEX IF NOT EXISTS idx_song_daily_plays_day ON song_daily_plays(day);
+CREATE INDEX IF NOT EXISTS idx_playlist_play_counts_play_count ON playlist_play_counts(play_count DESC);
+
+CREATE INDEX IF NOT EXISTS idx_songs_title_id ON songs(title, id);
+-- The /playlists keyset (created_at, id) needs a created_at on every row;
+-- playlists of unknown age sort last.
+UPDATE playlists SET created_at = 'epoch' WHERE created_at IS NULL;
+ALTER TABLE playlists ALTER COLUMN created_at SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_playlists_created_at_id ON playlists(created_at DESC, id DESC);
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+ALTER TABLE songs ADD COLUMN IF NOT EXISTS search_text TEXT;
+ALTER TABLE songs ADD COLUMN IF NOT EXISTS search_vector TSVECTOR;
+
+CREATE OR REPLACE FUNCTION songs_search_refresh() RETURNS trigger AS $$
+DECLARE
+    artist_name TEXT;
+BEGIN
+    SELECT name INTO artist_name FROM artists WHERE id = NEW.artist_id;
+    NEW.search_text := lower(NEW.title || ' ' || coalesce(artist_name, ''));
+    NEW.search_vector := setweight(to_tsvector('simple', NEW.title), 'A') ||
+                         setweight(to_tsvector('simple', coalesce(artist_name, '')), 'B');
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS songs_search_refresh ON songs;
+CREATE TRIGGER songs_search_refresh
+    BEFORE INSERT OR UPDATE OF title, artist_id ON songs
+    FOR EACH ROW EXECUTE FUNCTION songs_search_refresh();
+
+CREATE OR REPLACE FUNCTION artists_search_refresh() RETURNS trigger AS $$
+BEGIN
+    UPDATE songs SET title = title WHERE artist_id = NEW.id;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS artists_search_refresh ON artists;
+CREATE TRIGGER artists_search_refresh
+    AFTER UPDATE OF name ON artists
+    FOR EACH ROW WHEN (OLD.name IS DISTINCT FROM NEW.name)
+    EXECUTE FUNCTION artists_search_refresh();
+
+UPDATE songs SET title = title WHERE search_text IS NULL;
+
+CREATE INDEX IF NOT EXISTS idx_songs_search_text_trgm ON songs USING GIN (search_text gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_songs_search_vector ON songs USING GIN (search_vector);
+
+CREATE TABLE IF NOT EXISTS song_hourly_plays (
+    song_id INTEGER REFERENCES songs(id) ON DELETE CASCADE,
+    hour TIMESTAMP NOT NULL,
+    play_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (song_id, hour)
+);
+
+CREATE TABLE IF NOT EXISTS artist_play_counts (
+    artist_id INTEGER PRIMARY KEY REFERENCES artists(id) ON DELETE CASCADE,
+    play_count BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS artist_daily_plays (
+    artist_id INTEGER REFERENCES artists(id) ON DELETE CASCADE,
+    day DATE NOT NULL,
+    play_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (artist_id, day)
+);
+
+CREATE TABLE IF NOT EXISTS artist_hourly_plays (
+    artist_id INTEGER REFERENCES artists(id) ON DELETE CASCADE,
+    hour TIMESTAMP NOT NULL,
+    play_count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (artist_id, hour)
+);
+
+-- Chart windows scan a range of buckets and sum them per entity; covering
+-- indexes let that run as an index-only scan.
+DROP INDEX IF EXISTS idx_song_daily_plays_day;
+CREATE INDEX IF NOT EXISTS idx_song_daily_plays_day_covering ON song_daily_plays(day) INCLUDE (song_id, play_count);
+CREATE INDEX IF NOT EXISTS idx_song_hourly_plays_hour_covering ON song_hourly_plays(hour) INCLUDE (song_id, play_count);
+CREATE INDEX IF NOT EXISTS idx_artist_play_counts_play_count ON artist_play_counts(play_count DESC);
+CREATE INDEX IF NOT EXISTS idx_artist_daily_plays_day_covering ON artist_daily_plays(day) INCLUDE (artist_id, play_count);
+CREATE INDEX IF NOT EXISTS idx_artist_hourly_plays_hour_covering ON artist_hourly_plays(hour) INCLUDE (artist_id, play_count);
+
+-- plays is range-partitioned by month (plays_YYYY_MM) so time windows prune
+-- to the months they touch and old months can be detached cheaply. The
+-- primary key must include the partition key. plays_default catches rows for
+-- months that have no partition yet; src/partitions.py creates partitions
+-- ahead of time so it normally stays empty.
+-- A month whose plays already landed in plays_default (a missed cron run, or
+-- a batch with an old played_at) cannot simply get a partition: Postgres
+-- refuses while the default holds rows for its range. The default is then
+-- detached for the duration, the month's rows are moved into the new
+-- partition and the default is attached again, all in the caller's
+-- transaction. Detaching locks plays, so inserts wait until it commits.
+CREATE OR REPLACE FUNCTION create_plays_partition(month DATE) RETURNS TEXT AS $$
+DECLARE
+    start_at DATE := date_trunc('month', month)::date;
+    end_at DATE := (date_trunc('month', month) + INTERVAL '1 month')::date;
+    partition_name TEXT := 'plays_' || to_char(start_at, 'YYYY_MM');
+    has_default BOOLEAN := to_regclass('plays_default') IS NOT NULL;
+    stray BOOLEAN := FALSE;
+BEGIN
+    IF to_regclass(partition_name) IS NOT NULL THEN
+        RETURN partition_name;
+    END IF;
+    IF has_default THEN
+        EXECUTE 'SELECT EXISTS (SELECT 1 FROM plays_default WHERE played_at >= $1 AND played_at < $2)'
+            INTO stray USING start_at, end_at;
+    END IF;
+    IF stray THEN
+        ALTER TABLE plays DETACH PARTITION plays_default;
+    END IF;
+    EXECUTE format('CREATE TABLE %I PARTITION OF plays FOR VALUES FROM (%L) TO (%L)',
+                   partition_name, start_at, end_at);
+    IF stray THEN
+        EXECUTE format('WITH moved AS (
+                            DELETE FROM plays_default WHERE played_at >= $1 AND played_at < $2
+                            RETURNING id, user_id, song_id, played_at
+                        )
+                        INSERT INTO %I (id, user_id, song_id, played_at) SELECT * FROM moved',
+                       partition_name) USING start_at, end_at;
+        ALTER TABLE plays ATTACH PARTITION plays_default DEFAULT;
+    END IF;
+    RETURN partition_name;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+BEGIN
+    IF (SELECT relkind FROM pg_class WHERE oid = 'plays'::regclass) = 'r' THEN
+        ALTER TABLE plays RENAME TO plays_unpartitioned;
+
+        CREATE TABLE plays (
+            id INTEGER NOT NULL DEFAULT nextval('plays_id_seq'),
+            user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+            song_id INTEGER REFERENCES songs(id) ON DELETE CASCADE,
+            played_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, played_at)
+        ) PARTITION BY RANGE (played_at);
+        ALTER SEQUENCE plays_id_seq OWNED BY plays.id;
+        CREATE TABLE plays_default PARTITION OF plays DEFAULT;
+
+        PERFORM create_plays_partition(m::date)
+        FROM generate_series(
+            date_trunc('month', COALESCE((SELECT MIN(played_at) FROM plays_unpartitioned), LOCALTIMESTAMP)),
+            date_trunc('month', LOCALTIMESTAMP) + INTERVAL '3 months',
+            INTERVAL '1 month'
+        ) AS m;
+
+        INSERT INTO plays (id, user_id, song_id, played_at)
+        SELECT id, user_id, song_id, COALESCE(played_at, LOCALTIMESTAMP) FROM plays_unpartitioned;
+        DROP TABLE plays_unpartitioned;
+    END IF;
+END;
+$$;
+
+-- Composite indexes serve per-song and per-user time ranges (and replace the
+-- single-column ones); BRIN on the append-ordered played_at is tiny and
+-- enough for range scans inside a month.
+DROP INDEX IF EXISTS idx_plays_played_at, idx_plays_song_id, idx_plays_user_id;
+CREATE INDEX IF NOT EXISTS idx_plays_song_id_played_at ON plays(song_id, played_at);
+CREATE INDEX IF NOT EXISTS idx_plays_user_id_played_at ON plays(user_id, played_at);
+CREATE INDEX IF NOT EXISTS idx_plays_played_at_brin ON plays USING BRIN (played_at);
+
+-- Per-user playtime leaderboard, maintained with every recorded play (see
+-- src/rollups.py). Every user has a row, created by the trigger below, so
+-- the leaderboard still lists users who have not played anything yet.
+CREATE TABLE IF NOT EXISTS user_playtime (
+    user_id INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+    total_playtime BIGINT NOT NULL DEFAULT 0,
+    play_count BIGINT NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_playtime_rank ON user_playtime(total_playtime DESC, user_id);
+
+CREATE OR REPLACE FUNCTION users_playtime_init() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO user_playtime (user_id)
+    SELECT id FROM new_users
+    ON CONFLICT (user_id) DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS users_playtime_init ON users;
+CREATE TRIGGER users_playtime_init
+    AFTER INSERT ON users
+    REFERENCING NEW TABLE AS new_users
+    FOR EACH STATEMENT EXECUTE FUNCTION users_playtime_init();
+
+INSERT INTO user_playtime (user_id, total_playtime, play_count)
+SELECT u.id, COALESCE(SUM(s.duration), 0), COUNT(p.user_id)
+FROM users u
+LEFT JOIN plays p ON p.user_id = u.id
+LEFT JOIN songs s ON s.id = p.song_id
+GROUP BY u.id
+ON CONFLICT (user_id) DO NOTHING;
+
+-- Version tokens for conditional GETs (ETag / Last-Modified, see
+-- src/conditional.py). Every write statement on a catalog table bumps that
+-- table's counter; the row lock orders concurrent bumps, so a committed
+-- change always shows up as a higher version.
+CREATE TABLE IF NOT EXISTS table_versions (
+    table_name TEXT PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE OR REPLACE FUNCTION bump_table_version() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO table_versions (table_name, version, updated_at)
+    VALUES (TG_TABLE_NAME, 1, clock_timestamp())
+    ON CONFLICT (table_name) DO UPDATE
+    SET version = table_versions.version + 1, updated_at = clock_timestamp();
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DO $$
+DECLARE
+    t TEXT;
+BEGIN
+    FOREACH t IN ARRAY ARRAY['users', 'artists', 'songs', 'playlists', 'playlist_songs'] LOOP
+        INSERT INTO table_versions (table_name) VALUES (t) ON CONFLICT DO NOTHING;
+        EXECUTE format('DROP TRIGGER IF EXISTS %I ON %I', t || '_bump_version', t);
+        EXECUTE format('CREATE TRIGGER %I AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON %I '
+                       'FOR EACH STATEMENT EXECUTE FUNCTION bump_table_version()', t || '_bump_version', t);
+    END LOOP;
+END $$;
+
+-- Play counts change too often for a shared counter; their rows carry the
+-- time of their last change instead.
+ALTER TABLE song_play_counts ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+ALTER TABLE playlist_play_counts ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+CREATE INDEX IF NOT EXISTS idx_playlist_play_counts_updated_at ON playlist_play_counts(updated_at);
+
+-- Per-user listening counts, maintained with every recorded play (see
+-- src/rollups.py). They are the user x song matrix of the recommender
+-- (src/recommender.py) and each user's history at recommendation time;
+-- updated_at lets the recommender refresh only songs with new plays.
+CREATE TABLE IF NOT EXISTS user_song_plays (
+    user_id INTEGER REFERENCES users(id) ON DELETE CASCADE,
+    song_id INTEGER REFERENCES songs(id) ON DELETE CASCADE,
+    play_count BIGINT NOT NULL DEFAULT 0,
+    last_played_at TIMESTAMP,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    PRIMARY KEY (user_id, song_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_song_plays_recent ON user_song_plays(user_id, last_played_at DESC);
+CREATE INDEX IF NOT EXISTS idx_user_song_plays_updated_at ON user_song_plays(updated_at);
+-- A user's most played songs (the top_songs of GET /users/<id>).
+CREATE INDEX IF NOT EXISTS idx_user_song_plays_top ON user_song_plays(user_id, play_count DESC, song_id);
+
+INSERT INTO user_song_plays (user_id, song_id, play_count, last_played_at)
+SELECT user_id, song_id, COUNT(*), MAX(played_at)
+FROM plays
+WHERE user_id IS NOT NULL AND song_id IS NOT NULL
+GROUP BY user_id, song_id
+ON CONFLICT (user_id, song_id) DO NOTHING;
+
+-- Top-K item-item neighbors per song, written by src/recommender.py.
+CREATE TABLE IF NOT EXISTS song_neighbors (
+    song_id INTEGER REFERENCES songs(id) ON DELETE CASCADE,
+    neighbor_id INTEGER REFERENCES songs(id) ON DELETE CASCADE,
+    score REAL NOT NULL,
+    PRIMARY KEY (song_id, neighbor_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_song_neighbors_rank ON song_neighbors(song_id, score DESC) INCLUDE (neighbor_id);
+
+CREATE TABLE IF NOT EXISTS recommender_state (
+    id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+    built_at TIMESTAMPTZ,
+    refreshed_at TIMESTAMPTZ
+);
+
+-- Mergeable listener sketches written by src/sketches.py: a HyperLogLog of
+-- the users who played a song (or any song of a playlist) each day, and per
+-- hour a count-min sketch of plays per song with the songs estimated
+-- highest. Workers merge their in-memory sketches into these rows.
+CREATE TABLE IF NOT EXISTS song_listener_sketches (
+    song_id INTEGER REFERENCES songs(id) ON DELETE CASCADE,
+    day DATE NOT NULL,
+    registers BYTEA NOT NULL,
+    PRIMARY KEY (song_id, day)
+);
+
+CREATE TABLE IF NOT EXISTS playlist_listener_sketches (
+    playlist_id INTEGER REFERENCES playlists(id) ON DELETE CASCADE,
+    day DATE NOT NULL,
+    registers BYTEA NOT NULL,
+    PRIMARY KEY (playlist_id, day)
+);
+
+CREATE INDEX IF NOT EXISTS idx_song_listener_sketches_day ON song_listener_sketches(day);
+CREATE INDEX IF NOT EXISTS idx_playlist_listener_sketches_day ON playlist_listener_sketches(day);
+
+CREATE TABLE IF NOT EXISTS trend_sketches (
+    bucket TIMESTAMP PRIMARY KEY,
+    counters BYTEA NOT NULL,
+    candidates INTEGER[] NOT NULL DEFAULT '{}'
+);
+
+-- Track order within a playlist. Positions are spaced 65536 apart
+-- (playlists.POSITION_GAP) so a song can be inserted or moved between two
+-- others by taking the midpoint, without renumbering the list. Existing
+-- tracks keep the order they were shown in (by title).
+ALTER TABLE playlist_songs ADD COLUMN IF NOT EXISTS position BIGINT;
+
+UPDATE playlist_songs ps SET position = r.rank * 65536
+FROM (
+    SELECT ps.playlist_id, ps.song_id,
+           ROW_NUMBER() OVER (PARTITION BY ps.playlist_id ORDER BY s.title, s.id) as rank
+    FROM playlist_songs ps
+    JOIN songs s ON s.id = ps.song_id
+) r
+WHERE ps.playlist_id = r.playlist_id AND ps.song_id = r.song_id AND ps.position IS NULL;
+
+ALTER TABLE playlist_songs ALTER COLUMN position SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_playlist_songs_position ON playlist_songs(playlist_id, position, song_id);
+
+-- Follow feeds (see src/feeds.py). Every song added to a playlist is logged
+-- once in playlist_additions; user_feeds holds each user's newest addition
+-- ids, pushed by playlists with fewer than FEED_FANOUT_MAX_FOLLOWERS
+-- followers and capped at FEED_LENGTH. Bigger playlists are pulled from
+-- playlist_additions when the feed is read.
+CREATE TABLE IF NOT EXISTS playlist_additions (
+    id BIGSERIAL PRIMARY KEY,
+    playlist_id INTEGER REFERENCES playlists(id) ON DELETE CASCADE,
+    song_id INTEGER REFERENCES songs(id) ON DELETE CASCADE,
+    added_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_playlist_additions_playlist_id ON playlist_additions(playlist_id, id DESC);
+CREATE INDEX IF NOT EXISTS idx_playlist_additions_added_at ON playlist_additions(added_at);
+
+CREATE TABLE IF NOT EXISTS playlist_follower_counts (
+    playlist_id INTEGER PRIMARY KEY REFERENCES playlists(id) ON DELETE CASCADE,
+    follower_count BIGINT NOT NULL DEFAULT 0
+);
+
+INSERT INTO playlist_follower_counts (playlist_id, follower_count)
+SELECT playlist_id, COUNT(*) FROM follows GROUP BY playlist_id
+ON CONFLICT (playlist_id) DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS user_feeds (
+    user_id INTEGER PRIMARY KEY REFERENCES users(id) ON DELETE CASCADE,
+    addition_ids BIGINT[] NOT NULL DEFAULT '{}',
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
@@ -0,0 +1,359 @@
+import asyncio
+import math
+import os
+import re
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+from instrumentation import metrics
+
+# Admission control. Every route belongs to a cost class; a class admits at
+# most CONCURRENCY requests per process at a time, queues up to QUEUE more
+# in arrival order and answers the rest 503 with Retry-After, so a burst of
+# aggregate queries cannot take every worker thread and pooled connection
+# away from the cheap lookups and POST /plays.
+#
+# A request is also shed before it queues when the recent hold time of the
+# class says it would wait longer than MAX_WAIT seconds, and after MAX_WAIT
+# if it is still queued: by then the client is better off retrying than
+# waiting for a response it may have given up on. Queries run with the
+# class's STATEMENT_TIMEOUT (milliseconds, 0 for the server's default), set
+# on the pooled connection when it is checked out.
+ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+
+# (concurrency, queue, max wait, statement timeout); concurrency 0 admits
+# everything and only applies the statement timeout.
+CLASS_DEFAULTS = {
+    'cheap': (0, 0, 0, 5000),
+    'default': (8, 32, 2, 15000),
+    'expensive': (4, 16, 5, 30000)
+}
+
+# Routes are written as in the README, '*' for a path parameter; anything
+# not listed is 'default'. ADMISSION_ROUTES overrides entries, e.g.
+# "GET /songs=expensive,GET /trending=cheap".
+ROUTE_CLASSES = {
+    'GET /songs/*': 'cheap',
+    'GET /playlists/*': 'cheap',
+    'GET /users/*': 'cheap',
+    'GET /images/*/*': 'cheap',
+    'POST /plays': 'cheap',
+    'POST /plays/batch': 'cheap',
+    'GET /playlists': 'expensive',
+    'GET /users': 'expensive',
+    'GET /user-playtime': 'expensive',
+    'GET /top-playlists': 'expensive',
+    'GET /top-users': 'expensive',
+    'GET /top-songs': 'expensive',
+    'GET /top-artists': 'expensive'
+}
+
+# Never shed, so the stats stay readable during an overload.
+EXEMPT_ROUTES = {'GET /metrics', 'GET /pool-stats', 'GET /ingest-stats', 'GET /cache-stats'}
+
+# Weight of the newest hold time in the moving average behind the wait
+# estimate.
+SERVICE_TIME_WEIGHT = 0.2
+
+SET_STATEMENT_TIMEOUT_QUERY = "SELECT set_config('statement_timeout', %s, false)"
+RESET_STATEMENT_TIMEOUT_QUERY = "RESET statement_timeout"
+
+PARAMETER_RE = re.compile(r'<[^>]*>|\{[^}]*\}')
+
+
+class Overloaded(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class Waiter:
+    __slots__ = ('wake', 'granted')
+
+    def __init__(self, wake):
+        self.wake = wake
+        self.granted = False
+
+
+def resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class CostClass:
+    def __init__(self, name, concurrency=0, queue=0, max_wait=0.0, statement_timeout=0):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue = queue
+        self.max_wait = max_wait
+        self.statement_timeout = statement_timeout
+
+        self._lock = threading.Lock()
+        self._waiters = deque()
+        self._active = 0
+        self._service_time = None
+        self._stats = {
+            'admitted': 0,
+            'queued': 0,
+            'queue_full': 0,
+            'deadline': 0,
+            'timeout': 0,
+            'statement_timeouts': 0
+        }
+
+    def expected_wait(self, position):
+        # Caller holds the lock. Seconds until the waiter at `position` in
+        # the queue gets a slot, going by recent hold times.
+        if not self._service_time or self.concurrency <= 0:
+            return 0.0
+        return position * self._service_time / self.concurrency
+
+    def _shed(self, reason, wait):
+        # Caller holds the lock.
+        self._stats[reason] += 1
+        metrics.inc('admission_shed_total', (('class', self.name), ('reason', reason)))
+        return Overloaded("Server busy (%s requests: %s), retry later" % (self.name, reason.replace('_', ' ')),
+                          max(1, math.ceil(wait)))
+
+    def _enter(self, wake):
+        # Admits at once (returns None) or queues a waiter woken by `wake`
+        # (returns it); raises Overloaded if the request cannot be served in
+        # time.
+        with self._lock:
+            if self.concurrency <= 0 or (self._active < self.concurrency and not self._waiters):
+                self._active += 1
+                self._stats['admitted'] += 1
+                return None
+            wait = self.expected_wait(len(self._waiters) + 1)
+            if len(self._waiters) >= self.queue:
+                raise self._shed('queue_full', wait)
+            if wait > self.max_wait:
+                raise self._shed('deadline', wait)
+            waiter = Waiter(wake)
+            self._waiters.append(waiter)
+            self._stats['queued'] += 1
+            return waiter
+
+    def _settle(self, waiter, waited):
+        # After the wait: keeps the slot release() handed over, or leaves
+        # the queue and sheds the request.
+        metrics.observe('admission_wait_seconds', waited, (('class', self.name),))
+        with self._lock:
+            if waiter.granted:
+                self._stats['admitted'] += 1
+                return
+            self._waiters.remove(waiter)
+            raise self._shed('timeout', self.expected_wait(len(self._waiters) + 1))
+
+    def _abandon(self, waiter):
+        # The request went away while queued.
+        with self._lock:
+            if not waiter.granted:
+                self._waiters.remove(waiter)
+                return
+        self.release()
+
+    def acquire(self):
+        # Blocks the calling thread until admitted. Returns the admission
+        # time to pass to release().
+        event = threading.Event()
+        waiter = self._enter(event.set)
+        if waiter is not None:
+            started = time.monotonic()
+            event.wait(self.max_wait)
+            self._settle(waiter, time.monotonic() - started)
+        return time.monotonic()
+
+    async def acquire_async(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = self._enter(lambda: loop.call_soon_threadsafe(resolve, future))
+        if waiter is not None:
+            started = time.monotonic()
+            try:
+                await asyncio.wait({future}, timeout=self.max_wait)
+            except asyncio.CancelledError:
+                self._abandon(waiter)
+                raise
+            self._settle(waiter, time.monotonic() - started)
+        return time.monotonic()
+
+    def release(self, admitted_at=None):
+        # Hands the slot straight to the oldest waiter, so a request arriving
+        # now cannot overtake the queue.
+        with self._lock:
+            if admitted_at is not None:
+                held = time.monotonic() - admitted_at
+                if self._service_time is None:
+                    self._service_time = held
+                else:
+                    self._service_time += SERVICE_TIME_WEIGHT * (held - self._service_time)
+            if not self._waiters:
+                self._active -= 1
+                return
+            waiter = self._waiters.popleft()
+            waiter.granted = True
+        waiter.wake()
+
+    def record_statement_timeout(self):
+        with self._lock:
+            self._stats['statement_timeouts'] += 1
+        metrics.inc('admission_shed_total', (('class', self.name), ('reason', 'statement_timeout')))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = self._active
+            stats['queue_depth'] = len(self._waiters)
+            stats['service_time'] = self._service_time
+        stats.update(concurrency=self.concurrency, queue=self.queue, max_wait=self.max_wait,
+                     statement_timeout=self.statement_timeout)
+        return stats
+
+
+def class_settings(name):
+    concurrency, queue, max_wait, statement_timeout = CLASS_DEFAULTS[name]
+    prefix = 'ADMISSION_%s_' % name.upper()
+    return {
+        'concurrency': int(os.getenv(prefix + 'CONCURRENCY', concurrency)),
+        'queue': int(os.getenv(prefix + 'QUEUE', queue)),
+        'max_wait': float(os.getenv(prefix + 'MAX_WAIT', max_wait)),
+        'statement_timeout': int(os.getenv(prefix + 'STATEMENT_TIMEOUT', statement_timeout))
+    }
+
+
+def route_classes():
+    routes = dict(ROUTE_CLASSES)
+    for item in os.getenv("ADMISSION_ROUTES", "").split(','):
+        route, _, name = item.rpartition('=')
+        if route.strip():
+            if name.strip() not in CLASS_DEFAULTS:
+                raise ValueError("ADMISSION_ROUTES: unknown cost class %r" % name.strip())
+            routes[' '.join(route.split())] = name.strip()
+    return routes
+
+
+_classes = None
+_classes_pid = None
+_classes_lock = threading.Lock()
+_routes = route_classes()
+_current = ContextVar('admission_class', default=None)
+
+
+def get_classes():
+    # Per process, like the connection pools.
+    global _classes, _classes_pid
+    with _classes_lock:
+        if _classes is None or _classes_pid != os.getpid():
+            _classes = {name: CostClass(name, **class_settings(name)) for name in CLASS_DEFAULTS}
+            _classes_pid = os.getpid()
+        return _classes
+
+
+def route_key(method, route):
+    # 'GET /songs/*' for Flask's /songs/<int:song_id> and Starlette's
+    # /songs/{song_id:int} alike.
+    return '%s %s' % ('GET' if method == 'HEAD' else method, PARAMETER_RE.sub('*', route))
+
+
+def cost_class(method, route):
+    # None for requests that are not admission controlled.
+    if not ENABLED or route is None or method == 'OPTIONS':
+        return None
+    key = route_key(method, route)
+    if key in EXEMPT_ROUTES:
+        return None
+    return get_classes()[_routes.get(key, 'default')]
+
+
+def enter(method, route):
+    # Flask: admits the request before the view runs, blocking the worker
+    # thread while it is queued. Returns what leave() needs.
+    cost = cost_class(method, route)
+    if cost is None:
+        return None
+    admitted_at = cost.acquire()
+    return cost, admitted_at, _current.set(cost)
+
+
+def leave(entry):
+    cost, admitted_at, token = entry
+    _current.reset(token)
+    cost.release(admitted_at)
+
+
+@asynccontextmanager
+async def admitted(method, route):
+    # asyncio counterpart of enter()/leave().
+    cost = cost_class(method, route)
+    if cost is None:
+        yield
+        return
+    admitted_at = await cost.acquire_async()
+    token = _current.set(cost)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+        cost.release(admitted_at)
+
+
+def statement_timeout():
+    # Milliseconds for the current request's queries, None outside requests
+    # or for the server's default.
+    cost = _current.get()
+    if cost is None or cost.statement_timeout <= 0:
+        return None
+    return cost.statement_timeout
+
+
+def statement_timeout_query(timeout):
+    if timeout is None:
+        return RESET_STATEMENT_TIMEOUT_QUERY, None
+    return SET_STATEMENT_TIMEOUT_QUERY, (str(timeout),)
+
+
+def record_statement_timeout():
+    cost = _current.get()
+    if cost is not None:
+        cost.record_statement_timeout()
+
+
+def stats():
+    return {name: cost.stats() for name, cost in get_classes().items()} if ENABLED else None
+
+
+def gauges():
+    if not ENABLED:
+        return []
+    result = []
+    for name, cost in get_classes().items():
+        stats = cost.stats()
+        result.append(('admission_in_flight', (('class', name),), stats['in_flight']))
+        result.append(('admission_queue_depth', (('class', name),), stats['queue_depth']))
+    return result
+
+
+metrics.describe('admission_shed_total', 'counter', 'Requests answered 503 by admission control, by class and reason.')
+metrics.describe('admission_wait_seconds', 'histogram', 'Time queued requests waited for a slot, by cost class.')
+metrics.describe('admission_in_flight', 'gauge', 'Admitted requests running, by cost class.')
+metrics.describe('admission_queue_depth', 'gauge', 'Requests queued for a slot, by cost class.')
+
+
+def init_app(app):
+    # Flask hooks. Overloaded raised here is answered by the app's 503
+    # handler; the slot is held until the request is torn down.
+    from flask import g, request
+
+    @app.before_request
+    def admit_request():
+        g.admission = enter(request.method, request.url_rule.rule if request.url_rule else None)
+
+    @app.teardown_request
+    def release_request(exc):
+        entry = g.pop('admission', None)
+        if entry is not None:
+            leave(entry)
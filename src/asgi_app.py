@@ -0,0 +1,1011 @@
+import asyncio
+import os
+import time
+import weakref
+from contextlib import asynccontextmanager
+
+import psycopg
+from psycopg import AsyncCursor
+from psycopg.errors import QueryCanceled
+from psycopg_pool import AsyncConnectionPool, PoolTimeout
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.background import BackgroundTask
+from starlette.responses import FileResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+from db_pool import (REPLICA_CHECK_TIMEOUT, REPLICA_LAG_QUERY, ReplicaRouter, connection_params, pool_config,
+                     replica_params)
+from instrumentation import (EXPLAINABLE_RE, SLOW_QUERY_EXPLAIN, TimingMiddleware, is_slow,
+                             log_slow_statement, metrics, pool_gauges, record_checkout, record_serialize,
+                             record_statement)
+from pagination import (InvalidCursor, InvalidIdList, decode_cursor, int_arg, next_cursor_headers,
+                        page_size, parse_id_list, split_page, wants_pagination)
+from play_buffer import get_play_buffer, parse_play_event, BufferFull
+from response_cache import get_response_cache, endpoint_ttl, invalidate
+from conditional import endpoint_max_age, etag_matches, evaluate
+from rollups import rollup_statements, INIT_PLAYLIST_COUNTS_QUERY
+from search import search_query
+from charts import InvalidWindow, top_artists_query, top_songs_query
+from recommender import recommendations_query, similar_songs_query
+from thumbnails import ImageNotFound, ImageUnavailable, InvalidImageRequest
+from playlists import InvalidPlaylistEdit, PlaylistNotFound
+from admission import Overloaded
+from streaming import STREAM_ITERSIZE, StreamEncoder, cursor_name, stream_format, stream_mimetype
+from serialization import JSON_FROM_DB, CompressionMiddleware
+import serialization
+import thumbnails
+import sketches
+import playlists
+import admission
+import feeds
+import entity_cache
+import queries
+
+# Asyncio serving mode: the same routes and JSON shapes as db_requests.py,
+# but every handler awaits Postgres through psycopg 3's async pool, so one
+# process keeps many queries in flight. Run with
+#   gunicorn -c gunicorn.conf.py asgi_app:app
+
+PLAY_INGEST_MODE = os.getenv("PLAY_INGEST_MODE", "direct")
+MAX_PLAY_BATCH = int(os.getenv("MAX_PLAY_BATCH", 1000))
+PLAY_BUFFER_WAIT = float(os.getenv("PLAY_BUFFER_WAIT", 0.5))
+
+
+class TimedAsyncCursor(AsyncCursor):
+    # psycopg 3 counterpart of instrumentation.InstrumentedCursor.
+    async def execute(self, query, params=None, **kwargs):
+        started = time.perf_counter()
+        try:
+            await super().execute(query, params, **kwargs)
+        except Exception:
+            record_statement(time.perf_counter() - started, 0)
+            raise
+        seconds = time.perf_counter() - started
+        record_statement(seconds, self.rowcount)
+        if is_slow(seconds):
+            log_slow_statement(query if isinstance(query, str) else query.as_string(self), seconds,
+                               await self.explain(query, params))
+        return self
+
+    async def explain(self, query, params):
+        if not isinstance(query, str):
+            return None
+        if not SLOW_QUERY_EXPLAIN or not EXPLAINABLE_RE.match(query):
+            return None
+        try:
+            # A nested transaction is a savepoint, so a failing EXPLAIN
+            # leaves the caller's transaction intact.
+            async with self.connection.transaction():
+                cur = AsyncCursor(self.connection)
+                await cur.execute("EXPLAIN " + query, params)
+                return '\n'.join(row[0] for row in await cur.fetchall())
+        except Exception as e:
+            return "(EXPLAIN failed: %s)" % str(e).strip()
+
+
+# Statement timeout each pooled connection was last given (see
+# db_pool.ConnectionPool._set_statement_timeout).
+statement_timeouts = weakref.WeakKeyDictionary()
+
+
+class TimedAsyncConnectionPool(AsyncConnectionPool):
+    async def getconn(self, timeout=None):
+        started = time.perf_counter()
+        try:
+            conn = await super().getconn(timeout)
+        finally:
+            record_checkout(time.perf_counter() - started)
+        try:
+            await set_statement_timeout(conn)
+        except BaseException:
+            await self.putconn(conn)
+            raise
+        return conn
+
+
+async def set_statement_timeout(conn):
+    timeout = admission.statement_timeout()
+    if statement_timeouts.get(conn) == timeout:
+        return
+    async with conn.cursor() as cur:
+        await cur.execute(*admission.statement_timeout_query(timeout))
+    await conn.commit()
+    statement_timeouts[conn] = timeout
+
+
+def async_pool(params=None):
+    config = pool_config()
+    params = {('dbname' if k == 'database' else k): v for k, v in (params or connection_params()).items() if v}
+    params['cursor_factory'] = TimedAsyncCursor
+    return TimedAsyncConnectionPool(
+        kwargs=params,
+        min_size=config['minconn'],
+        max_size=config['maxconn'],
+        timeout=config['timeout'],
+        max_idle=config['max_idle'],
+        check=AsyncConnectionPool.check_connection,
+        open=False
+    )
+
+
+pool = async_pool()
+replica_pools = {name: async_pool(params) for name, params in replica_params().items()}
+router = ReplicaRouter(replica_pools) if replica_pools else None
+
+
+async def checkout_read():
+    # Async counterpart of db_pool.get_read_connection; also returns the pool
+    # the connection goes back to.
+    name = router.choose() if router is not None else None
+    if name is not None:
+        try:
+            return replica_pools[name], await replica_pools[name].getconn()
+        except (psycopg.Error, PoolTimeout) as e:
+            router.mark_down(name, e)
+            router.unroute(name)
+    return pool, await pool.getconn()
+
+
+@asynccontextmanager
+async def read_connection():
+    source, conn = await checkout_read()
+    try:
+        async with conn:
+            yield conn
+    finally:
+        await source.putconn(conn)
+
+
+async def check_replicas():
+    # Async counterpart of db_pool.check_replicas_forever.
+    while True:
+        for name, replica in replica_pools.items():
+            try:
+                async with replica.connection(REPLICA_CHECK_TIMEOUT) as conn:
+                    async with conn.cursor() as cur:
+                        await cur.execute(REPLICA_LAG_QUERY)
+                        lag = (await cur.fetchone())[0]
+            except Exception as e:
+                router.mark_down(name, e)
+                continue
+            router.record(name, lag)
+        await asyncio.sleep(router.check_interval)
+
+
+def encode(content):
+    # Same encoder as the Flask provider, so both apps emit identical bodies.
+    started = time.perf_counter()
+    try:
+        return serialization.dumps(content)
+    finally:
+        record_serialize(time.perf_counter() - started)
+
+
+def dumps(content):
+    return encode(content) + b'\n'
+
+
+def json_response(content, status_code=200, headers=None):
+    return Response(dumps(content), status_code=status_code, headers=headers,
+                    media_type='application/json')
+
+
+def error(message, status_code, headers=None):
+    return json_response({'error': str(message)}, status_code, headers)
+
+
+async def fetch(query, params=None, read=False):
+    async with (read_connection() if read else pool.connection()) as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(query, params)
+            return cur.description, await cur.fetchall()
+
+
+async def db_json_list(query, read=False):
+    # Serves a body that Postgres already rendered as JSON (JSON_FROM_DB).
+    try:
+        _, rows = await fetch(query, read=read)
+        return Response(rows[0][0] + '\n', media_type='application/json')
+    except (PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return error(e, 500)
+
+
+def requested_stream(request):
+    return stream_format(request.query_params, request.headers.get('accept'))
+
+
+async def stream_list(fmt, query, params, from_row, read=False):
+    # Async counterpart of db_requests.stream_list: a server-side cursor
+    # fetched `itersize` rows at a time, encoded as it goes. The connection
+    # stays checked out until the body is sent or the client disconnects.
+    source, conn = await checkout_read() if read else (pool, await pool.getconn())
+    cur = conn.cursor(name=cursor_name())
+    cur.itersize = STREAM_ITERSIZE
+    released = False
+
+    async def release():
+        nonlocal released
+        if not released:
+            released = True
+            try:
+                await cur.close()
+            finally:
+                await source.putconn(conn)
+
+    try:
+        await cur.execute(query, params)
+    except Exception as e:
+        await release()
+        return error(e, 500)
+
+    async def body():
+        encoder = StreamEncoder(fmt, encode)
+        try:
+            async for row in cur:
+                chunk = encoder.feed(from_row(row))
+                if chunk:
+                    yield chunk
+            yield encoder.finish()
+        finally:
+            await release()
+
+    return StreamingResponse(body(), media_type=stream_mimetype(fmt), background=BackgroundTask(release))
+
+
+def paged_response(request, content, next_cursor):
+    base_url = str(request.url.replace(query=''))
+    return json_response(content, headers=next_cursor_headers(base_url, request.query_params, next_cursor))
+
+
+async def conditional(request, name, version_query, params, compute):
+    # Counterpart of conditional.conditional_response: answers 304 from the
+    # version query alone when the client's ETag is current.
+    try:
+        _, rows = await fetch(version_query, params)
+    except (PoolTimeout, QueryCanceled):
+        raise
+    except Exception:
+        rows = None
+    version = rows[0] if rows else None
+    if version is None:
+        return await compute()
+
+    variant = '%s|%s' % (request.url.path + '?' + request.url.query, request.headers.get('accept', ''))
+    headers, fresh = evaluate(name, variant, version, request.headers.get('if-none-match'),
+                              request.headers.get('if-modified-since'), endpoint_max_age(name))
+    if fresh:
+        return Response(status_code=304, headers=headers)
+
+    response = await compute()
+    if response.status_code == 200:
+        response.headers.update(headers)
+    return response
+
+
+_flights = {}
+
+
+async def cached(request, name, ttl, tags, compute):
+    # Same entries and invalidation generations as response_cache.cached_response,
+    # so Flask and ASGI workers can share one Redis backend.
+    cache = get_response_cache()
+    ttl = endpoint_ttl(name, ttl)
+    key = cache.key_for(name, tags, '%s?%s' % (request.url.path, request.url.query))
+    value = cache.backend.get(key)
+    if value is None:
+        flight = _flights.get(key)
+        if flight is not None:
+            cache.count(name, 'coalesced')
+            shared = await asyncio.shield(flight)
+            response = Response(shared.body, status_code=shared.status_code, headers=dict(shared.headers))
+            response.headers['X-Cache'] = 'HIT'
+            return response
+        cache.count(name, 'misses')
+        flight = _flights[key] = asyncio.get_running_loop().create_future()
+        try:
+            response = await compute()
+            flight.set_result(response)
+        except BaseException as e:
+            flight.set_exception(e)
+            flight.exception()
+            raise
+        finally:
+            del _flights[key]
+        if response.status_code == 200:
+            cache.backend.set(key, {
+                'body': response.body.decode(),
+                'mimetype': response.media_type,
+                'headers': {h: response.headers[h] for h in ('X-Next-Cursor', 'Link') if h in response.headers}
+            }, ttl)
+        response.headers['X-Cache'] = 'MISS'
+        return response
+
+    cache.count(name, 'hits')
+    response = Response(value['body'], media_type=value['mimetype'], headers=value['headers'])
+    response.headers['X-Cache'] = 'HIT'
+    return response
+
+
+async def get_songs(request):
+    args = request.query_params
+    if 'ids' in args:
+        return await get_details_batch('songs', queries.SONG_DETAILS_QUERY, parse_id_list(args['ids']),
+                                       queries.song_details_from_row)
+
+    page = int_arg(args, 'page', 1)
+    per_page = page_size(args)
+    search = args.get('search', '')
+    cursor = args.get('cursor')
+    after = decode_cursor(cursor, queries.SEARCH_CURSOR if search else queries.SONG_CURSOR) if cursor else None
+    offset = (page - 1) * per_page if page > 1 and not after else 0
+
+    try:
+        if search:
+            _, rows = await fetch(*search_query(search, per_page + 1, after, offset), read=True)
+            rows, next_cursor = split_page(rows, per_page, queries.search_cursor_key)
+        else:
+            _, rows = await fetch(*queries.songs_query(after, per_page + 1, offset), read=True)
+            rows, next_cursor = split_page(rows, per_page, queries.song_cursor_key)
+        return paged_response(request, [queries.song_from_row(row) for row in rows], next_cursor)
+    except (PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return error(e, 500)
+
+
+async def get_top_songs(request):
+    query, params = top_songs_query(request.query_params)
+
+    async def compute():
+        try:
+            description, rows = await fetch(query, params, read=True)
+            return json_response(queries.rows_as_dicts(description, rows))
+        except (PoolTimeout, QueryCanceled):
+            raise
+        except Exception as e:
+            return error(e, 500)
+    return await cached(request, 'top-songs', 60, ('plays',), compute)
+
+
+async def get_top_artists(request):
+    query, params = top_artists_query(request.query_params)
+
+    async def compute():
+        try:
+            description, rows = await fetch(query, params, read=True)
+            return json_response(queries.rows_as_dicts(description, rows))
+        except (PoolTimeout, QueryCanceled):
+            raise
+        except Exception as e:
+            return error(e, 500)
+    return await cached(request, 'top-artists', 60, ('plays',), compute)
+
+
+async def get_top_users(request):
+    async def compute():
+        try:
+            description, rows = await fetch(queries.TOP_USERS_QUERY, read=True)
+            return json_response(queries.rows_as_dicts(description, rows))
+        except (PoolTimeout, QueryCanceled):
+            raise
+        except Exception as e:
+            return error(e, 500)
+    return await cached(request, 'top-users', 120, ('plays',), compute)
+
+
+async def get_user_playtime(request):
+    fmt = requested_stream(request)
+    if fmt:
+        return await stream_list(fmt, *queries.user_playtime_query(None), queries.user_playtime_from_row, read=True)
+
+    args = request.query_params
+    paged = wants_pagination(args)
+    per_page = page_size(args)
+    cursor = args.get('cursor')
+    after = decode_cursor(cursor, queries.USER_PLAYTIME_CURSOR) if cursor else None
+
+    async def compute():
+        if not paged and JSON_FROM_DB:
+            return await db_json_list(queries.USER_PLAYTIME_JSON_QUERY, read=True)
+        try:
+            _, rows = await fetch(*queries.user_playtime_query(after, per_page + 1 if paged else None), read=True)
+            next_cursor = None
+            if paged:
+                rows, next_cursor = split_page(rows, per_page, queries.user_playtime_cursor_key)
+            return paged_response(request, [queries.user_playtime_from_row(row) for row in rows], next_cursor)
+        except (PoolTimeout, QueryCanceled):
+            raise
+        except Exception as e:
+            return error(e, 500)
+    return await cached(request, 'user-playtime', 120, ('plays',), compute)
+
+
+async def get_top_playlists(request):
+    async def compute():
+        try:
+            _, rows = await fetch(queries.TOP_PLAYLISTS_QUERY, read=True)
+            return json_response([queries.top_playlist_from_row(row) for row in rows])
+        except (PoolTimeout, QueryCanceled):
+            raise
+        except Exception as e:
+            return error(e, 500)
+    return await cached(request, 'top-playlists', 60, ('plays', 'playlists'), compute)
+
+
+async def get_playlists(request):
+    return await conditional(request, 'playlists', queries.PLAYLISTS_VERSION_QUERY, (),
+                             lambda: list_playlists(request))
+
+
+async def list_playlists(request):
+    fmt = requested_stream(request)
+    if fmt:
+        return await stream_list(fmt, *queries.playlists_query(None), queries.playlist_from_row)
+
+    args = request.query_params
+    paged = wants_pagination(args)
+    if not paged and JSON_FROM_DB:
+        return await db_json_list(queries.PLAYLISTS_JSON_QUERY)
+    per_page = page_size(args)
+    cursor = args.get('cursor')
+    after = decode_cursor(cursor, queries.PLAYLIST_CURSOR) if cursor else None
+
+    try:
+        _, rows = await fetch(*queries.playlists_query(after, per_page + 1 if paged else None))
+        next_cursor = None
+        if paged:
+            rows, next_cursor = split_page(rows, per_page, queries.playlist_cursor_key)
+        return paged_response(request, [queries.playlist_from_row(row) for row in rows], next_cursor)
+    except (PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return error(e, 500)
+
+
+async def create_playlist(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+
+    if not data or 'name' not in data:
+        return error('Missing required field: name', 400)
+
+    name = data['name'].strip()
+    description = data.get('description', '').strip()
+    cover = data.get('cover', None)
+
+    if not name:
+        return error('Playlist name cannot be empty', 400)
+    if cover is not None and not thumbnails.allowed_image_url(cover):
+        return error('cover must be an http(s) URL on an allowed image host', 400)
+
+    try:
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(queries.RANDOM_USER_QUERY)
+                user_row = await cur.fetchone()
+                if not user_row:
+                    return error('No users found in database', 500)
+                random_user_id, random_username = user_row
+
+                await cur.execute(queries.CREATE_PLAYLIST_QUERY,
+                                  (name, random_user_id, False, cover, description))
+                playlist_row = await cur.fetchone()
+                await cur.execute(INIT_PLAYLIST_COUNTS_QUERY, (playlist_row[0],))
+        invalidate('playlists')
+        entity_cache.invalidate('user_activity', [random_user_id])
+        return json_response(queries.created_playlist_from_row(playlist_row, random_username), 201)
+    except (PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return error(e, 500)
+
+
+async def enqueue_plays(events):
+    try:
+        await run_in_threadpool(get_play_buffer().add, events, PLAY_BUFFER_WAIT)
+    except BufferFull as e:
+        return error(e, 503, {'Retry-After': '1'})
+    return json_response({'queued': len(events)}, 202)
+
+
+async def add_play(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        return error('Invalid JSON body', 400)
+
+    if PLAY_INGEST_MODE == 'buffered':
+        try:
+            return await enqueue_plays([parse_play_event(data)])
+        except (KeyError, TypeError, ValueError) as e:
+            return error('Invalid play: %s' % e, 400)
+
+    try:
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(queries.INSERT_PLAY_QUERY, (data['user_id'], data['song_id']))
+                play = await cur.fetchone()
+                for query, params in rollup_statements([play[1:]]):
+                    await cur.execute(query, params)
+        sketches.record_plays([play[1:]])
+        invalidate('plays')
+        entity_cache.invalidate('song_plays', [play[2]])
+        entity_cache.invalidate('user_activity', [play[1]])
+        return json_response({'id': play[0]}, 201)
+    except (PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return error(e, 400)
+
+
+async def add_plays_batch(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    events = data.get('plays') if isinstance(data, dict) else data
+
+    if not isinstance(events, list) or not events:
+        return error('Expected a non-empty array of plays', 400)
+    if len(events) > MAX_PLAY_BATCH:
+        return error('At most %d plays per batch' % MAX_PLAY_BATCH, 413)
+
+    parsed = []
+    for index, item in enumerate(events):
+        try:
+            parsed.append(parse_play_event(item))
+        except (KeyError, TypeError, ValueError) as e:
+            return error('Invalid play at index %d: %s' % (index, e), 400)
+
+    return await enqueue_plays(parsed)
+
+
+async def get_playlist_songs(request):
+    playlist_id = request.path_params['playlist_id']
+    args = request.query_params
+    per_page = page_size(args)
+    cursor = args.get('cursor')
+    after = decode_cursor(cursor, playlists.TRACK_CURSOR) if cursor else None
+    try:
+        _, rows = await fetch(*playlists.tracks_query(playlist_id, after, per_page + 1))
+        if not rows and not after:
+            _, found = await fetch(playlists.PLAYLIST_EXISTS_QUERY, (playlist_id,))
+            if not found:
+                return error('Playlist not found', 404)
+        rows, next_cursor = split_page(rows, per_page, playlists.track_cursor_key)
+        return paged_response(request, [playlists.track_from_row(row) for row in rows], next_cursor)
+    except (PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return error(e, 500)
+
+
+async def request_json(request):
+    try:
+        return await request.json()
+    except ValueError:
+        return None
+
+
+async def edit_playlist(playlist_id, edit):
+    # The edit runs in one transaction, committed when the pooled
+    # connection is returned.
+    try:
+        result = await run_lookup(edit)
+    except (InvalidPlaylistEdit, PlaylistNotFound, PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return error(e, 500)
+    invalidate('playlists')
+    entity_cache.invalidate('playlists', [playlist_id])
+    entity_cache.invalidate('playlist_plays', [playlist_id])
+    return json_response(result)
+
+
+async def add_playlist_songs(request):
+    playlist_id = request.path_params['playlist_id']
+    return await edit_playlist(playlist_id, playlists.add_songs(playlist_id, await request_json(request)))
+
+
+async def remove_playlist_songs(request):
+    playlist_id = request.path_params['playlist_id']
+    if 'ids' in request.query_params:
+        data = {'song_ids': parse_id_list(request.query_params['ids'])}
+    else:
+        data = await request_json(request)
+    return await edit_playlist(playlist_id, playlists.remove_songs(playlist_id, data))
+
+
+async def move_playlist_songs(request):
+    playlist_id = request.path_params['playlist_id']
+    return await edit_playlist(playlist_id, playlists.move_songs(playlist_id, await request_json(request)))
+
+
+async def follow_playlist(request):
+    try:
+        data = await request.json()
+        await run_lookup(feeds.follow(data['user_id'], data['playlist_id']))
+        invalidate('follows')
+        return json_response({'message': 'Playlist followed'}, 201)
+    except (PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return error(e, 400)
+
+
+async def unfollow_playlist(request):
+    try:
+        data = await request_json(request) or request.query_params
+        removed = await run_lookup(feeds.unfollow(int(data['user_id']), int(data['playlist_id'])))
+    except (PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return error(e, 400)
+    if not removed:
+        return error('Follow not found', 404)
+    invalidate('follows')
+    return json_response({'message': 'Playlist unfollowed'})
+
+
+async def get_users(request):
+    args = request.query_params
+    if 'ids' in args:
+        return await get_details_batch('users', queries.USER_DETAILS_QUERY, parse_id_list(args['ids']),
+                                       queries.user_details_from_row)
+
+    fmt = requested_stream(request)
+    if fmt:
+        return await stream_list(fmt, *queries.users_query(None), queries.user_from_row, read=True)
+
+    paged = wants_pagination(args)
+    per_page = page_size(args)
+    cursor = args.get('cursor')
+    after = decode_cursor(cursor, queries.USER_CURSOR) if cursor else None
+
+    try:
+        _, rows = await fetch(*queries.users_query(after, per_page + 1 if paged else None), read=True)
+        next_cursor = None
+        if paged:
+            rows, next_cursor = split_page(rows, per_page, queries.user_cursor_key)
+        return paged_response(request, [queries.user_from_row(row) for row in rows], next_cursor)
+    except (PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return error(e, 500)
+
+
+async def run_lookup(lookup, read=False):
+    # Async driver for entity_cache loaders (see entity_cache.run_sync); a
+    # connection is checked out only when the cache cannot answer alone.
+    try:
+        query, params = next(lookup)
+    except StopIteration as done:
+        return done.value
+    async with (read_connection() if read else pool.connection()) as conn:
+        async with conn.cursor() as cur:
+            while True:
+                await cur.execute(query, params)
+                try:
+                    query, params = lookup.send(await cur.fetchall())
+                except StopIteration as done:
+                    return done.value
+
+
+async def fetch_details(kind, query, ids, from_row, fresh_counts=False):
+    # Song and playlist details answer conditional GETs, so they are read
+    # from the primary like their version queries.
+    read = kind == 'users'
+    if entity_cache.ENABLED:
+        return await run_lookup(entity_cache.DETAILS[kind](ids, fresh_counts), read)
+    _, rows = await fetch(query, (ids,), read=read)
+    return queries.details_in_order(rows, ids, from_row)
+
+
+async def get_details(kind, query, entity_id, from_row, not_found, fresh_counts=False):
+    try:
+        details = await fetch_details(kind, query, [entity_id], from_row, fresh_counts)
+        if not details:
+            return error(not_found, 404)
+        return json_response(details[0])
+    except (PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return error(e, 500)
+
+
+async def get_details_batch(kind, query, ids, from_row):
+    try:
+        return json_response(await fetch_details(kind, query, ids, from_row))
+    except (PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return error(e, 500)
+
+
+async def get_song_details(request):
+    song_id = request.path_params['song_id']
+
+    async def compute():
+        return await get_details('songs', queries.SONG_DETAILS_QUERY, song_id, queries.song_details_from_row,
+                                 'Song not found', fresh_counts=True)
+    return await conditional(request, 'song', queries.SONG_VERSION_QUERY, (song_id,), compute)
+
+
+async def get_playlist_details(request):
+    playlist_id = request.path_params['playlist_id']
+
+    async def compute():
+        return await get_details('playlists', queries.PLAYLIST_DETAILS_QUERY, playlist_id,
+                                 queries.playlist_details_from_row, 'Playlist not found', fresh_counts=True)
+    return await conditional(request, 'playlist', queries.PLAYLIST_VERSION_QUERY, (playlist_id,), compute)
+
+
+async def get_user_details(request):
+    return await get_details('users', queries.USER_DETAILS_QUERY, request.path_params['user_id'],
+                             queries.user_details_from_row, 'User not found')
+
+
+async def get_metrics(request):
+    pools = {}
+    for name, source in dict(replica_pools, primary=pool).items():
+        stats = source.get_stats()
+        size, idle = stats.get('pool_size', 0), stats.get('pool_available', 0)
+        pools[name] = {'size': size, 'idle': idle, 'in_use': size - idle, 'max': source.max_size}
+    gauges = pool_gauges(pools) + admission.gauges()
+    return Response(metrics.render(gauges), media_type='text/plain; version=0.0.4')
+
+
+async def get_user_rank(request):
+    async def compute():
+        try:
+            _, rows = await fetch(queries.USER_RANK_QUERY, (request.path_params['user_id'],), read=True)
+            if not rows:
+                return error('User not found', 404)
+            return json_response(queries.user_rank_from_row(rows[0]))
+        except (PoolTimeout, QueryCanceled):
+            raise
+        except Exception as e:
+            return error(e, 500)
+    return await cached(request, 'user-rank', 30, ('plays',), compute)
+
+
+async def get_user_feed(request):
+    # Newest first, paged on the addition id.
+    args = request.query_params
+    per_page = page_size(args)
+    cursor = args.get('cursor')
+    after = decode_cursor(cursor, feeds.FEED_CURSOR) if cursor else None
+    try:
+        rows = await run_lookup(feeds.feed(request.path_params['user_id'], after[0] if after else None,
+                                           per_page + 1), read=True)
+        if rows is None:
+            return error('User not found', 404)
+        rows, next_cursor = split_page(rows, per_page, feeds.feed_cursor_key)
+        return paged_response(request, [feeds.feed_item_from_row(row) for row in rows], next_cursor)
+    except (PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return error(e, 500)
+
+
+async def get_user_recommendations(request):
+    query, params = recommendations_query(request.path_params['user_id'], request.query_params)
+
+    async def compute():
+        try:
+            description, rows = await fetch(query, params, read=True)
+            return json_response(queries.rows_as_dicts(description, rows))
+        except (PoolTimeout, QueryCanceled):
+            raise
+        except Exception as e:
+            return error(e, 500)
+    return await cached(request, 'recommendations', 300, ('recommendations',), compute)
+
+
+async def get_similar_songs(request):
+    query, params = similar_songs_query(request.path_params['song_id'], request.query_params)
+
+    async def compute():
+        try:
+            description, rows = await fetch(query, params, read=True)
+            return json_response(queries.rows_as_dicts(description, rows))
+        except (PoolTimeout, QueryCanceled):
+            raise
+        except Exception as e:
+            return error(e, 500)
+    return await cached(request, 'similar-songs', 300, ('recommendations',), compute)
+
+
+async def listener_stats(request, name, kind, entity_id, not_found):
+    async def compute():
+        try:
+            stats = await run_lookup(sketches.listener_stats(kind, entity_id, request.query_params), read=True)
+            if stats is None:
+                return error(not_found, 404)
+            return json_response(stats)
+        except (PoolTimeout, QueryCanceled):
+            raise
+        except Exception as e:
+            return error(e, 500)
+    return await cached(request, name, 60, (), compute)
+
+
+async def get_song_stats(request):
+    return await listener_stats(request, 'song-stats', 'songs', request.path_params['song_id'], 'Song not found')
+
+
+async def get_playlist_stats(request):
+    return await listener_stats(request, 'playlist-stats', 'playlists', request.path_params['playlist_id'],
+                                'Playlist not found')
+
+
+async def get_trending(request):
+    async def compute():
+        try:
+            return json_response(await run_lookup(sketches.trending(request.query_params), read=True))
+        except (PoolTimeout, QueryCanceled):
+            raise
+        except Exception as e:
+            return error(e, 500)
+    return await cached(request, 'trending', 30, (), compute)
+
+
+async def get_image(request):
+    size = thumbnails.parse_size(request.query_params)
+    lookup = thumbnails.image_url_lookup(request.path_params['kind'], request.path_params['entity_id'])
+    url = await run_lookup(lookup, read=True)
+    # Fetching and resizing block, so a miss runs on the thread pool.
+    path, digest = await run_in_threadpool(thumbnails.thumbnail, url, size)
+    tag = '"%s"' % thumbnails.etag_token(digest, size)
+    headers = {'ETag': tag, 'Cache-Control': 'public, max-age=%d' % thumbnails.IMAGE_MAX_AGE}
+    if etag_matches(tag, request.headers.get('if-none-match')):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=thumbnails.MIMETYPE, headers=headers)
+
+
+async def get_pool_stats(request):
+    stats = {name: replica.get_stats() for name, replica in replica_pools.items()}
+    stats['primary'] = pool.get_stats()
+    stats['routing'] = router.stats() if router is not None else None
+    stats['admission'] = admission.stats()
+    return json_response(stats)
+
+
+async def get_ingest_stats(request):
+    return json_response(dict(get_play_buffer().stats(), sketches=sketches.get_recorder().stats()))
+
+
+async def get_cache_stats(request):
+    return json_response(dict(get_response_cache().stats(), entities=entity_cache.stats(),
+                              images=thumbnails.get_store().stats()))
+
+
+async def handle_pool_timeout(request, exc):
+    return error(exc, 503, {'Retry-After': '1'})
+
+
+async def handle_overloaded(request, exc):
+    return error(exc, 503, {'Retry-After': str(exc.retry_after)})
+
+
+async def handle_statement_timeout(request, exc):
+    # The query outran its admission class's statement_timeout.
+    return error('Query took too long, retry later', 503, {'Retry-After': '1'})
+
+
+async def handle_invalid_argument(request, exc):
+    return error(exc, 400)
+
+
+async def handle_not_found(request, exc):
+    return error(exc, 404)
+
+
+async def handle_image_unavailable(request, exc):
+    return error(exc, 502)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    await pool.open()
+    for replica in replica_pools.values():
+        await replica.open()
+    checks = asyncio.create_task(check_replicas()) if router is not None else None
+    if entity_cache.ENABLED and entity_cache.ENTITY_CACHE_WARM:
+        try:
+            await run_lookup(entity_cache.warm_up())
+        except Exception as e:
+            entity_cache.log.warning("Entity cache warm-up failed: %s", e)
+    try:
+        yield
+    finally:
+        if checks is not None:
+            checks.cancel()
+        for replica in replica_pools.values():
+            await replica.close()
+        await pool.close()
+        await run_in_threadpool(get_play_buffer().close)
+        await run_in_threadpool(sketches.get_recorder().close)
+
+
+routes = [
+    Route('/songs', get_songs, methods=['GET']),
+    Route('/top-songs', get_top_songs, methods=['GET']),
+    Route('/top-artists', get_top_artists, methods=['GET']),
+    Route('/top-users', get_top_users, methods=['GET']),
+    Route('/user-playtime', get_user_playtime, methods=['GET']),
+    Route('/top-playlists', get_top_playlists, methods=['GET']),
+    Route('/playlists', get_playlists, methods=['GET']),
+    Route('/playlists', create_playlist, methods=['POST']),
+    Route('/playlists/{playlist_id:int}/songs', get_playlist_songs, methods=['GET']),
+    Route('/playlists/{playlist_id:int}/songs', add_playlist_songs, methods=['POST']),
+    Route('/playlists/{playlist_id:int}/songs', remove_playlist_songs, methods=['DELETE']),
+    Route('/playlists/{playlist_id:int}/songs', move_playlist_songs, methods=['PATCH']),
+    Route('/plays', add_play, methods=['POST']),
+    Route('/plays/batch', add_plays_batch, methods=['POST']),
+    Route('/follows', follow_playlist, methods=['POST']),
+    Route('/follows', unfollow_playlist, methods=['DELETE']),
+    Route('/users', get_users, methods=['GET']),
+    Route('/songs/{song_id:int}', get_song_details, methods=['GET']),
+    Route('/playlists/{playlist_id:int}', get_playlist_details, methods=['GET']),
+    Route('/users/{user_id:int}', get_user_details, methods=['GET']),
+    Route('/users/{user_id:int}/rank', get_user_rank, methods=['GET']),
+    Route('/users/{user_id:int}/feed', get_user_feed, methods=['GET']),
+    Route('/users/{user_id:int}/recommendations', get_user_recommendations, methods=['GET']),
+    Route('/songs/{song_id:int}/similar', get_similar_songs, methods=['GET']),
+    Route('/songs/{song_id:int}/stats', get_song_stats, methods=['GET']),
+    Route('/playlists/{playlist_id:int}/stats', get_playlist_stats, methods=['GET']),
+    Route('/trending', get_trending, methods=['GET']),
+    Route('/images/{kind}/{entity_id:int}', get_image, methods=['GET']),
+    Route('/metrics', get_metrics, methods=['GET']),
+    Route('/pool-stats', get_pool_stats, methods=['GET']),
+    Route('/ingest-stats', get_ingest_stats, methods=['GET']),
+    Route('/cache-stats', get_cache_stats, methods=['GET'])
+]
+
+
+def admitted(route):
+    # Runs the endpoint under its cost class's admission control (see
+    # admission.py). The slot is held until the handler returns, so a
+    # streamed body is sent without it.
+    endpoint = route.endpoint
+
+    async def handler(request):
+        async with admission.admitted(request.method, route.path):
+            try:
+                return await endpoint(request)
+            except QueryCanceled:
+                admission.record_statement_timeout()
+                raise
+    return Route(route.path, handler, methods=route.methods, name=route.name)
+
+
+app = Starlette(
+    routes=[admitted(route) for route in routes],
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'], allow_credentials=True,
+                           allow_methods=['*'], allow_headers=['*'],
+                           expose_headers=['X-Next-Cursor', 'Link', 'Server-Timing', 'ETag', 'Last-Modified']),
+                Middleware(TimingMiddleware),
+                Middleware(CompressionMiddleware)],
+    exception_handlers={
+        PoolTimeout: handle_pool_timeout,
+        Overloaded: handle_overloaded,
+        QueryCanceled: handle_statement_timeout,
+        InvalidCursor: handle_invalid_argument,
+        InvalidIdList: handle_invalid_argument,
+        InvalidWindow: handle_invalid_argument,
+        InvalidImageRequest: handle_invalid_argument,
+        InvalidPlaylistEdit: handle_invalid_argument,
+        ImageNotFound: handle_not_found,
+        PlaylistNotFound: handle_not_found,
+        ImageUnavailable: handle_image_unavailable
+    },
+    lifespan=lifespan
+)
@@ -0,0 +1,371 @@
+import argparse
+import http.client
+import json
+import math
+import random
+import re
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+
+from cloudflare_utils import run_query
+from db_gen import CONFIG, SONG_TITLES, populate_database
+
+# End-to-end benchmark: drives every API route over HTTP at a fixed
+# concurrency, one endpoint at a time, and reports latency percentiles,
+# throughput, error counts and database statements per request (from the
+# Server-Timing header, or pg_stat_statements as a fallback). Reports are
+# JSON so a run can be diffed against a stored baseline:
+#   python benchmark.py --seed-scale 1000 --report report.json
+#   python benchmark.py --report new.json --baseline report.json
+#   python benchmark.py --compare report.json new.json
+
+SERVER_TIMING_QUERIES_RE = re.compile(r'db;[^,]*desc="(\d+) queries')
+
+SEARCH_WORDS = sorted({word.lower() for title in SONG_TITLES for word in title.split()})
+
+
+def fixed_path(path):
+    return lambda rng, ids: (path, None)
+
+
+def random_id(rng, ids, table):
+    return rng.randint(1, max(ids[table], 1))
+
+
+def random_ids(rng, ids, table, count=10):
+    return ','.join(str(random_id(rng, ids, table)) for _ in range(count))
+
+
+def play_body(rng, ids):
+    return {'user_id': random_id(rng, ids, 'users'), 'song_id': random_id(rng, ids, 'songs')}
+
+
+# (name, method, request factory, accepted statuses[, extra headers]).
+# Factories get a per-thread Random and the highest id of every table. The
+# "full" lists measure serialization and compression: run them against a
+# server started with JSON_ENCODER=stdlib COMPRESSION= for the old path.
+GZIP = {'Accept-Encoding': 'gzip'}
+BROTLI = {'Accept-Encoding': 'br'}
+
+SCENARIOS = [
+    ('GET /songs', 'GET', lambda rng, ids: ('/songs?page=%d' % rng.randint(1, 5), None), (200,)),
+    ('GET /songs?search', 'GET', lambda rng, ids: ('/songs?search=%s' % rng.choice(SEARCH_WORDS)[:4], None), (200,)),
+    ('GET /songs?ids', 'GET', lambda rng, ids: ('/songs?ids=' + random_ids(rng, ids, 'songs'), None), (200,)),
+    ('GET /songs/<id>', 'GET', lambda rng, ids: ('/songs/%d' % random_id(rng, ids, 'songs'), None), (200, 404)),
+    ('GET /top-songs', 'GET', fixed_path('/top-songs'), (200,)),
+    ('GET /top-users', 'GET', fixed_path('/top-users'), (200,)),
+    ('GET /top-playlists', 'GET', fixed_path('/top-playlists'), (200,)),
+    ('GET /top-songs 24h', 'GET', fixed_path('/top-songs?window=24h'), (200,)),
+    ('GET /top-songs 30d', 'GET', fixed_path('/top-songs?window=30d'), (200,)),
+    ('GET /top-artists', 'GET', fixed_path('/top-artists'), (200,)),
+    ('GET /top-artists 7d', 'GET', fixed_path('/top-artists?window=7d'), (200,)),
+    ('GET /user-playtime', 'GET', fixed_path('/user-playtime?per_page=20'), (200,)),
+    ('GET /user-playtime full', 'GET', fixed_path('/user-playtime'), (200,)),
+    ('GET /user-playtime full gzip', 'GET', fixed_path('/user-playtime'), (200,), GZIP),
+    ('GET /user-playtime full br', 'GET', fixed_path('/user-playtime'), (200,), BROTLI),
+    ('GET /playlists', 'GET', fixed_path('/playlists?per_page=20'), (200,)),
+    ('GET /playlists full', 'GET', fixed_path('/playlists'), (200,)),
+    ('GET /playlists full gzip', 'GET', fixed_path('/playlists'), (200,), GZIP),
+    ('GET /playlists full br', 'GET', fixed_path('/playlists'), (200,), BROTLI),
+    ('GET /playlists/<id>', 'GET', lambda rng, ids: ('/playlists/%d' % random_id(rng, ids, 'playlists'), None), (200, 404)),
+    ('GET /playlists/<id>/songs', 'GET',
+     lambda rng, ids: ('/playlists/%d/songs?per_page=20' % random_id(rng, ids, 'playlists'), None), (200, 404)),
+    ('GET /users', 'GET', fixed_path('/users?per_page=20'), (200,)),
+    ('GET /users?ids', 'GET', lambda rng, ids: ('/users?ids=' + random_ids(rng, ids, 'users'), None), (200,)),
+    ('GET /users/<id>', 'GET', lambda rng, ids: ('/users/%d' % random_id(rng, ids, 'users'), None), (200, 404)),
+    ('GET /users/<id>/rank', 'GET', lambda rng, ids: ('/users/%d/rank' % random_id(rng, ids, 'users'), None), (200, 404)),
+    ('GET /users/<id>/feed', 'GET',
+     lambda rng, ids: ('/users/%d/feed?per_page=20' % random_id(rng, ids, 'users'), None), (200, 404)),
+    ('GET /users/<id>/recommendations', 'GET',
+     lambda rng, ids: ('/users/%d/recommendations' % random_id(rng, ids, 'users'), None), (200,)),
+    ('GET /songs/<id>/similar', 'GET',
+     lambda rng, ids: ('/songs/%d/similar' % random_id(rng, ids, 'songs'), None), (200,)),
+    # Thumbnails are fetched and resized once per image, then served from
+    # the disk cache; a run mostly measures the cached path.
+    ('GET /images/<kind>/<id>', 'GET',
+     lambda rng, ids: ('/images/songs/%d?size=128' % random_id(rng, ids, 'songs'), None), (200, 404)),
+    ('GET /songs/<id>/stats', 'GET',
+     lambda rng, ids: ('/songs/%d/stats' % random_id(rng, ids, 'songs'), None), (200, 404)),
+    ('GET /playlists/<id>/stats', 'GET',
+     lambda rng, ids: ('/playlists/%d/stats' % random_id(rng, ids, 'playlists'), None), (200, 404)),
+    ('GET /trending', 'GET', fixed_path('/trending'), (200,)),
+    ('POST /plays', 'POST', lambda rng, ids: ('/plays', play_body(rng, ids)), (201, 202)),
+    ('POST /plays/batch', 'POST', lambda rng, ids: ('/plays/batch', [play_body(rng, ids) for _ in range(50)]), (202,)),
+    ('POST /playlists', 'POST', lambda rng, ids: ('/playlists', {'name': 'Benchmark %d' % rng.randint(1, 10 ** 6)}), (201,)),
+    ('POST /playlists/<id>/songs', 'POST',
+     lambda rng, ids: ('/playlists/%d/songs' % random_id(rng, ids, 'playlists'),
+                       {'song_ids': [random_id(rng, ids, 'songs') for _ in range(5)]}), (200, 404)),
+    ('DELETE /playlists/<id>/songs', 'DELETE',
+     lambda rng, ids: ('/playlists/%d/songs?ids=%s' % (random_id(rng, ids, 'playlists'), random_ids(rng, ids, 'songs', 5)),
+                       None), (200, 404)),
+    # A random song is usually not in the playlist, which is answered 400.
+    ('PATCH /playlists/<id>/songs', 'PATCH',
+     lambda rng, ids: ('/playlists/%d/songs' % random_id(rng, ids, 'playlists'),
+                       {'song_id': random_id(rng, ids, 'songs'), 'after': random_id(rng, ids, 'songs')}), (200, 400, 404)),
+    # Duplicate follows are rejected with 400, which is expected here.
+    ('POST /follows', 'POST', lambda rng, ids: ('/follows', {'user_id': random_id(rng, ids, 'users'),
+                                                             'playlist_id': random_id(rng, ids, 'playlists')}), (201, 400)),
+    ('DELETE /follows', 'DELETE',
+     lambda rng, ids: ('/follows?user_id=%d&playlist_id=%d' % (random_id(rng, ids, 'users'),
+                                                               random_id(rng, ids, 'playlists')), None), (200, 404)),
+    ('GET /pool-stats', 'GET', fixed_path('/pool-stats'), (200,)),
+    ('GET /ingest-stats', 'GET', fixed_path('/ingest-stats'), (200,)),
+    ('GET /cache-stats', 'GET', fixed_path('/cache-stats'), (200,)),
+    ('GET /metrics', 'GET', fixed_path('/metrics'), (200,)),
+]
+
+
+def entity_ranges():
+    rows = run_query("""
+        SELECT (SELECT COALESCE(MAX(id), 0) FROM users) AS users,
+               (SELECT COALESCE(MAX(id), 0) FROM songs) AS songs,
+               (SELECT COALESCE(MAX(id), 0) FROM playlists) AS playlists
+    """)
+    return rows[0]
+
+
+def statement_calls():
+    # Total statements executed, from pg_stat_statements when the extension
+    # is installed; None otherwise (query counts are then not reported).
+    try:
+        rows = run_query("SELECT SUM(calls)::bigint AS calls FROM pg_stat_statements")
+    except Exception:
+        return None
+    return rows[0]['calls'] or 0
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    rank = max(1, math.ceil(pct / 100.0 * len(sorted_values)))
+    return sorted_values[rank - 1]
+
+
+def connect(base_url):
+    parts = urlsplit(base_url)
+    conn_class = http.client.HTTPSConnection if parts.scheme == 'https' else http.client.HTTPConnection
+    return conn_class(parts.hostname, parts.port, timeout=30), parts.path.rstrip('/')
+
+
+def send(conn, prefix, method, path, body, extra_headers=None):
+    headers = {'Accept': 'application/json'}
+    headers.update(extra_headers or {})
+    payload = None
+    if body is not None:
+        payload = json.dumps(body)
+        headers['Content-Type'] = 'application/json'
+    conn.request(method, prefix + path, body=payload, headers=headers)
+    response = conn.getresponse()
+    # http.client does not decode Content-Encoding: this is the wire size.
+    size = len(response.read())
+    match = SERVER_TIMING_QUERIES_RE.search(response.getheader('Server-Timing') or '')
+    return response.status, int(match.group(1)) if match else None, size
+
+
+def drive(base_url, scenario, ids, concurrency, duration, seed):
+    name, method, factory, accepted = scenario[:4]
+    headers = scenario[4] if len(scenario) > 4 else None
+    latencies, statuses, failures, query_counts, sizes = [], {}, [], [], []
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def worker(index):
+        rng = random.Random('%s:%s:%d' % (seed, name, index))
+        conn, prefix = connect(base_url)
+        local, local_statuses, local_queries, local_sizes = [], {}, [], []
+        while time.monotonic() < deadline:
+            path, body = factory(rng, ids)
+            started = time.perf_counter()
+            try:
+                status, queries, size = send(conn, prefix, method, path, body, headers)
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                conn, prefix = connect(base_url)
+                with lock:
+                    failures.append(str(e))
+                continue
+            local.append(time.perf_counter() - started)
+            local_sizes.append(size)
+            local_statuses[status] = local_statuses.get(status, 0) + 1
+            if queries is not None:
+                local_queries.append(queries)
+        conn.close()
+        with lock:
+            latencies.extend(local)
+            query_counts.extend(local_queries)
+            sizes.extend(local_sizes)
+            for status, count in local_statuses.items():
+                statuses[status] = statuses.get(status, 0) + count
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses, failures, query_counts, sizes, time.monotonic() - started
+
+
+def run_scenario(base_url, scenario, ids, args):
+    accepted = scenario[3]
+    if args.warmup > 0:
+        drive(base_url, scenario, ids, args.concurrency, args.warmup, args.seed)
+
+    calls_before = statement_calls()
+    latencies, statuses, failures, query_counts, sizes, elapsed = drive(base_url, scenario, ids, args.concurrency,
+                                                                 args.duration, args.seed)
+    calls_after = statement_calls()
+
+    latencies.sort()
+    requests = len(latencies)
+    errors = sum(count for status, count in statuses.items() if status not in accepted) + len(failures)
+    queries = None
+    if query_counts:
+        # Exact per-request counts from the API's Server-Timing header.
+        queries = round(sum(query_counts) / len(query_counts), 2)
+    elif calls_before is not None and calls_after is not None and requests:
+        # The first pg_stat_statements sample is itself counted once.
+        queries = round((calls_after - calls_before - 1) / requests, 2)
+
+    ms = lambda value: round(value * 1000, 2) if value is not None else None
+    return {
+        'requests': requests,
+        'errors': errors,
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'throughput': round(requests / elapsed, 1) if elapsed else 0,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'mean_ms': ms(sum(latencies) / requests) if requests else None,
+        'max_ms': ms(latencies[-1]) if latencies else None,
+        'queries_per_request': queries,
+        'bytes_per_request': round(sum(sizes) / len(sizes)) if sizes else None
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_report(report):
+    print("%-28s %8s %9s %9s %9s %9s %7s %6s %10s" % ('endpoint', 'reqs', 'req/s', 'p50 ms', 'p95 ms',
+                                                      'p99 ms', 'errors', 'q/req', 'bytes/req'))
+    for name, stats in report['endpoints'].items():
+        print("%-28s %8d %9s %9s %9s %9s %7d %6s %10s" % (
+            name, stats['requests'], stats['throughput'], stats['p50_ms'], stats['p95_ms'],
+            stats['p99_ms'], stats['errors'],
+            '-' if stats['queries_per_request'] is None else stats['queries_per_request'],
+            '-' if stats.get('bytes_per_request') is None else stats['bytes_per_request']))
+
+
+def compare_reports(baseline, report, threshold):
+    # A regression is a p50/p95/p99 latency more than `threshold` above the
+    # baseline, a throughput more than `threshold` below it, more queries per
+    # request, or new errors.
+    regressions = []
+    print("%-28s %12s %12s %12s %12s" % ('endpoint', 'p50', 'p95', 'p99', 'req/s'))
+    for name, new in report['endpoints'].items():
+        old = baseline.get('endpoints', {}).get(name)
+        if old is None:
+            print("%-28s %12s" % (name, 'new'))
+            continue
+
+        cells = []
+        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'throughput'):
+            if not old.get(key) or new.get(key) is None:
+                cells.append('-')
+                continue
+            change = (new[key] - old[key]) / old[key]
+            cells.append('%+.1f%%' % (change * 100))
+            worse = change < -threshold if key == 'throughput' else change > threshold
+            if worse:
+                regressions.append('%s: %s %s -> %s' % (name, key, old[key], new[key]))
+        print("%-28s %12s %12s %12s %12s" % (name, *cells))
+
+        if old.get('queries_per_request') is not None and new.get('queries_per_request') is not None \
+                and new['queries_per_request'] > old['queries_per_request'] + 0.5:
+            regressions.append('%s: queries_per_request %s -> %s' % (
+                name, old['queries_per_request'], new['queries_per_request']))
+        if new['errors'] > old.get('errors', 0):
+            regressions.append('%s: errors %s -> %s' % (name, old.get('errors', 0), new['errors']))
+
+    for line in regressions:
+        print("REGRESSION " + line)
+    return regressions
+
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark every API route and compare against a baseline.")
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000', help="running API to benchmark")
+    parser.add_argument('--seed-scale', type=float,
+                        help="reseed the database first with db_gen at this scale (destroys existing data)")
+    parser.add_argument('--seed', type=int, default=1, help="seed for generated data and request mix")
+    parser.add_argument('--workers', type=int, default=4, help="db_gen loader processes when seeding")
+    parser.add_argument('--concurrency', type=int, default=8, help="concurrent clients per endpoint")
+    parser.add_argument('--duration', type=float, default=10, help="measured seconds per endpoint")
+    parser.add_argument('--warmup', type=float, default=2, help="unmeasured seconds per endpoint")
+    parser.add_argument('--only', help="regex selecting endpoints by name, e.g. 'top-|/songs'")
+    parser.add_argument('--report', help="write the JSON report to this file")
+    parser.add_argument('--baseline', help="compare the run against this JSON report")
+    parser.add_argument('--compare', nargs=2, metavar=('BASELINE', 'REPORT'),
+                        help="only diff two existing reports")
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help="relative change counted as a regression (default 0.10)")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    if args.compare:
+        regressions = compare_reports(load_report(args.compare[0]), load_report(args.compare[1]), args.threshold)
+        return 1 if regressions else 0
+
+    if args.seed_scale:
+        sizes = {table: max(1, int(count * args.seed_scale)) for table, count in CONFIG.items()}
+        populate_database(sizes, seed=args.seed, workers=args.workers)
+
+    ids = entity_ranges()
+    scenarios = [s for s in SCENARIOS if not args.only or re.search(args.only, s[0])]
+    report = {
+        'meta': {
+            'base_url': args.base_url,
+            'revision': git_revision(),
+            'started_at': datetime.now(timezone.utc).isoformat(),
+            'concurrency': args.concurrency,
+            'duration': args.duration,
+            'seed': args.seed,
+            'seed_scale': args.seed_scale,
+            'rows': ids
+        },
+        'endpoints': {}
+    }
+    for scenario in scenarios:
+        print("Benchmarking %s..." % scenario[0], file=sys.stderr)
+        report['endpoints'][scenario[0]] = run_scenario(args.base_url, scenario, ids, args)
+
+    print_report(report)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    if args.baseline:
+        return 1 if compare_reports(load_report(args.baseline), report, args.threshold) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
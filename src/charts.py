@@ -0,0 +1,115 @@
+import os
+import re
+import sys
+
+from db_pool import get_connection
+from pagination import int_arg
+
+DEFAULT_WINDOW = '7d'
+DEFAULT_LIMIT = 10
+MAX_LIMIT = int(os.getenv("CHARTS_MAX_LIMIT", 100))
+# Hourly buckets are only kept this long; longer windows use daily buckets.
+HOURLY_RETENTION_HOURS = int(os.getenv("CHARTS_HOURLY_RETENTION_HOURS", 72))
+MAX_WINDOW_DAYS = 3650
+
+WINDOW_RE = re.compile(r'^(\d+)([hd])$')
+
+
+class InvalidWindow(ValueError):
+    pass
+
+
+# Charts are answered from bucket rollups kept in step with `plays` by
+# rollups.py, never from raw plays:
+#   Nh  -> sum of the last N hourly buckets (current hour included)
+#   Nd  -> sum of the last N daily buckets (today included)
+#   all -> running totals
+# Each source is (bucket table, entity column, bucket predicate).
+SONG_SOURCES = {
+    'h': ("song_hourly_plays", "song_id", "hour > date_trunc('hour', LOCALTIMESTAMP) - %s * INTERVAL '1 hour'"),
+    'd': ("song_daily_plays", "song_id", "day > CURRENT_DATE - %s"),
+    'all': ("song_play_counts", "song_id", None)
+}
+
+ARTIST_SOURCES = {
+    'h': ("artist_hourly_plays", "artist_id", "hour > date_trunc('hour', LOCALTIMESTAMP) - %s * INTERVAL '1 hour'"),
+    'd': ("artist_daily_plays", "artist_id", "day > CURRENT_DATE - %s"),
+    'all': ("artist_play_counts", "artist_id", None)
+}
+
+TOP_SONGS_QUERY = """
+    SELECT s.id, s.title, a.name as artist, d.play_count, s.album_cover
+    FROM ({ranking}) d
+    JOIN songs s ON d.song_id = s.id
+    LEFT JOIN artists a ON s.artist_id = a.id
+    ORDER BY d.play_count DESC, s.id
+"""
+
+TOP_ARTISTS_QUERY = """
+    SELECT a.id, a.name, a.country, a.profile_image, d.play_count
+    FROM ({ranking}) d
+    JOIN artists a ON d.artist_id = a.id
+    ORDER BY d.play_count DESC, a.id
+"""
+
+
+def parse_window(value):
+    value = (value or DEFAULT_WINDOW).strip().lower()
+    if value == 'all':
+        return 'all', None
+    match = WINDOW_RE.match(value)
+    if not match:
+        raise InvalidWindow("window must look like 24h, 7d, 30d or all")
+    size, unit = int(match.group(1)), match.group(2)
+    if size < 1:
+        raise InvalidWindow("window must be at least 1%s" % unit)
+    if unit == 'h' and size > HOURLY_RETENTION_HOURS:
+        raise InvalidWindow("hour windows are limited to %dh; use days instead" % HOURLY_RETENTION_HOURS)
+    if unit == 'd' and size > MAX_WINDOW_DAYS:
+        raise InvalidWindow("window must be at most %dd; use all instead" % MAX_WINDOW_DAYS)
+    return unit, size
+
+
+def chart_limit(args):
+    return max(1, min(int_arg(args, 'limit', DEFAULT_LIMIT), MAX_LIMIT))
+
+
+def ranking_query(sources, window, limit):
+    unit, size = window
+    table, column, predicate = sources[unit]
+    if predicate is None:
+        return ("SELECT %s, play_count FROM %s ORDER BY play_count DESC, %s LIMIT %%s"
+                % (column, table, column), [limit])
+    return ("SELECT %s, SUM(play_count) as play_count FROM %s WHERE %s "
+            "GROUP BY %s ORDER BY play_count DESC, %s LIMIT %%s"
+            % (column, table, predicate, column, column), [size, limit])
+
+
+def top_songs_query(args):
+    ranking, params = ranking_query(SONG_SOURCES, parse_window(args.get('window')), chart_limit(args))
+    return TOP_SONGS_QUERY.format(ranking=ranking), params
+
+
+def top_artists_query(args):
+    ranking, params = ranking_query(ARTIST_SOURCES, parse_window(args.get('window')), chart_limit(args))
+    return TOP_ARTISTS_QUERY.format(ranking=ranking), params
+
+
+def prune_hourly(conn):
+    with conn.cursor() as cur:
+        for table in ('song_hourly_plays', 'artist_hourly_plays'):
+            cur.execute(
+                "DELETE FROM %s WHERE hour <= date_trunc('hour', LOCALTIMESTAMP) - %%s * INTERVAL '1 hour'" % table,
+                (HOURLY_RETENTION_HOURS,)
+            )
+    conn.commit()
+
+
+if __name__ == '__main__':
+    # Run periodically (e.g. hourly from cron) to drop expired hourly buckets.
+    if sys.argv[1:] not in ([], ['prune']):
+        sys.exit("usage: python charts.py [prune]")
+    print("Pruning hourly chart buckets older than %dh..." % HOURLY_RETENTION_HOURS)
+    with get_connection() as conn:
+        prune_hourly(conn)
+    print("Hourly chart buckets pruned!")
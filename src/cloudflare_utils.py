@@ -1,18 +1,9 @@
-import psycopg2
-import os
-from dotenv import load_dotenv
-from pathlib import Path
+import io
 
-load_dotenv(dotenv_path=Path(__file__).resolve().parent / ".env")
+from db_pool import get_pool
 
 def get_connection():
-    return psycopg2.connect(
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        database=os.getenv("DB_DATABASE")
-    )
+    return get_pool().connection()
 
 def run_query(sql):
     with get_connection() as conn:
@@ -46,8 +37,26 @@ def batch_insert(sql_prefix, values):
         conn.commit()
         return []
 
+def copy_value(value):
+    if value is None:
+        return '\\N'
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
 
+def copy_rows(table, columns, rows):
+    # COPY FROM STDIN in text format: one round-trip and no SQL parsing per
+    # row, which is what makes multi-million-row loads practical.
+    buf = io.StringIO()
+    count = 0
+    for row in rows:
+        buf.write('\t'.join(copy_value(value) for value in row))
+        buf.write('\n')
+        count += 1
+    buf.seek(0)
 
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.copy_expert("COPY %s (%s) FROM STDIN" % (table, ', '.join(columns)), buf)
+    return count
 
 def clear_all_tables():
     with get_connection() as conn:
@@ -0,0 +1,118 @@
+import hashlib
+import os
+from email.utils import parsedate_to_datetime
+from functools import wraps
+
+from flask import Response, request
+from werkzeug.http import http_date
+
+from db_pool import PoolTimeout, get_pool
+
+# Conditional GETs: a cheap version query (see queries.*_VERSION_QUERY)
+# gives each resource a token and a modification time. Clients that send
+# the ETag back in If-None-Match get a bodiless 304 without the full query
+# running. The version is read on every request and before the body, so a
+# write landing in between at worst costs the client one extra 200, never a
+# stale 304.
+DEFAULT_MAX_AGE = int(os.getenv("HTTP_MAX_AGE", 0))
+
+
+def endpoint_max_age(name, default=DEFAULT_MAX_AGE):
+    return int(os.getenv("HTTP_MAX_AGE_" + name.upper().replace('-', '_'), default))
+
+
+def make_etag(name, variant, token):
+    digest = hashlib.sha1(('%s|%s|%s' % (name, variant, token)).encode()).hexdigest()[:20]
+    # Weak: the same representation may go out with different encodings.
+    return 'W/"%s"' % digest
+
+
+def etag_matches(etag, if_none_match):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    opaque = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if candidate.startswith('W/'):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+
+def modified_since(last_modified, if_modified_since):
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return True
+    if since is None or since.tzinfo is None or last_modified.tzinfo is None:
+        return True
+    return last_modified.replace(microsecond=0) > since
+
+
+def evaluate(name, variant, version, if_none_match, if_modified_since, max_age):
+    # `version` is a (token, last_modified) row. Returns the caching headers
+    # for the response and whether the client's copy is still current;
+    # If-None-Match takes precedence over If-Modified-Since (RFC 9110).
+    token, last_modified = version
+    etag = make_etag(name, variant, token)
+    headers = {
+        'ETag': etag,
+        'Cache-Control': 'public, max-age=%d, must-revalidate' % max_age,
+        'Vary': 'Accept'
+    }
+    if last_modified is not None:
+        headers['Last-Modified'] = http_date(last_modified)
+
+    if if_none_match:
+        fresh = etag_matches(etag, if_none_match)
+    elif if_modified_since and last_modified is not None:
+        fresh = not modified_since(last_modified, if_modified_since)
+    else:
+        fresh = False
+    return headers, fresh
+
+
+def fetch_version(query, params):
+    conn = get_pool().connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            return cur.fetchone()
+    finally:
+        conn.close()
+
+
+def conditional_response(name, version_query, param_names=(), max_age=DEFAULT_MAX_AGE):
+    # Flask decorator. `param_names` picks the view arguments (in order)
+    # that the version query takes.
+    max_age = endpoint_max_age(name, max_age)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            params = tuple(kwargs[p] for p in param_names)
+            try:
+                version = fetch_version(version_query, params)
+            except PoolTimeout:
+                raise
+            except Exception:
+                version = None
+            # No version row means no such entity: the view answers the 404.
+            if version is None:
+                return view(*args, **kwargs)
+
+            variant = '%s|%s' % (request.full_path, request.headers.get('Accept', ''))
+            headers, fresh = evaluate(name, variant, version, request.headers.get('If-None-Match'),
+                                      request.headers.get('If-Modified-Since'), max_age)
+            if fresh:
+                return Response(status=304, headers=headers)
+
+            response = view(*args, **kwargs)
+            if isinstance(response, Response) and response.status_code == 200:
+                response.headers.update(headers)
+            return response
+        return wrapper
+    return decorator
@@ -1,6 +1,14 @@
+import argparse
+import math
+import multiprocessing
+import os
 import random
+import time
 from faker import Faker
-from cloudflare_utils import batch_insert, clear_all_tables
+from cloudflare_utils import clear_all_tables, copy_rows, get_connection
+from rollups import rebuild_rollups
+from partitions import ensure_partitions
+from playlists import POSITION_GAP
 from datetime import datetime, timedelta
 
 fake = Faker()
@@ -15,127 +23,244 @@ CONFIG = {
     'playlist_songs': 10
 }
 
+COLUMNS = {
+    'users': ('id', 'username', 'email', 'profile_image', 'created_at'),
+    'artists': ('id', 'name', 'country', 'profile_image'),
+    'songs': ('id', 'title', 'artist_id', 'duration', 'album_cover'),
+    'playlists': ('id', 'name', 'is_curated', 'created_by', 'cover', 'created_at'),
+    'playlist_songs': ('playlist_id', 'song_id', 'position'),
+    'plays': ('user_id', 'song_id', 'played_at'),
+    'follows': ('user_id', 'playlist_id', 'followed_at')
+}
+
+# Tables in a phase only reference tables loaded by earlier phases, so each
+# phase can be loaded fully in parallel.
+PHASES = [
+    ('users', 'artists'),
+    ('songs', 'playlists'),
+    ('playlist_songs', 'plays', 'follows')
+]
+
+SERIAL_TABLES = ('users', 'artists', 'songs', 'playlists')
+
+# Relative listening activity per hour of the day (quiet nights, evening peak).
+HOUR_WEIGHTS = [3, 2, 1, 1, 1, 2, 4, 6, 7, 6, 5, 5, 6, 6, 5, 5, 6, 7, 9, 10, 10, 9, 7, 5]
+HOUR_CUM_WEIGHTS = [sum(HOUR_WEIGHTS[:i + 1]) for i in range(24)]
+
+COUNTRIES = ['USA', 'Canada', 'UK', 'Australia', 'Japan', 'Germany', 'France', 'Brazil']
+
+SONG_TITLES = [
+    "Midnight Dreams", "Electric Nights", "Sunset Boulevard", "Ocean Waves",
+    "City Lights", "Dancing Stars", "Broken Hearts", "Summer Vibes",
+    "Neon Glow", "Silent Whispers", "Thunder Storm", "Golden Hour",
+    "Velvet Sky", "Crystal Clear", "Fire and Ice", "Moonlight Serenade",
+    "Starlight Express", "Cosmic Journey", "Digital Dreams", "Retro Wave"
+]
+
+PLAYLIST_NAMES = [
+    "Chill Vibes", "Workout Mix", "Road Trip", "Study Session",
+    "Party Time", "Relaxing Evening", "Morning Energy", "Late Night",
+    "Top Hits 2024", "Indie Favorites", "Electronic Beats", "Rock Classics",
+    "Jazz Collection", "Pop Anthems", "Acoustic Sessions", "Hip Hop Essentials"
+]
+
 def generate_image_urls(base_size, count, start_random=1):
     return [f"https://picsum.photos/{base_size}/{base_size}?random={i+start_random}" for i in range(count)]
 
-def generate_users(n):
-    profile_images = generate_image_urls(200, 20, 50)
-    users = []
-    used_usernames, used_emails = set(), set()
-    
-    for _ in range(n):
-        username = fake.user_name()
-        while username in used_usernames:
-            username = f"{fake.user_name()}_{random.randint(1000, 9999)}"
-        used_usernames.add(username)
-        
-        email = fake.email()
-        while email in used_emails:
-            email = fake.email()
-        used_emails.add(email)
-        
-        users.append((username, email, random.choice(profile_images)))
-    
-    return users
-
-def generate_artists(n):
-    countries = ['USA', 'Canada', 'UK', 'Australia', 'Japan', 'Germany', 'France', 'Brazil']
-    artist_images = generate_image_urls(400, 8, 1)
-    
-    return [(fake.name(), random.choice(countries), random.choice(artist_images)) for _ in range(n)]
-
-def generate_songs(n, artist_ids):
-    song_titles = [
-        "Midnight Dreams", "Electric Nights", "Sunset Boulevard", "Ocean Waves",
-        "City Lights", "Dancing Stars", "Broken Hearts", "Summer Vibes",
-        "Neon Glow", "Silent Whispers", "Thunder Storm", "Golden Hour",
-        "Velvet Sky", "Crystal Clear", "Fire and Ice", "Moonlight Serenade",
-        "Starlight Express", "Cosmic Journey", "Digital Dreams", "Retro Wave"
-    ]
-    
-    album_covers = generate_image_urls(300, 20, 10)
-    
-    return [
-        (random.choice(song_titles), random.choice(artist_ids), 
-         random.randint(120, 300), random.choice(album_covers))
-        for _ in range(n)
-    ]
-
-def generate_playlists(n, user_ids):
-    playlist_names = [
-        "Chill Vibes", "Workout Mix", "Road Trip", "Study Session",
-        "Party Time", "Relaxing Evening", "Morning Energy", "Late Night",
-        "Top Hits 2024", "Indie Favorites", "Electronic Beats", "Rock Classics",
-        "Jazz Collection", "Pop Anthems", "Acoustic Sessions", "Hip Hop Essentials"
-    ]
-    
-    playlist_covers = generate_image_urls(300, 20, 30)
-    
-    return [
-        (random.choice(playlist_names), False, random.choice(user_ids), random.choice(playlist_covers))
-        for _ in range(n)
-    ]
-
-def generate_unique_combinations(list1, list2, target_count):
-    combinations = set()
-    max_attempts = target_count * 3
-    attempts = 0
-    
-    while len(combinations) < target_count and attempts < max_attempts:
-        combination = (random.choice(list1), random.choice(list2))
-        combinations.add(combination)
-        attempts += 1
-    
-    return list(combinations)
-
-def generate_plays(user_ids, song_ids, n):
-    end_date = datetime.now()
-    
-    return [
-        (random.choice(user_ids), random.choice(song_ids),
-         (end_date - timedelta(days=random.randint(0, 30))).strftime('%Y-%m-%d'))
-        for _ in range(n)
-    ]
-
-def populate_database():
+PROFILE_IMAGES = generate_image_urls(200, 20, 50)
+ARTIST_IMAGES = generate_image_urls(400, 8, 1)
+ALBUM_COVERS = generate_image_urls(300, 20, 10)
+PLAYLIST_COVERS = generate_image_urls(300, 20, 30)
+
+def zipf_rank(rng, n, s):
+    # Inverse CDF of the continuous approximation of Zipf(s) over ranks 1..n:
+    # constant time and memory per draw, whatever the size of n.
+    u = rng.random()
+    if abs(s - 1.0) < 1e-9:
+        x = (n + 1) ** u
+    else:
+        x = (((n + 1) ** (1 - s) - 1) * u + 1) ** (1 / (1 - s))
+    return min(int(x), n)
+
+def popularity_step(n, rng):
+    # Ranks are scattered over ids with rank * step mod n, so the most popular
+    # songs and most active users are not simply the lowest ids.
+    step = rng.randrange(1, n + 1) | 1 if n > 1 else 1
+    while math.gcd(step, n) != 1:
+        step += 1
+    return step
+
+def ranked_id(rank, n, step):
+    return (rank - 1) * step % n + 1
+
+def random_time(rng, end, days):
+    day = end.replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=rng.randrange(days))
+    hour = rng.choices(range(24), cum_weights=HOUR_CUM_WEIGHTS)[0]
+    moment = day + timedelta(hours=hour, seconds=rng.randrange(3600))
+    return moment if moment <= end else moment - timedelta(days=1)
+
+def share(total, n, entity_id):
+    # Spreads `total` rows as evenly as possible over entities 1..n.
+    return total // n + (1 if entity_id <= total % n else 0)
+
+def generate_users(rng, start, count, opts):
+    for user_id in range(start, start + count):
+        username = f"{fake.user_name()}{user_id}"[-50:]
+        email = f"{username}@{fake.free_email_domain()}"
+        yield (user_id, username, email, rng.choice(PROFILE_IMAGES),
+               random_time(rng, opts['end'], opts['days'] * 12))
+
+def generate_artists(rng, start, count, opts):
+    for artist_id in range(start, start + count):
+        yield (artist_id, fake.name(), rng.choice(COUNTRIES), rng.choice(ARTIST_IMAGES))
+
+def generate_songs(rng, start, count, opts):
+    artists = opts['sizes']['artists']
+    for song_id in range(start, start + count):
+        yield (song_id, rng.choice(SONG_TITLES), rng.randint(1, artists),
+               rng.randint(120, 300), rng.choice(ALBUM_COVERS))
+
+def generate_playlists(rng, start, count, opts):
+    users = opts['sizes']['users']
+    for playlist_id in range(start, start + count):
+        yield (playlist_id, rng.choice(PLAYLIST_NAMES), False, rng.randint(1, users),
+               rng.choice(PLAYLIST_COVERS), random_time(rng, opts['end'], opts['days'] * 6))
+
+def generate_playlist_songs(rng, start, count, opts):
+    songs = opts['sizes']['songs']
+    for playlist_id in range(start, start + count):
+        size = min(share(opts['sizes']['playlist_songs'], opts['sizes']['playlists'], playlist_id), songs)
+        for index, song_id in enumerate(rng.sample(range(1, songs + 1), size), 1):
+            yield (playlist_id, song_id, index * POSITION_GAP)
+
+def generate_follows(rng, start, count, opts):
+    playlists = opts['sizes']['playlists']
+    for user_id in range(start, start + count):
+        size = min(share(opts['sizes']['follows'], opts['sizes']['users'], user_id), playlists)
+        for playlist_id in rng.sample(range(1, playlists + 1), size):
+            yield (user_id, playlist_id, random_time(rng, opts['end'], opts['days']))
+
+def generate_plays(rng, start, count, opts):
+    users, songs = opts['sizes']['users'], opts['sizes']['songs']
+    for _ in range(count):
+        user_id = ranked_id(zipf_rank(rng, users, opts['user_skew']), users, opts['user_step'])
+        song_id = ranked_id(zipf_rank(rng, songs, opts['song_skew']), songs, opts['song_step'])
+        yield (user_id, song_id, random_time(rng, opts['end'], opts['days']))
+
+GENERATORS = {
+    'users': generate_users,
+    'artists': generate_artists,
+    'songs': generate_songs,
+    'playlists': generate_playlists,
+    'playlist_songs': generate_playlist_songs,
+    'plays': generate_plays,
+    'follows': generate_follows
+}
+
+# Link tables are generated per parent row (playlist or user), so their
+# chunks are ranges of parent ids rather than ranges of output rows.
+CHUNKED_BY = {'playlist_songs': 'playlists', 'follows': 'users'}
+
+def load_chunk(task):
+    table, start, count, opts = task
+    # Every chunk has its own seed, so a given --seed yields the same data
+    # whatever the number of workers or the order chunks finish in.
+    seed = f"{opts['seed']}:{table}:{start}"
+    rng = random.Random(seed)
+    fake.seed_instance(seed)
+    return table, copy_rows(table, COLUMNS[table], GENERATORS[table](rng, start, count, opts))
+
+def chunk_tasks(table, opts):
+    total = opts['sizes'][CHUNKED_BY.get(table, table)]
+    chunk_size = opts['chunk_size']
+    if table in CHUNKED_BY:
+        per_parent = opts['sizes'][table] / max(total, 1)
+        chunk_size = max(1, int(chunk_size / max(per_parent, 1)))
+    start = 1
+    while start <= total:
+        count = min(chunk_size, total - start + 1)
+        yield (table, start, count, opts)
+        start += count
+
+def reset_sequences():
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            for table in SERIAL_TABLES:
+                cur.execute(
+                    f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), COALESCE(MAX(id), 0) + 1, false) FROM {table}"
+                )
+
+def populate_database(sizes=CONFIG, seed=None, workers=1, chunk_size=100000, days=30,
+                      song_skew=1.1, user_skew=0.8):
+    if seed is None:
+        seed = random.randrange(2 ** 32)
+    rng = random.Random(seed)
+    opts = {
+        'sizes': dict(sizes),
+        'seed': seed,
+        'chunk_size': chunk_size,
+        'days': days,
+        'end': datetime.now().replace(microsecond=0),
+        'song_skew': song_skew,
+        'user_skew': user_skew,
+        'song_step': popularity_step(max(sizes['songs'], 1), rng),
+        'user_step': popularity_step(max(sizes['users'], 1), rng)
+    }
+
     print("Clearing existing data...")
     clear_all_tables()
-    
-    print("Generating users and artists...")
-    users_data = generate_users(CONFIG['users'])
-    artists_data = generate_artists(CONFIG['artists'])
-    
-    print("Inserting users and artists...")
-    user_ids = batch_insert("INSERT INTO users (username, email, profile_image) VALUES {} RETURNING id", users_data)
-    artist_ids = batch_insert("INSERT INTO artists (name, country, profile_image) VALUES {} RETURNING id", artists_data)
-    
-    user_id_list = [user['id'] for user in user_ids] if user_ids else []
-    artist_id_list = [artist['id'] for artist in artist_ids] if artist_ids else []
-    
-    print("Generating songs and playlists...")
-    songs_data = generate_songs(CONFIG['songs'], artist_id_list)
-    playlists_data = generate_playlists(CONFIG['playlists'], user_id_list)
-    
-    print("Inserting songs and playlists...")
-    song_ids = batch_insert("INSERT INTO songs (title, artist_id, duration, album_cover) VALUES {} RETURNING id", songs_data)
-    playlist_ids = batch_insert("INSERT INTO playlists (name, is_curated, created_by, cover) VALUES {} RETURNING id", playlists_data)
-    
-    song_id_list = [song['id'] for song in song_ids] if song_ids else []
-    playlist_id_list = [playlist['id'] for playlist in playlist_ids] if playlist_ids else []
-    
-    print("Inserting playlist songs...")
-    playlist_songs_data = generate_unique_combinations(playlist_id_list, song_id_list, CONFIG['playlist_songs'])
-    batch_insert("INSERT INTO playlist_songs (playlist_id, song_id) VALUES {}", playlist_songs_data)
-    
-    print("Inserting plays...")
-    plays_data = generate_plays(user_id_list, song_id_list, CONFIG['plays'])
-    batch_insert("INSERT INTO plays (user_id, song_id, played_at) VALUES {}", plays_data)
-    
-    print("Inserting follows...")
-    follows_data = generate_unique_combinations(user_id_list, playlist_id_list, CONFIG['follows'])
-    batch_insert("INSERT INTO follows (user_id, playlist_id) VALUES {}", follows_data)
-    
+
+    print("Creating plays partitions...")
+    with get_connection() as conn:
+        ensure_partitions(conn, start=(opts['end'] - timedelta(days=days)).date())
+
+    print(f"Seed {seed}, {workers} worker(s), chunks of {chunk_size} rows")
+    # Workers are spawned rather than forked so none of them inherits the
+    # parent's open database sockets.
+    with multiprocessing.get_context('spawn').Pool(workers) as pool:
+        for phase in PHASES:
+            started = time.monotonic()
+            loaded = dict.fromkeys(phase, 0)
+            tasks = [task for table in phase for task in chunk_tasks(table, opts)]
+            for table, count in pool.imap_unordered(load_chunk, tasks):
+                loaded[table] += count
+            elapsed = time.monotonic() - started
+            print("Loaded " + ", ".join(f"{count} {table}" for table, count in loaded.items()) +
+                  f" in {elapsed:.1f}s ({sum(loaded.values()) / max(elapsed, 1e-9):.0f} rows/s)")
+
+    reset_sequences()
+
+    print("Rebuilding play-count rollups...")
+    with get_connection() as conn:
+        rebuild_rollups(conn)
+
+    print("Analyzing tables...")
+    with get_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("ANALYZE")
+
     print("Database populated successfully!")
 
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Fill the database with synthetic users, songs, playlists and plays.")
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help="multiply every default table size by this factor")
+    for table in CONFIG:
+        parser.add_argument('--' + table.replace('_', '-'), type=int, dest=table,
+                            help=f"number of {table.replace('_', ' ')} rows (default {CONFIG[table]} x scale)")
+    parser.add_argument('--seed', type=int, help="random seed; the same seed reproduces the same data")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="loader processes (default: CPU count)")
+    parser.add_argument('--chunk-size', type=int, default=100000, help="rows per COPY")
+    parser.add_argument('--days', type=int, default=30, help="plays are spread over this many days")
+    parser.add_argument('--song-skew', type=float, default=1.1, help="Zipf exponent of song popularity")
+    parser.add_argument('--user-skew', type=float, default=0.8, help="Zipf exponent of user activity")
+    return parser.parse_args()
+
 if __name__ == '__main__':
-    populate_database()
+    args = parse_args()
+    sizes = {table: getattr(args, table) if getattr(args, table) is not None
+             else max(1, int(count * args.scale)) for table, count in CONFIG.items()}
+    populate_database(sizes, seed=args.seed, workers=args.workers, chunk_size=args.chunk_size,
+                      days=args.days, song_skew=args.song_skew, user_skew=args.user_skew)
@@ -0,0 +1,493 @@
+import os
+import threading
+import time
+from pathlib import Path
+
+import psycopg2
+from psycopg2 import extensions
+from dotenv import load_dotenv
+
+from instrumentation import InstrumentedCursor, record_checkout, record_connect
+import admission
+
+load_dotenv(dotenv_path=Path(__file__).resolve().parent / ".env")
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+def connection_params():
+    return {
+        'host': os.getenv("DB_HOST"),
+        'port': os.getenv("DB_PORT"),
+        'user': os.getenv("DB_USER"),
+        'password': os.getenv("DB_PASSWORD"),
+        'database': os.getenv("DB_DATABASE")
+    }
+
+
+# Read replicas: DB_REPLICAS is a comma-separated list of host[:port]
+# addresses; user, password and database are the primary's. Read-only
+# handlers are spread over the replicas that passed their last health check
+# and lag at most REPLICA_MAX_LAG seconds behind; with none usable they fall
+# back to the primary.
+REPLICA_HOSTS = [h.strip() for h in os.getenv("DB_REPLICAS", "").split(',') if h.strip()]
+REPLICA_MAX_LAG = float(os.getenv("REPLICA_MAX_LAG", 5))
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", 5))
+REPLICA_CHECK_TIMEOUT = float(os.getenv("REPLICA_CHECK_TIMEOUT", 2))
+
+# Seconds of replay lag. A replica that has replayed everything it received
+# counts as current even when the primary has been idle for a while.
+REPLICA_LAG_QUERY = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END
+"""
+
+
+def replica_params():
+    replicas = {}
+    for number, address in enumerate(REPLICA_HOSTS, 1):
+        host, _, port = address.partition(':')
+        replicas['replica-%d' % number] = dict(connection_params(), host=host, port=port or os.getenv("DB_PORT"))
+    return replicas
+
+
+def pool_config():
+    return {
+        'minconn': int(os.getenv("DB_POOL_MIN", 1)),
+        'maxconn': int(os.getenv("DB_POOL_MAX", os.getenv("MAX_CONNECTIONS", 20))),
+        'timeout': float(os.getenv("DB_POOL_TIMEOUT", 10)),
+        'max_uses': int(os.getenv("DB_POOL_MAX_USES", 1000)),
+        'check_after': float(os.getenv("DB_POOL_CHECK_IDLE", 30)),
+        'max_idle': float(os.getenv("DB_POOL_MAX_IDLE", 300))
+    }
+
+
+class PooledConnection:
+    # Looks like a psycopg2 connection to the handlers, but close() hands the
+    # underlying connection back to the pool instead of tearing it down.
+
+    def __init__(self, pool, raw):
+        self._pool = pool
+        self._raw = raw
+
+    def __getattr__(self, name):
+        raw = self.__dict__.get('_raw')
+        if raw is None:
+            raise psycopg2.InterfaceError("connection already returned to the pool")
+        return getattr(raw, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if self._raw is not None and not self._raw.closed:
+                if exc_type is None:
+                    self._raw.commit()
+                else:
+                    self._raw.rollback()
+        finally:
+            self.close()
+
+    @property
+    def raw(self):
+        return self._raw
+
+    def close(self):
+        if self._raw is not None:
+            raw, self._raw = self._raw, None
+            self._pool.release(raw)
+
+
+class ConnectionPool:
+    def __init__(self, params, minconn=1, maxconn=20, timeout=10.0, max_uses=1000,
+                 check_after=30.0, max_idle=300.0):
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("invalid pool size: min=%s max=%s" % (minconn, maxconn))
+        self.params = params
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.max_uses = max_uses
+        self.check_after = check_after
+        self.max_idle = max_idle
+
+        self._cond = threading.Condition()
+        self._idle = []
+        self._uses = {}
+        self._timeouts = {}
+        self._size = 0
+        self._filled = False
+        self._stats = {
+            'checkouts': 0,
+            'waits': 0,
+            'wait_time': 0.0,
+            'timeouts': 0,
+            'created': 0,
+            'recycled': 0,
+            'discarded': 0
+        }
+
+    def _connect(self):
+        started = time.perf_counter()
+        raw = psycopg2.connect(cursor_factory=InstrumentedCursor, **self.params)
+        record_connect(time.perf_counter() - started)
+        with self._cond:
+            self._uses[id(raw)] = 0
+            self._stats['created'] += 1
+        return raw
+
+    def _discard(self, raw, reason='discarded'):
+        try:
+            if not raw.closed:
+                raw.close()
+        except psycopg2.Error:
+            pass
+        with self._cond:
+            self._uses.pop(id(raw), None)
+            self._timeouts.pop(id(raw), None)
+            self._size -= 1
+            self._stats[reason] += 1
+            self._cond.notify()
+
+    def _prefill(self):
+        with self._cond:
+            if self._filled:
+                return
+            self._filled = True
+            missing = self.minconn - self._size
+            self._size += max(missing, 0)
+        for _ in range(max(missing, 0)):
+            try:
+                raw = self._connect()
+            except psycopg2.Error:
+                with self._cond:
+                    self._size -= 1
+                    self._cond.notify()
+                continue
+            with self._cond:
+                self._idle.append((raw, time.monotonic()))
+                self._cond.notify()
+
+    def _reap_idle(self, now):
+        # Caller holds the lock. Drops connections that sat idle too long while
+        # keeping at least `minconn` open.
+        expired = []
+        while self._idle and self._size - len(expired) > self.minconn:
+            raw, last_used = self._idle[0]
+            if now - last_used < self.max_idle:
+                break
+            self._idle.pop(0)
+            expired.append(raw)
+        return expired
+
+    def _is_alive(self, raw, last_used):
+        if raw.closed:
+            return False
+        if time.monotonic() - last_used < self.check_after:
+            return True
+        try:
+            with raw.cursor() as cur:
+                cur.execute("SELECT 1")
+            raw.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self, timeout=None):
+        if not self._filled:
+            self._prefill()
+
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        waited = False
+
+        while True:
+            create = False
+            with self._cond:
+                expired = self._reap_idle(time.monotonic())
+                while not self._idle and self._size >= self.maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeout(
+                            "no database connection available within %.1fs (pool max %d)"
+                            % (timeout, self.maxconn))
+                    waited = True
+                    self._cond.wait(remaining)
+                if self._idle:
+                    raw, last_used = self._idle.pop()
+                else:
+                    self._size += 1
+                    create = True
+
+            for stale in expired:
+                self._discard(stale)
+
+            if create:
+                try:
+                    raw = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_alive(raw, last_used):
+                self._discard(raw)
+                continue
+
+            with self._cond:
+                self._stats['checkouts'] += 1
+                if waited:
+                    self._stats['waits'] += 1
+                    self._stats['wait_time'] += time.monotonic() - started
+            record_checkout(time.monotonic() - started)
+            try:
+                self._set_statement_timeout(raw)
+            except Exception:
+                self.release(raw)
+                raise
+            return raw
+
+    def _set_statement_timeout(self, raw):
+        # The current request's admission class decides the timeout. It is a
+        # session setting, so it is only sent when it differs from what the
+        # connection was last given.
+        timeout = admission.statement_timeout()
+        with self._cond:
+            current = self._timeouts.get(id(raw))
+        if timeout == current:
+            return
+        with raw.cursor() as cur:
+            cur.execute(*admission.statement_timeout_query(timeout))
+        raw.commit()
+        with self._cond:
+            self._timeouts[id(raw)] = timeout
+
+    def release(self, raw):
+        if raw.closed:
+            self._discard(raw)
+            return
+
+        try:
+            if raw.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+                raw.rollback()
+        except psycopg2.Error:
+            self._discard(raw)
+            return
+
+        with self._cond:
+            uses = self._uses.get(id(raw), 0) + 1
+            self._uses[id(raw)] = uses
+        if self.max_uses and uses >= self.max_uses:
+            self._discard(raw, 'recycled')
+            return
+
+        with self._cond:
+            self._idle.append((raw, time.monotonic()))
+            self._cond.notify()
+
+    def connection(self, timeout=None):
+        return PooledConnection(self, self.getconn(timeout))
+
+    def closeall(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+        for raw, _ in idle:
+            self._discard(raw)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['size'] = self._size
+            stats['idle'] = len(self._idle)
+            stats['in_use'] = self._size - len(self._idle)
+            stats['max'] = self.maxconn
+            stats['min'] = self.minconn
+            stats['avg_wait'] = stats['wait_time'] / stats['waits'] if stats['waits'] else 0.0
+        return stats
+
+
+class ReplicaRouter:
+    # Health and lag bookkeeping for the replicas, shared by both apps; the
+    # checks themselves run on each app's own driver (check_replicas here,
+    # asgi_app.check_replicas). A replica is only used while its last check
+    # succeeded, is recent and saw little enough lag, so an unreachable or
+    # stalled replica drops out within a few check intervals.
+
+    def __init__(self, names, max_lag=REPLICA_MAX_LAG, check_interval=REPLICA_CHECK_INTERVAL):
+        self.names = list(names)
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._next = 0
+        self._state = {name: {'healthy': False, 'lag': None, 'checked_at': None, 'error': 'not checked yet'}
+                       for name in self.names}
+        self._routed = dict.fromkeys(self.names + ['primary'], 0)
+        self._fallbacks = 0
+
+    def _usable(self, state, now):
+        return (state['healthy'] and state['lag'] <= self.max_lag
+                and now - state['checked_at'] <= 3 * self.check_interval)
+
+    def choose(self):
+        # Round-robin over usable replicas; None means the primary.
+        now = time.monotonic()
+        with self._lock:
+            usable = [name for name in self.names if self._usable(self._state[name], now)]
+            if not usable:
+                self._routed['primary'] += 1
+                if self.names:
+                    self._fallbacks += 1
+                return None
+            name = usable[self._next % len(usable)]
+            self._next += 1
+            self._routed[name] += 1
+            return name
+
+    def record(self, name, lag):
+        with self._lock:
+            self._state[name] = {'healthy': True, 'lag': float(lag), 'checked_at': time.monotonic(), 'error': None}
+
+    def mark_down(self, name, error):
+        with self._lock:
+            self._state[name] = {'healthy': False, 'lag': None, 'checked_at': time.monotonic(),
+                                 'error': str(error).strip()}
+
+    def unroute(self, name):
+        # A request routed to `name` could not get a connection and went to
+        # the primary instead.
+        with self._lock:
+            self._routed[name] -= 1
+            self._routed['primary'] += 1
+            self._fallbacks += 1
+
+    def stats(self):
+        now = time.monotonic()
+        with self._lock:
+            replicas = {}
+            for name, state in self._state.items():
+                replicas[name] = dict(state, usable=self._usable(state, now),
+                                      checked_ago=now - state['checked_at'] if state['checked_at'] else None,
+                                      routed=self._routed[name])
+                del replicas[name]['checked_at']
+            return {'replicas': replicas, 'primary_reads': self._routed['primary'],
+                    'fallbacks': self._fallbacks, 'max_lag': self.max_lag}
+
+
+_pools = {}
+_pools_pid = os.getpid()
+_pools_lock = threading.Lock()
+_router = None
+_checker = None
+
+
+def _reset_after_fork():
+    # Caller holds _pools_lock. Connections must never be shared across a
+    # fork; a forked worker starts with its own empty pools and its own
+    # replica health checks.
+    global _pools, _pools_pid, _router, _checker
+    if _pools_pid != os.getpid():
+        _pools, _pools_pid, _router, _checker = {}, os.getpid(), None, None
+
+
+def get_pool(name='primary'):
+    with _pools_lock:
+        _reset_after_fork()
+        pool = _pools.get(name)
+        if pool is None:
+            params = connection_params() if name == 'primary' else replica_params()[name]
+            pool = ConnectionPool(params, **pool_config())
+            _pools[name] = pool
+        return pool
+
+
+def get_connection(timeout=None):
+    return get_pool().connection(timeout)
+
+
+def get_router():
+    # None when no replicas are configured. The first call in a process
+    # starts the background health checks.
+    global _router, _checker
+    if not REPLICA_HOSTS:
+        return None
+    with _pools_lock:
+        _reset_after_fork()
+        if _router is None:
+            _router = ReplicaRouter(replica_params())
+        if _checker is None:
+            _checker = threading.Thread(target=check_replicas_forever, args=(_router,),
+                                        name='replica-checks', daemon=True)
+            _checker.start()
+        return _router
+
+
+def check_replica(router, name):
+    try:
+        conn = get_pool(name).connection(REPLICA_CHECK_TIMEOUT)
+        try:
+            with conn.cursor() as cur:
+                cur.execute(REPLICA_LAG_QUERY)
+                lag = cur.fetchone()[0]
+        finally:
+            conn.close()
+    except Exception as e:
+        router.mark_down(name, e)
+        return
+    router.record(name, lag)
+
+
+def check_replicas_forever(router):
+    while True:
+        for name in router.names:
+            check_replica(router, name)
+        time.sleep(router.check_interval)
+
+
+def get_read_connection(timeout=None):
+    # For handlers that never write: a usable replica if there is one,
+    # otherwise the primary. A replica that cannot hand out a connection is
+    # taken out of rotation until its next successful check.
+    router = get_router()
+    name = router.choose() if router is not None else None
+    if name is None:
+        return get_connection(timeout)
+    try:
+        return get_pool(name).connection(timeout)
+    except (psycopg2.Error, PoolTimeout) as e:
+        router.mark_down(name, e)
+        router.unroute(name)
+        return get_connection(timeout)
+
+
+def pool_stats():
+    with _pools_lock:
+        pools = dict(_pools)
+    return {name: pool.stats() for name, pool in pools.items()}
+
+
+def routing_stats():
+    router = get_router()
+    return router.stats() if router is not None else None
+
+
+if __name__ == '__main__':
+    # Checks every configured replica once and prints its state, e.g. to
+    # try the routing locally against a primary and a streaming replica.
+    if not REPLICA_HOSTS:
+        raise SystemExit("DB_REPLICAS is not set")
+    router = ReplicaRouter(replica_params())
+    for name in router.names:
+        check_replica(router, name)
+    for name, state in router.stats()['replicas'].items():
+        if state['healthy']:
+            print("%s: lag %.1fs, %s" % (name, state['lag'], 'usable' if state['usable'] else 'too far behind'))
+        else:
+            print("%s: down (%s)" % (name, state['error']))
@@ -1,66 +1,170 @@
 from flask import Flask, request, jsonify, send_from_directory
-import psycopg2
+from psycopg2.errors import QueryCanceled
 import os
+import threading
 from dotenv import load_dotenv
 from flask_cors import CORS
-from functools import lru_cache
+from db_pool import get_pool, get_read_connection, pool_stats, routing_stats, PoolTimeout
+from rollups import record_plays, init_playlist_counts
+from play_buffer import get_play_buffer, parse_play_event, BufferFull
+from search import search_songs
+from charts import InvalidWindow, top_artists_query, top_songs_query
+from recommender import recommendations_query, similar_songs_query
+from thumbnails import ImageNotFound, ImageUnavailable, InvalidImageRequest
+from playlists import InvalidPlaylistEdit, PlaylistNotFound, run_transaction
+from response_cache import cached_response, get_response_cache, invalidate
+from conditional import conditional_response
+from pagination import (InvalidCursor, InvalidIdList, decode_cursor, page_size, parse_id_list,
+                        split_page, wants_pagination, with_next_cursor)
+from streaming import RowStream, encode_rows, stream_format, stream_mimetype
+from instrumentation import init_app, metrics, pool_gauges
+from admission import Overloaded
+import serialization
+import thumbnails
+import sketches
+import playlists
+import feeds
+import entity_cache
+import admission
+import queries
 
 load_dotenv()
 app = Flask(__name__)
-CORS(app, supports_credentials=True)
+CORS(app, supports_credentials=True, expose_headers=['X-Next-Cursor', 'Link', 'Server-Timing', 'ETag', 'Last-Modified'])
+init_app(app)
+admission.init_app(app)
+serialization.init_app(app)
+
+PLAY_INGEST_MODE = os.getenv("PLAY_INGEST_MODE", "direct")
+MAX_PLAY_BATCH = int(os.getenv("MAX_PLAY_BATCH", 1000))
+PLAY_BUFFER_WAIT = float(os.getenv("PLAY_BUFFER_WAIT", 0.5))
 
 def get_db_connection():
-    return psycopg2.connect(
-        host=os.getenv("DB_HOST"),
-        database=os.getenv("DB_DATABASE"),
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        port=os.getenv("DB_PORT")
-    )
+    return get_pool().connection()
+
+@app.errorhandler(PoolTimeout)
+def handle_pool_timeout(e):
+    response = jsonify({'error': str(e)})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+@app.errorhandler(Overloaded)
+def handle_overloaded(e):
+    response = jsonify({'error': str(e)})
+    response.headers['Retry-After'] = str(e.retry_after)
+    return response, 503
+
+@app.errorhandler(QueryCanceled)
+def handle_statement_timeout(e):
+    # The query outran its admission class's statement_timeout.
+    admission.record_statement_timeout()
+    response = jsonify({'error': 'Query took too long, retry later'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
+
+@app.errorhandler(InvalidCursor)
+@app.errorhandler(InvalidIdList)
+@app.errorhandler(InvalidWindow)
+@app.errorhandler(InvalidImageRequest)
+@app.errorhandler(InvalidPlaylistEdit)
+def handle_invalid_argument(e):
+    return jsonify({'error': str(e)}), 400
+
+@app.errorhandler(ImageNotFound)
+@app.errorhandler(PlaylistNotFound)
+def handle_not_found(e):
+    return jsonify({'error': str(e)}), 404
+
+@app.errorhandler(ImageUnavailable)
+def handle_image_unavailable(e):
+    return jsonify({'error': str(e)}), 502
+
+_warm_up_started = threading.Event()
+
+def warm_entity_cache():
+    try:
+        loaded = entity_cache.run_sync(entity_cache.warm_up(), get_db_connection)
+        entity_cache.log.info("Entity cache warmed: %s", loaded)
+    except Exception as e:
+        entity_cache.log.warning("Entity cache warm-up failed: %s", e)
+
+@app.before_request
+def start_entity_cache_warm_up():
+    # Warm-up runs once per process, in the background, from the first request.
+    if entity_cache.ENABLED and entity_cache.ENTITY_CACHE_WARM and not _warm_up_started.is_set():
+        _warm_up_started.set()
+        threading.Thread(target=warm_entity_cache, name='entity-cache-warm-up', daemon=True).start()
+
+def requested_stream():
+    return stream_format(request.args, request.headers.get('Accept'))
+
+def stream_list(fmt, query, params, from_row, connect=get_db_connection):
+    # Rows go from the server-side cursor straight to the socket; the pooled
+    # connection is held until the body is fully sent (or the client leaves).
+    conn = connect()
+    try:
+        rows = RowStream(conn, query, params)
+    except QueryCanceled:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    response = app.response_class(encode_rows(rows, from_row, fmt, app.json.encode), mimetype=stream_mimetype(fmt))
+    response.call_on_close(rows.close)
+    return response
+
+def db_json_list(query, connect=get_db_connection):
+    # Serves a body that Postgres already rendered as JSON (JSON_FROM_DB).
+    conn = connect()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query)
+            return app.response_class(cur.fetchone()[0] + '\n', mimetype='application/json')
+    except QueryCanceled:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        conn.close()
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return app.response_class(metrics.render(pool_gauges(pool_stats()) + admission.gauges()),
+                              mimetype='text/plain; version=0.0.4')
+
+@app.route('/pool-stats', methods=['GET'])
+def get_pool_stats():
+    return jsonify(dict(pool_stats(), routing=routing_stats(), admission=admission.stats()))
 
 @app.route('/songs')
 def get_songs():
+    if 'ids' in request.args:
+        return get_details_batch('songs', queries.SONG_DETAILS_QUERY, parse_id_list(request.args['ids']),
+                                 queries.song_details_from_row)
+
     page = request.args.get('page', 1, type=int)
-    per_page = request.args.get('per_page', 20, type=int)
+    per_page = page_size(request.args)
     search = request.args.get('search', '', type=str)
-    offset = (page - 1) * per_page
-    
-    conn = get_db_connection()
+    cursor = request.args.get('cursor')
+    # Browsing seeks on (title, id), search results on (rank, id).
+    after = decode_cursor(cursor, queries.SEARCH_CURSOR if search else queries.SONG_CURSOR) if cursor else None
+    # Legacy page numbers still work, but only cursors stay cheap on deep pages.
+    offset = (page - 1) * per_page if page > 1 and not after else 0
+
+    conn = get_read_connection()
     try:
         cur = conn.cursor()
-        
-        base_query = """
-            SELECT s.id, s.title, s.artist_id, s.duration, s.album_cover, a.name as artist_name 
-            FROM songs s 
-            JOIN artists a ON s.artist_id = a.id 
-        """
-        
+
         if search:
-            base_query += """
-                WHERE LOWER(s.title) LIKE LOWER(%s) OR LOWER(a.name) LIKE LOWER(%s)
-            """
-            search_param = f"%{search}%"
-            params = (search_param, search_param, per_page, offset)
+            rows = search_songs(cur, search, per_page + 1, after, offset)
+            rows, next_cursor = split_page(rows, per_page, queries.search_cursor_key)
         else:
-            params = (per_page, offset)
-            
-        base_query += " ORDER BY s.title LIMIT %s OFFSET %s"
-        
-        cur.execute(base_query, params)
-        
-        rows = cur.fetchall()
-        songs = []
-        for row in rows:
-            songs.append({
-                'id': row[0],
-                'title': row[1],
-                'artist_id': row[2],
-                'duration': row[3],
-                'album_cover': row[4],
-                'artist_name': row[5]
-            })
-        
-        return jsonify(songs)
+            cur.execute(*queries.songs_query(after, per_page + 1, offset))
+            rows, next_cursor = split_page(cur.fetchall(), per_page, queries.song_cursor_key)
+
+        songs = [queries.song_from_row(row) for row in rows]
+        return with_next_cursor(jsonify(songs), next_cursor)
+    except QueryCanceled:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -68,118 +172,103 @@ def get_songs():
         conn.close()
 
 @app.route('/top-songs', methods=['GET'])
+@cached_response('top-songs', ttl=60, tags=('plays',))
 def get_top_songs():
-    conn = None
+    query, params = top_songs_query(request.args)
+    conn = get_read_connection()
     try:
-        conn = get_db_connection()
         with conn.cursor() as cur:
-            cur.execute("""
-                SELECT s.id, s.title, a.name as artist, COUNT(*) as play_count, s.album_cover
-                FROM plays p
-                JOIN songs s ON p.song_id = s.id
-                LEFT JOIN artists a ON s.artist_id = a.id
-                WHERE p.played_at >= CURRENT_DATE - INTERVAL '7 days'
-                GROUP BY s.id, s.title, a.name, s.album_cover
-                ORDER BY play_count DESC
-                LIMIT 10
-            """)
-            
-            columns = [desc[0] for desc in cur.description]
-            results = [dict(zip(columns, row)) for row in cur.fetchall()]
-            
+            cur.execute(query, params)
+            results = queries.rows_as_dicts(cur.description, cur.fetchall())
+
         return jsonify(results)
+    except QueryCanceled:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
-        if conn:
-            conn.close()
+        conn.close()
+
+@app.route('/top-artists', methods=['GET'])
+@cached_response('top-artists', ttl=60, tags=('plays',))
+def get_top_artists():
+    query, params = top_artists_query(request.args)
+    conn = get_read_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            results = queries.rows_as_dicts(cur.description, cur.fetchall())
+
+        return jsonify(results)
+    except QueryCanceled:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        conn.close()
 
 @app.route('/top-users', methods=['GET'])
+@cached_response('top-users', ttl=120, tags=('plays',))
 def get_top_users():
+    conn = get_read_connection()
     try:
-        conn = get_db_connection()
         with conn.cursor() as cur:
-            cur.execute("""
-                SELECT u.id, u.username, u.email, u.profile_image, u.created_at,
-                       COALESCE(SUM(s.duration), 0) as total_playtime
-                FROM users u
-                LEFT JOIN plays p ON u.id = p.user_id
-                LEFT JOIN songs s ON p.song_id = s.id
-                GROUP BY u.id, u.username, u.email, u.profile_image, u.created_at
-                ORDER BY total_playtime DESC
-                LIMIT 3
-            """)
-            
-            columns = [desc[0] for desc in cur.description]
-            results = [dict(zip(columns, row)) for row in cur.fetchall()]
-            
+            cur.execute(queries.TOP_USERS_QUERY)
+            results = queries.rows_as_dicts(cur.description, cur.fetchall())
+
             return jsonify(results)
+    except QueryCanceled:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
         conn.close()
 
 @app.route('/user-playtime', methods=['GET'])
+@cached_response('user-playtime', ttl=120, tags=('plays',), unless=requested_stream)
 def get_user_playtime():
+    fmt = requested_stream()
+    if fmt:
+        return stream_list(fmt, *queries.user_playtime_query(None), queries.user_playtime_from_row,
+                           connect=get_read_connection)
+
+    paged = wants_pagination(request.args)
+    if not paged and serialization.JSON_FROM_DB:
+        return db_json_list(queries.USER_PLAYTIME_JSON_QUERY, get_read_connection)
+    per_page = page_size(request.args)
+    cursor = request.args.get('cursor')
+    after = decode_cursor(cursor, queries.USER_PLAYTIME_CURSOR) if cursor else None
+
+    conn = get_read_connection()
     try:
-        conn = get_db_connection()
         with conn.cursor() as cur:
-            cur.execute("""
-                SELECT u.id, u.username, u.email, u.profile_image, u.created_at,
-                       COALESCE(SUM(s.duration), 0) as total_playtime
-                FROM users u
-                LEFT JOIN plays p ON u.id = p.user_id
-                LEFT JOIN songs s ON p.song_id = s.id
-                GROUP BY u.id, u.username, u.email, u.profile_image, u.created_at
-                ORDER BY total_playtime DESC
-            """)
-            
-            columns = [desc[0] for desc in cur.description]
-            results = []
-            for row in cur.fetchall():
-                user_data = dict(zip(columns, row))
-                results.append({
-                    'user': {
-                        'id': user_data['id'],
-                        'username': user_data['username'],
-                        'email': user_data['email'],
-                        'profile_image': user_data['profile_image'],
-                        'created_at': user_data['created_at'].isoformat() if user_data['created_at'] else None
-                    },
-                    'total_playtime': user_data['total_playtime']
-                })
-            
-            return jsonify(results)
+            cur.execute(*queries.user_playtime_query(after, per_page + 1 if paged else None))
+
+            rows, next_cursor = cur.fetchall(), None
+            if paged:
+                rows, next_cursor = split_page(rows, per_page, queries.user_playtime_cursor_key)
+
+            results = [queries.user_playtime_from_row(row) for row in rows]
+            return with_next_cursor(jsonify(results), next_cursor)
+    except QueryCanceled:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
         conn.close()
 
 @app.route('/top-playlists', methods=['GET'])
+@cached_response('top-playlists', ttl=60, tags=('plays', 'playlists'))
 def get_top_playlists():
-    conn = get_db_connection()
+    conn = get_read_connection()
     try:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT p.id, p.name, p.cover, COALESCE(play_counts.total_plays, 0) as play_count
-            FROM playlists p
-            LEFT JOIN (
-                SELECT ps.playlist_id, COUNT(pl.id) as total_plays
-                FROM playlist_songs ps
-                LEFT JOIN plays pl ON ps.song_id = pl.song_id
-                GROUP BY ps.playlist_id
-            ) play_counts ON p.id = play_counts.playlist_id
-            ORDER BY play_count DESC, p.created_at DESC
-            LIMIT 5
-        """)
+        cur.execute(queries.TOP_PLAYLISTS_QUERY)
         rows = cur.fetchall()
-        
-        return jsonify([{
-            'id': row[0],
-            'name': row[1],
-            'cover': row[2],
-            'play_count': row[3]
-        } for row in rows])
+
+        return jsonify([queries.top_playlist_from_row(row) for row in rows])
+    except QueryCanceled:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -187,35 +276,31 @@ def get_top_playlists():
         conn.close()
 
 @app.route('/playlists', methods=['GET'])
+@conditional_response('playlists', queries.PLAYLISTS_VERSION_QUERY)
 def get_playlists():
+    fmt = requested_stream()
+    if fmt:
+        return stream_list(fmt, *queries.playlists_query(None), queries.playlist_from_row)
+
+    paged = wants_pagination(request.args)
+    if not paged and serialization.JSON_FROM_DB:
+        return db_json_list(queries.PLAYLISTS_JSON_QUERY)
+    per_page = page_size(request.args)
+    cursor = request.args.get('cursor')
+    after = decode_cursor(cursor, queries.PLAYLIST_CURSOR) if cursor else None
+
     conn = get_db_connection()
     try:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT p.id, p.name, p.is_curated, p.created_by, p.created_at, p.cover, 
-                   u.username as creator_username, COALESCE(play_counts.total_plays, 0) as play_count
-            FROM playlists p
-            LEFT JOIN users u ON p.created_by = u.id
-            LEFT JOIN (
-                SELECT ps.playlist_id, COUNT(pl.id) as total_plays
-                FROM playlist_songs ps
-                LEFT JOIN plays pl ON ps.song_id = pl.song_id
-                GROUP BY ps.playlist_id
-            ) play_counts ON p.id = play_counts.playlist_id
-            ORDER BY p.created_at DESC
-        """)
-        rows = cur.fetchall()
-        
-        return jsonify([{
-            'id': row[0],
-            'name': row[1],
-            'is_curated': row[2],
-            'created_by': row[3],
-            'created_at': row[4].isoformat() if row[4] else None,
-            'cover': row[5],
-            'creator_username': row[6],
-            'play_count': row[7]
-        } for row in rows])
+        cur.execute(*queries.playlists_query(after, per_page + 1 if paged else None))
+
+        rows, next_cursor = cur.fetchall(), None
+        if paged:
+            rows, next_cursor = split_page(rows, per_page, queries.playlist_cursor_key)
+
+        return with_next_cursor(jsonify([queries.playlist_from_row(row) for row in rows]), next_cursor)
+    except QueryCanceled:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
@@ -225,49 +310,43 @@ def get_playlists():
 @app.route('/playlists', methods=['POST'])
 def create_playlist():
     data = request.get_json()
-    
+
     if not data or 'name' not in data:
         return jsonify({'error': 'Missing required field: name'}), 400
-    
+
     name = data['name'].strip()
     description = data.get('description', '').strip()
     cover = data.get('cover', None)
-    
+
     if not name:
         return jsonify({'error': 'Playlist name cannot be empty'}), 400
-    
+    if cover is not None and not thumbnails.allowed_image_url(cover):
+        return jsonify({'error': 'cover must be an http(s) URL on an allowed image host'}), 400
+
     conn = get_db_connection()
     try:
         cur = conn.cursor()
-        
-        cur.execute("SELECT id, username FROM users ORDER BY RANDOM() LIMIT 1")
+
+        cur.execute(queries.RANDOM_USER_QUERY)
         user_row = cur.fetchone()
-        
+
         if not user_row:
             return jsonify({'error': 'No users found in database'}), 500
-        
+
         random_user_id, random_username = user_row
-        
-        cur.execute("""
-            INSERT INTO playlists (name, created_by, is_curated, cover, description) 
-            VALUES (%s, %s, %s, %s, %s) 
-            RETURNING id, name, is_curated, created_by, created_at, cover, description
-        """, (name, random_user_id, False, cover, description))
-        
+
+        cur.execute(queries.CREATE_PLAYLIST_QUERY, (name, random_user_id, False, cover, description))
+
         playlist_row = cur.fetchone()
+        init_playlist_counts(cur, playlist_row[0])
         conn.commit()
-        
-        return jsonify({
-            'id': playlist_row[0],
-            'name': playlist_row[1],
-            'is_curated': playlist_row[2],
-            'created_by': playlist_row[3],
-            'created_at': playlist_row[4].isoformat() if playlist_row[4] else None,
-            'cover': playlist_row[5],
-            'creator_username': random_username,
-            'play_count': 0
-        }), 201
-        
+        invalidate('playlists')
+        entity_cache.invalidate('user_activity', [random_user_id])
+
+        return jsonify(queries.created_playlist_from_row(playlist_row, random_username)), 201
+
+    except QueryCanceled:
+        raise
     except Exception as e:
         conn.rollback()
         return jsonify({'error': str(e)}), 500
@@ -275,17 +354,88 @@ def create_playlist():
         cur.close()
         conn.close()
 
+def enqueue_plays(events):
+    try:
+        get_play_buffer().add(events, timeout=PLAY_BUFFER_WAIT)
+    except BufferFull as e:
+        response = jsonify({'error': str(e)})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+    return jsonify({'queued': len(events)}), 202
+
+@app.route('/playlists/<int:playlist_id>/songs', methods=['GET'])
+def get_playlist_songs(playlist_id):
+    # Tracks in playlist order, paged on (position, song_id) so deep pages of
+    # long playlists cost the same as the first.
+    per_page = page_size(request.args)
+    cursor = request.args.get('cursor')
+    after = decode_cursor(cursor, playlists.TRACK_CURSOR) if cursor else None
+    conn = get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(*playlists.tracks_query(playlist_id, after, per_page + 1))
+            rows = cur.fetchall()
+            if not rows and not after:
+                cur.execute(playlists.PLAYLIST_EXISTS_QUERY, (playlist_id,))
+                if cur.fetchone() is None:
+                    return jsonify({'error': 'Playlist not found'}), 404
+        rows, next_cursor = split_page(rows, per_page, playlists.track_cursor_key)
+        return with_next_cursor(jsonify([playlists.track_from_row(row) for row in rows]), next_cursor)
+    except QueryCanceled:
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    finally:
+        conn.close()
+
+def edit_playlist(playlist_id, edit):
+    try:
+        result = run_transaction(edit, get_db_connection())
+    except (InvalidPlaylistEdit, PlaylistNotFound, PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    invalidate('playlists')
+    entity_cache.invalidate('playlists', [playlist_id])
+    entity_cache.invalidate('playlist_plays', [playlist_id])
+    return jsonify(result)
+
+@app.route('/playlists/<int:playlist_id>/songs', methods=['POST'])
+def add_playlist_songs(playlist_id):
+    return edit_playlist(playlist_id, playlists.add_songs(playlist_id, request.get_json(silent=True)))
+
+@app.route('/playlists/<int:playlist_id>/songs', methods=['DELETE'])
+def remove_playlist_songs(playlist_id):
+    # Clients that cannot send a DELETE body may pass ?ids=1,2,3 instead.
+    data = {'song_ids': parse_id_list(request.args['ids'])} if 'ids' in request.args else request.get_json(silent=True)
+    return edit_playlist(playlist_id, playlists.remove_songs(playlist_id, data))
+
+@app.route('/playlists/<int:playlist_id>/songs', methods=['PATCH'])
+def move_playlist_songs(playlist_id):
+    return edit_playlist(playlist_id, playlists.move_songs(playlist_id, request.get_json(silent=True)))
+
 @app.route('/plays', methods=['POST'])
 def add_play():
     data = request.get_json()
+    if PLAY_INGEST_MODE == 'buffered':
+        try:
+            return enqueue_plays([parse_play_event(data)])
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'error': 'Invalid play: %s' % e}), 400
     conn = get_db_connection()
     try:
         cur = conn.cursor()
-        cur.execute("INSERT INTO plays (user_id, song_id) VALUES (%s, %s) RETURNING id", 
-                   (data['user_id'], data['song_id']))
+        cur.execute(queries.INSERT_PLAY_QUERY, (data['user_id'], data['song_id']))
         play = cur.fetchone()
+        record_plays(cur, [play[1:]])
         conn.commit()
+        sketches.record_plays([play[1:]])
+        invalidate('plays')
+        entity_cache.invalidate('song_plays', [play[2]])
+        entity_cache.invalidate('user_activity', [play[1]])
         return jsonify({'id': play[0]}), 201
+    except QueryCanceled:
+        raise
     except Exception as e:
         conn.rollback()
         return jsonify({'error': str(e)}), 400
@@ -293,235 +443,259 @@ def add_play():
         cur.close()
         conn.close()
 
+@app.route('/plays/batch', methods=['POST'])
+def add_plays_batch():
+    data = request.get_json(silent=True)
+    events = data.get('plays') if isinstance(data, dict) else data
+
+    if not isinstance(events, list) or not events:
+        return jsonify({'error': 'Expected a non-empty array of plays'}), 400
+    if len(events) > MAX_PLAY_BATCH:
+        return jsonify({'error': 'At most %d plays per batch' % MAX_PLAY_BATCH}), 413
+
+    parsed = []
+    for index, item in enumerate(events):
+        try:
+            parsed.append(parse_play_event(item))
+        except (KeyError, TypeError, ValueError) as e:
+            return jsonify({'error': 'Invalid play at index %d: %s' % (index, e)}), 400
+
+    return enqueue_plays(parsed)
+
+@app.route('/ingest-stats', methods=['GET'])
+def get_ingest_stats():
+    return jsonify(dict(get_play_buffer().stats(), sketches=sketches.get_recorder().stats()))
+
+@app.route('/cache-stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(dict(get_response_cache().stats(), entities=entity_cache.stats(),
+                        images=thumbnails.get_store().stats()))
+
 @app.route('/follows', methods=['POST'])
 def follow_playlist():
     data = request.get_json()
-    conn = get_db_connection()
     try:
-        cur = conn.cursor()
-        cur.execute("INSERT INTO follows (user_id, playlist_id) VALUES (%s, %s)", 
-                   (data['user_id'], data['playlist_id']))
-        conn.commit()
+        run_transaction(feeds.follow(data['user_id'], data['playlist_id']), get_db_connection())
+        invalidate('follows')
         return jsonify({'message': 'Playlist followed'}), 201
+    except (PoolTimeout, QueryCanceled):
+        raise
     except Exception as e:
-        conn.rollback()
         return jsonify({'error': str(e)}), 400
-    finally:
-        cur.close()
-        conn.close()
+
+@app.route('/follows', methods=['DELETE'])
+def unfollow_playlist():
+    data = request.get_json(silent=True) or request.args
+    try:
+        removed = run_transaction(feeds.unfollow(int(data['user_id']), int(data['playlist_id'])),
+                                  get_db_connection())
+    except (PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 400
+    if not removed:
+        return jsonify({'error': 'Follow not found'}), 404
+    invalidate('follows')
+    return jsonify({'message': 'Playlist unfollowed'})
 
 @app.route('/users', methods=['GET'])
 def handle_users():
     if request.method == 'GET':
-        conn = get_db_connection()
+        if 'ids' in request.args:
+            return get_details_batch('users', queries.USER_DETAILS_QUERY, parse_id_list(request.args['ids']),
+                                     queries.user_details_from_row)
+
+        fmt = requested_stream()
+        if fmt:
+            return stream_list(fmt, *queries.users_query(None), queries.user_from_row, connect=get_read_connection)
+
+        paged = wants_pagination(request.args)
+        per_page = page_size(request.args)
+        cursor = request.args.get('cursor')
+        after = decode_cursor(cursor, queries.USER_CURSOR) if cursor else None
+
+        conn = get_read_connection()
         try:
             cur = conn.cursor()
-            cur.execute("SELECT id, username, email, profile_image, created_at FROM users")
-            rows = cur.fetchall()
-            users = []
-            for row in rows:
-                users.append({
-                    'id': row[0],
-                    'username': row[1],
-                    'email': row[2],
-                    'profile_image': row[3],
-                    'created_at': row[4].isoformat() if row[4] else None
-                })
-            return jsonify(users)
+            cur.execute(*queries.users_query(after, per_page + 1 if paged else None))
+
+            rows, next_cursor = cur.fetchall(), None
+            if paged:
+                rows, next_cursor = split_page(rows, per_page, queries.user_cursor_key)
+            users = [queries.user_from_row(row) for row in rows]
+            return with_next_cursor(jsonify(users), next_cursor)
+        except QueryCanceled:
+            raise
         except Exception as e:
             return jsonify({'error': str(e)}), 500
         finally:
             cur.close()
             conn.close()
 
+def fetch_details(kind, query, ids, from_row, fresh_counts=False):
+    # Song and playlist details answer conditional GETs, so they are read
+    # from the primary like their version queries.
+    connect = get_read_connection if kind == 'users' else get_db_connection
+    if entity_cache.ENABLED:
+        # Connects only if some record is missing or expired.
+        return entity_cache.run_sync(entity_cache.DETAILS[kind](ids, fresh_counts), connect)
+    conn = connect()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query, (ids,))
+            return queries.details_in_order(cur.fetchall(), ids, from_row)
+    finally:
+        conn.close()
+
+def get_details(kind, query, entity_id, from_row, not_found, fresh_counts=False):
+    try:
+        details = fetch_details(kind, query, [entity_id], from_row, fresh_counts)
+        if not details:
+            return jsonify({'error': not_found}), 404
+        return jsonify(details[0])
+    except (PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+def get_details_batch(kind, query, ids, from_row):
+    try:
+        return jsonify(fetch_details(kind, query, ids, from_row))
+    except (PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/songs/<int:song_id>', methods=['GET'])
+@conditional_response('song', queries.SONG_VERSION_QUERY, ('song_id',))
 def get_song_details(song_id):
-    conn = get_db_connection()
+    return get_details('songs', queries.SONG_DETAILS_QUERY, song_id, queries.song_details_from_row,
+                       'Song not found', fresh_counts=True)
+
+@app.route('/playlists/<int:playlist_id>', methods=['GET'])
+@conditional_response('playlist', queries.PLAYLIST_VERSION_QUERY, ('playlist_id',))
+def get_playlist_details(playlist_id):
+    return get_details('playlists', queries.PLAYLIST_DETAILS_QUERY, playlist_id, queries.playlist_details_from_row,
+                       'Playlist not found', fresh_counts=True)
+
+@app.route('/users/<int:user_id>', methods=['GET'])
+def get_user_details(user_id):
+    return get_details('users', queries.USER_DETAILS_QUERY, user_id, queries.user_details_from_row,
+                       'User not found')
+
+@app.route('/users/<int:user_id>/rank', methods=['GET'])
+@cached_response('user-rank', ttl=30, tags=('plays',))
+def get_user_rank(user_id):
+    conn = get_read_connection()
     try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT s.id, s.title, s.artist_id, s.duration, s.album_cover, 
-                   a.name as artist_name, a.country, a.profile_image as artist_image
-            FROM songs s 
-            JOIN artists a ON s.artist_id = a.id 
-            WHERE s.id = %s
-        """, (song_id,))
-        
-        song_row = cur.fetchone()
-        if not song_row:
-            return jsonify({'error': 'Song not found'}), 404
-            
-        cur.execute("""
-            SELECT COUNT(*) as play_count
-            FROM plays p
-            WHERE p.song_id = %s
-        """, (song_id,))
-        
-        play_count = cur.fetchone()[0]
-        
-        song_details = {
-            'id': song_row[0],
-            'title': song_row[1],
-            'artist_id': song_row[2],
-            'duration': song_row[3],
-            'album_cover': song_row[4],
-            'artist_name': song_row[5],
-            'artist_country': song_row[6],
-            'artist_image': song_row[7],
-            'play_count': play_count
-        }
-        
-        return jsonify(song_details)
+        with conn.cursor() as cur:
+            cur.execute(queries.USER_RANK_QUERY, (user_id,))
+            row = cur.fetchone()
+
+        if not row:
+            return jsonify({'error': 'User not found'}), 404
+        return jsonify(queries.user_rank_from_row(row))
+    except QueryCanceled:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
-        cur.close()
         conn.close()
 
-@app.route('/playlists/<int:playlist_id>', methods=['GET'])
-def get_playlist_details(playlist_id):
-    conn = get_db_connection()
+@app.route('/users/<int:user_id>/feed', methods=['GET'])
+def get_user_feed(user_id):
+    # Newest first, paged on the addition id.
+    per_page = page_size(request.args)
+    cursor = request.args.get('cursor')
+    after = decode_cursor(cursor, feeds.FEED_CURSOR) if cursor else None
     try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT p.id, p.name, p.is_curated, p.created_by, p.created_at, p.cover,
-                   u.username as creator_username, u.profile_image as creator_image
-            FROM playlists p
-            LEFT JOIN users u ON p.created_by = u.id
-            WHERE p.id = %s
-        """, (playlist_id,))
-        
-        playlist_row = cur.fetchone()
-        if not playlist_row:
-            return jsonify({'error': 'Playlist not found'}), 404
-            
-        cur.execute("""
-            SELECT s.id, s.title, s.duration, s.album_cover, a.name as artist_name
-            FROM playlist_songs ps
-            JOIN songs s ON ps.song_id = s.id
-            JOIN artists a ON s.artist_id = a.id
-            WHERE ps.playlist_id = %s
-            ORDER BY s.title
-        """, (playlist_id,))
-        
-        songs = []
-        for song_row in cur.fetchall():
-            songs.append({
-                'id': song_row[0],
-                'title': song_row[1],
-                'duration': song_row[2],
-                'album_cover': song_row[3],
-                'artist_name': song_row[4]
-            })
-            
-        cur.execute("""
-            SELECT COUNT(pl.id) as total_plays
-            FROM playlist_songs ps
-            LEFT JOIN plays pl ON ps.song_id = pl.song_id
-            WHERE ps.playlist_id = %s
-        """, (playlist_id,))
-        
-        total_plays = cur.fetchone()[0] or 0
-        
-        playlist_details = {
-            'id': playlist_row[0],
-            'name': playlist_row[1],
-            'is_curated': playlist_row[2],
-            'created_by': playlist_row[3],
-            'created_at': playlist_row[4].isoformat() if playlist_row[4] else None,
-            'cover': playlist_row[5],
-            'creator_username': playlist_row[6],
-            'creator_image': playlist_row[7],
-            'songs': songs,
-            'song_count': len(songs),
-            'total_plays': total_plays
-        }
-        
-        return jsonify(playlist_details)
+        rows = entity_cache.run_sync(feeds.feed(user_id, after[0] if after else None, per_page + 1),
+                                     get_read_connection)
+        if rows is None:
+            return jsonify({'error': 'User not found'}), 404
+        rows, next_cursor = split_page(rows, per_page, feeds.feed_cursor_key)
+        return with_next_cursor(jsonify([feeds.feed_item_from_row(row) for row in rows]), next_cursor)
+    except (PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/users/<int:user_id>/recommendations', methods=['GET'])
+@cached_response('recommendations', ttl=300, tags=('recommendations',))
+def get_user_recommendations(user_id):
+    query, params = recommendations_query(user_id, request.args)
+    conn = get_read_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            results = queries.rows_as_dicts(cur.description, cur.fetchall())
+
+        return jsonify(results)
+    except QueryCanceled:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
-        cur.close()
         conn.close()
 
-@app.route('/users/<int:user_id>', methods=['GET'])
-def get_user_details(user_id):
-    conn = get_db_connection()
+@app.route('/songs/<int:song_id>/similar', methods=['GET'])
+@cached_response('similar-songs', ttl=300, tags=('recommendations',))
+def get_similar_songs(song_id):
+    query, params = similar_songs_query(song_id, request.args)
+    conn = get_read_connection()
     try:
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT id, username, email, profile_image, created_at
-            FROM users
-            WHERE id = %s
-        """, (user_id,))
-        
-        user_row = cur.fetchone()
-        if not user_row:
-            return jsonify({'error': 'User not found'}), 404
-            
-        cur.execute("""
-            SELECT id, name, cover, created_at
-            FROM playlists
-            WHERE created_by = %s
-            ORDER BY created_at DESC
-        """, (user_id,))
-        
-        playlists = []
-        for playlist_row in cur.fetchall():
-            playlists.append({
-                'id': playlist_row[0],
-                'name': playlist_row[1],
-                'cover': playlist_row[2],
-                'created_at': playlist_row[3].isoformat() if playlist_row[3] else None
-            })
-            
-        cur.execute("""
-            SELECT COALESCE(SUM(s.duration), 0) as total_playtime
-            FROM plays p
-            JOIN songs s ON p.song_id = s.id
-            WHERE p.user_id = %s
-        """, (user_id,))
-        
-        total_playtime = cur.fetchone()[0]
-        
-        cur.execute("""
-            SELECT s.id, s.title, a.name as artist_name, COUNT(*) as play_count
-            FROM plays p
-            JOIN songs s ON p.song_id = s.id
-            JOIN artists a ON s.artist_id = a.id
-            WHERE p.user_id = %s
-            GROUP BY s.id, s.title, a.name
-            ORDER BY play_count DESC
-            LIMIT 5
-        """, (user_id,))
-        
-        top_songs = []
-        for song_row in cur.fetchall():
-            top_songs.append({
-                'id': song_row[0],
-                'title': song_row[1],
-                'artist_name': song_row[2],
-                'play_count': song_row[3]
-            })
-        
-        user_details = {
-            'id': user_row[0],
-            'username': user_row[1],
-            'email': user_row[2],
-            'profile_image': user_row[3],
-            'created_at': user_row[4].isoformat() if user_row[4] else None,
-            'playlists': playlists,
-            'playlist_count': len(playlists),
-            'total_playtime': total_playtime,
-            'top_songs': top_songs
-        }
-        
-        return jsonify(user_details)
+        with conn.cursor() as cur:
+            cur.execute(query, params)
+            results = queries.rows_as_dicts(cur.description, cur.fetchall())
+
+        return jsonify(results)
+    except QueryCanceled:
+        raise
     except Exception as e:
         return jsonify({'error': str(e)}), 500
     finally:
-        cur.close()
         conn.close()
 
+def listener_stats(kind, entity_id, not_found):
+    try:
+        stats = entity_cache.run_sync(sketches.listener_stats(kind, entity_id, request.args), get_read_connection)
+        if stats is None:
+            return jsonify({'error': not_found}), 404
+        return jsonify(stats)
+    except (PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/songs/<int:song_id>/stats', methods=['GET'])
+@cached_response('song-stats', ttl=60)
+def get_song_stats(song_id):
+    return listener_stats('songs', song_id, 'Song not found')
+
+@app.route('/playlists/<int:playlist_id>/stats', methods=['GET'])
+@cached_response('playlist-stats', ttl=60)
+def get_playlist_stats(playlist_id):
+    return listener_stats('playlists', playlist_id, 'Playlist not found')
+
+@app.route('/trending', methods=['GET'])
+@cached_response('trending', ttl=30)
+def get_trending():
+    try:
+        return jsonify(entity_cache.run_sync(sketches.trending(request.args), get_read_connection))
+    except (PoolTimeout, QueryCanceled):
+        raise
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+@app.route('/images/<kind>/<int:entity_id>', methods=['GET'])
+def get_image(kind, entity_id):
+    size = thumbnails.parse_size(request.args)
+    url = entity_cache.run_sync(thumbnails.image_url_lookup(kind, entity_id), get_read_connection)
+    path, digest = thumbnails.thumbnail(url, size)
+    # send_from_directory hands the open file to the server's
+    # wsgi.file_wrapper (sendfile under gunicorn).
+    return send_from_directory(path.parent, path.name, mimetype=thumbnails.MIMETYPE,
+                               max_age=thumbnails.IMAGE_MAX_AGE, etag=thumbnails.etag_token(digest, size))
+
 if __name__ == '__main__':
     app.run(debug=True)
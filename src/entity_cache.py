@@ -0,0 +1,339 @@
+import logging
+import os
+import threading
+import time
+from array import array
+from collections import OrderedDict
+
+import queries
+
+# In-process cache of the mostly-immutable rows behind the detail endpoints
+# (songs, artists, users, playlists and their track lists). Records are
+# slotted objects; each kind is bounded, evicts in LRU order and admits a new
+# entry only if a TinyLFU frequency sketch says it is requested more often
+# than the entry it would push out, so one-off lookups cannot flush the
+# popular set. Counters that move with every play (play counts, a user's
+# playtime and top songs) are kept separately for ENTITY_VOLATILE_TTL seconds.
+#
+# Invalidation is write-through but per process, like the memory response
+# cache: records also expire after ENTITY_CACHE_TTL seconds, which bounds how
+# long another worker can serve a record changed elsewhere.
+ENTITY_CACHE_SIZE = int(os.getenv("ENTITY_CACHE_SIZE", 50000))
+ENTITY_CACHE_TTL = float(os.getenv("ENTITY_CACHE_TTL", 300))
+ENTITY_VOLATILE_TTL = float(os.getenv("ENTITY_VOLATILE_TTL", 5))
+ENTITY_CACHE_WARM = int(os.getenv("ENTITY_CACHE_WARM", 5000))
+ENABLED = ENTITY_CACHE_SIZE > 0
+
+log = logging.getLogger('entity_cache')
+
+SKETCH_DEPTH = 4
+SKETCH_SEEDS = (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F, 0x165667B19E3779F9, 0x27D4EB2F165667C5)
+
+
+class Record:
+    __slots__ = ('expires_at',)
+
+    def __init__(self, row, expires_at):
+        for name, value in zip(self.__slots__, row):
+            setattr(self, name, value)
+        self.expires_at = expires_at
+
+
+class Song(Record):
+    __slots__ = ('id', 'title', 'artist_id', 'duration', 'album_cover')
+
+
+class Artist(Record):
+    __slots__ = ('id', 'name', 'country', 'profile_image')
+
+
+class User(Record):
+    __slots__ = ('id', 'username', 'email', 'profile_image', 'created_at')
+
+
+class Playlist(Record):
+    __slots__ = ('id', 'name', 'is_curated', 'created_by', 'created_at', 'cover', 'song_ids')
+
+
+class Volatile(Record):
+    __slots__ = ('id', 'value')
+
+
+class FrequencySketch:
+    # Count-min sketch of recent access frequency (TinyLFU). Counters are
+    # halved every `sample_size` increments so old popularity fades out.
+    def __init__(self, capacity):
+        width = 64
+        while width < capacity * 4:
+            width *= 2
+        self.mask = width - 1
+        self.rows = [array('H', bytes(2 * width)) for _ in range(SKETCH_DEPTH)]
+        self.sample_size = max(capacity * 10, 100)
+        self.additions = 0
+
+    def _slots(self, key):
+        h = hash(key)
+        return [((h ^ seed) * 0x9E3779B1 >> 16) & self.mask for seed in SKETCH_SEEDS]
+
+    def increment(self, key):
+        for row, slot in zip(self.rows, self._slots(key)):
+            if row[slot] < 0xFFFF:
+                row[slot] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.rows = [array('H', map((1).__rrshift__, row)) for row in self.rows]
+            self.additions //= 2
+
+    def estimate(self, key):
+        return min(row[slot] for row, slot in zip(self.rows, self._slots(key)))
+
+
+class EntityCache:
+    def __init__(self, name, max_entries):
+        self.name = name
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._sketch = FrequencySketch(max_entries)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'rejections': 0, 'invalidations': 0}
+
+    def get_many(self, keys, now):
+        found = {}
+        with self._lock:
+            for key in keys:
+                self._sketch.increment(key)
+                record = self._entries.get(key)
+                if record is None or record.expires_at <= now:
+                    self._stats['misses'] += 1
+                    continue
+                self._entries.move_to_end(key)
+                self._stats['hits'] += 1
+                found[key] = record
+        return found
+
+    def put(self, key, record, admit=True):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = record
+                self._entries.move_to_end(key)
+                return
+            if len(self._entries) >= self.max_entries:
+                victim = next(iter(self._entries))
+                if admit and self._sketch.estimate(key) <= self._sketch.estimate(victim):
+                    self._stats['rejections'] += 1
+                    return
+                del self._entries[victim]
+                self._stats['evictions'] += 1
+            self._entries[key] = record
+
+    def invalidate(self, keys):
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, entries=len(self._entries), max_entries=self.max_entries)
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
+
+
+# kind -> (record class, lookup query by id array, ttl)
+KINDS = {
+    'songs': (Song, queries.SONG_RECORDS_QUERY, ENTITY_CACHE_TTL),
+    'artists': (Artist, queries.ARTIST_RECORDS_QUERY, ENTITY_CACHE_TTL),
+    'users': (User, queries.USER_RECORDS_QUERY, ENTITY_CACHE_TTL),
+    'playlists': (Playlist, queries.PLAYLIST_RECORDS_QUERY, ENTITY_CACHE_TTL),
+    'song_plays': (Volatile, queries.SONG_COUNTS_QUERY, ENTITY_VOLATILE_TTL),
+    'playlist_plays': (Volatile, queries.PLAYLIST_COUNTS_QUERY, ENTITY_VOLATILE_TTL),
+    'user_activity': (Volatile, queries.USER_ACTIVITY_QUERY, ENTITY_VOLATILE_TTL)
+}
+
+caches = {kind: EntityCache(kind, ENTITY_CACHE_SIZE) for kind in KINDS}
+
+
+def invalidate(kind, ids):
+    caches[kind].invalidate(ids)
+
+
+def stats():
+    return {kind: cache.stats() for kind, cache in caches.items()}
+
+
+def make_record(kind, row, now):
+    record_class, _, ttl = KINDS[kind]
+    if record_class is Volatile:
+        return Volatile((row[0], row[1] if len(row) == 2 else tuple(row[1:])), now + ttl)
+    return record_class(row, now + ttl)
+
+
+# The loaders below are generators that yield (query, params) and are sent
+# the fetched rows back, so the same lookup logic runs on psycopg2 cursors
+# (run_sync) and on the async pool (asgi_app.run_lookup).
+def load(kind, ids, admit=True, fresh=False):
+    # `fresh` reads every id from the database (and refreshes the cache).
+    now = time.monotonic()
+    wanted = list(dict.fromkeys(ids))
+    found = {} if fresh else caches[kind].get_many(wanted, now)
+    missing = [key for key in wanted if key not in found]
+    if missing:
+        rows = yield KINDS[kind][1], (missing,)
+        for row in rows:
+            record = make_record(kind, row, now)
+            caches[kind].put(record.id, record, admit)
+            found[record.id] = record
+    return found
+
+
+def load_counts(kind, ids, fresh=False):
+    # Play counters: ids without a rollup row have not been played yet.
+    found = yield from load(kind, ids, fresh=fresh)
+    now = time.monotonic()
+    for key in ids:
+        if key not in found:
+            record = found[key] = Volatile((key, 0), now + ENTITY_VOLATILE_TTL)
+            caches[kind].put(key, record)
+    return {key: record.value for key, record in found.items()}
+
+
+# `fresh_counts` is for the conditional GETs: their ETag includes the
+# current play count, so the body must not show a cached older one.
+def song_details(ids, fresh_counts=False):
+    songs = yield from load('songs', ids)
+    artists = yield from load('artists', [s.artist_id for s in songs.values() if s.artist_id is not None])
+    counts = yield from load_counts('song_plays', list(songs), fresh_counts)
+    details = []
+    for song_id in ids:
+        song = songs.get(song_id)
+        artist = artists.get(song.artist_id) if song else None
+        if artist is None:
+            continue
+        details.append({
+            'id': song.id,
+            'title': song.title,
+            'artist_id': song.artist_id,
+            'duration': song.duration,
+            'album_cover': song.album_cover,
+            'artist_name': artist.name,
+            'artist_country': artist.country,
+            'artist_image': artist.profile_image,
+            'play_count': counts.get(song.id, 0)
+        })
+    return details
+
+
+def playlist_details(ids, fresh_counts=False):
+    playlists = yield from load('playlists', ids)
+    creators = yield from load('users', [p.created_by for p in playlists.values() if p.created_by is not None])
+    songs = yield from load('songs', [song_id for p in playlists.values() for song_id in p.song_ids])
+    artists = yield from load('artists', {s.artist_id for s in songs.values() if s.artist_id is not None})
+    counts = yield from load_counts('playlist_plays', list(playlists), fresh_counts)
+    details = []
+    for playlist_id in ids:
+        playlist = playlists.get(playlist_id)
+        if playlist is None:
+            continue
+        creator = creators.get(playlist.created_by)
+        tracks = []
+        for song_id in playlist.song_ids:
+            song = songs.get(song_id)
+            artist = artists.get(song.artist_id) if song else None
+            if artist is not None:
+                tracks.append({
+                    'id': song.id,
+                    'title': song.title,
+                    'duration': song.duration,
+                    'album_cover': song.album_cover,
+                    'artist_name': artist.name
+                })
+        details.append({
+            'id': playlist.id,
+            'name': playlist.name,
+            'is_curated': playlist.is_curated,
+            'created_by': playlist.created_by,
+            'created_at': playlist.created_at,
+            'cover': playlist.cover,
+            'creator_username': creator.username if creator else None,
+            'creator_image': creator.profile_image if creator else None,
+            'songs': tracks,
+            'song_count': len(tracks),
+            'total_plays': counts.get(playlist.id, 0)
+        })
+    return details
+
+
+def user_details(ids, fresh_counts=False):
+    users = yield from load('users', ids)
+    activity = yield from load('user_activity', list(users), fresh=fresh_counts)
+    details = []
+    for user_id in ids:
+        user = users.get(user_id)
+        if user is None or user_id not in activity:
+            continue
+        playlists, total_playtime, top_songs = activity[user_id].value
+        details.append({
+            'id': user.id,
+            'username': user.username,
+            'email': user.email,
+            'profile_image': user.profile_image,
+            'created_at': user.created_at,
+            'playlists': playlists,
+            'playlist_count': len(playlists),
+            'total_playtime': total_playtime,
+            'top_songs': top_songs
+        })
+    return details
+
+
+DETAILS = {
+    'songs': song_details,
+    'playlists': playlist_details,
+    'users': user_details
+}
+
+
+def warm_up(limit=ENTITY_CACHE_WARM):
+    # Bulk-loads the most played songs and playlists and the most active
+    # users (plus the artists and creators they reference) without going
+    # through admission, so a fresh worker starts with the popular set.
+    loaded = {}
+    artist_ids = set()
+    now = time.monotonic()
+    for kind, query in (('songs', queries.WARM_SONGS_QUERY), ('playlists', queries.WARM_PLAYLISTS_QUERY),
+                        ('users', queries.WARM_USERS_QUERY)):
+        rows = yield query, (limit,)
+        for row in rows:
+            record = make_record(kind, row, now)
+            caches[kind].put(record.id, record, admit=False)
+            if kind == 'songs' and record.artist_id is not None:
+                artist_ids.add(record.artist_id)
+        loaded[kind] = len(rows)
+    artists = yield from load('artists', artist_ids, admit=False)
+    loaded['artists'] = len(artists)
+    return loaded
+
+
+def run_sync(lookup, connect):
+    # Drives a loader generator on psycopg2. `connect` is only called when
+    # the cache cannot answer on its own.
+    conn = None
+    try:
+        query, params = next(lookup)
+        conn = connect()
+        with conn.cursor() as cur:
+            while True:
+                cur.execute(query, params)
+                query, params = lookup.send(cur.fetchall())
+    except StopIteration as done:
+        return done.value
+    finally:
+        if conn is not None:
+            conn.close()
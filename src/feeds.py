@@ -0,0 +1,213 @@
+import os
+import sys
+
+import entity_cache
+from db_pool import get_connection
+
+# "What's new in the playlists I follow". Every song added to a playlist is
+# logged once in playlist_additions, and each user's feed is the ids of the
+# newest additions from the playlists they follow:
+#
+#   fan-out on write  a playlist with fewer than FEED_FANOUT_MAX_FOLLOWERS
+#                     followers prepends the new addition ids to each
+#                     follower's user_feeds row, in the transaction that
+#                     adds the songs. The array is cut to FEED_LENGTH ids in
+#                     the same statement, so a timeline never grows past it.
+#   fan-out on read   bigger playlists are not pushed; a feed read merges in
+#                     the newest additions of the big playlists the user
+#                     follows, one index range scan each.
+#
+# Reads pull from playlists with at least half the push limit, so a playlist
+# hovering around the limit appears through both paths (ids are merged, not
+# duplicated) rather than through neither. Follower counts are kept in
+# playlist_follower_counts by follow and unfollow, not counted per write.
+FEED_LENGTH = int(os.getenv("FEED_LENGTH", 500))
+FANOUT_MAX_FOLLOWERS = int(os.getenv("FEED_FANOUT_MAX_FOLLOWERS", 10000))
+PULL_MIN_FOLLOWERS = max(1, FANOUT_MAX_FOLLOWERS // 2)
+# Recent additions of a playlist copied into a new follower's feed.
+FOLLOW_BACKFILL = int(os.getenv("FEED_FOLLOW_BACKFILL", 20))
+RETENTION_DAYS = int(os.getenv("FEED_RETENTION_DAYS", 90))
+
+RECORD_ADDITIONS_QUERY = """
+    INSERT INTO playlist_additions (playlist_id, song_id)
+    SELECT %s, song_id FROM unnest(%s::integer[]) WITH ORDINALITY AS v(song_id, n)
+    ORDER BY n
+    RETURNING id
+"""
+
+# Followers are upserted in user_id order, so concurrent fan-outs lock
+# their rows in the same order.
+FAN_OUT_QUERY = """
+    WITH pushed AS (
+        INSERT INTO user_feeds (user_id, addition_ids)
+        SELECT f.user_id, %(ids)s::bigint[]
+        FROM follows f
+        WHERE f.playlist_id = %(playlist_id)s
+          AND COALESCE((
+              SELECT follower_count FROM playlist_follower_counts WHERE playlist_id = %(playlist_id)s
+          ), 0) < %(max_followers)s
+        ORDER BY f.user_id
+        ON CONFLICT (user_id) DO UPDATE
+        SET addition_ids = (EXCLUDED.addition_ids || user_feeds.addition_ids)[1:%(length)s],
+            updated_at = now()
+        RETURNING 1
+    )
+    SELECT COUNT(*) FROM pushed
+"""
+
+INSERT_FOLLOW_QUERY = """
+    INSERT INTO follows (user_id, playlist_id) VALUES (%s, %s)
+    RETURNING playlist_id
+"""
+
+DELETE_FOLLOW_QUERY = """
+    DELETE FROM follows WHERE user_id = %s AND playlist_id = %s
+    RETURNING playlist_id
+"""
+
+ADJUST_FOLLOWERS_QUERY = """
+    INSERT INTO playlist_follower_counts (playlist_id, follower_count) VALUES (%s, %s)
+    ON CONFLICT (playlist_id) DO UPDATE
+    SET follower_count = playlist_follower_counts.follower_count + EXCLUDED.follower_count
+    RETURNING follower_count
+"""
+
+ENSURE_FEED_QUERY = """
+    INSERT INTO user_feeds (user_id) VALUES (%s)
+    ON CONFLICT (user_id) DO NOTHING
+    RETURNING user_id
+"""
+
+# Merged against the row as locked, so a concurrent fan-out is not lost.
+BACKFILL_QUERY = """
+    UPDATE user_feeds u SET addition_ids = (
+        SELECT COALESCE(array_agg(id ORDER BY id DESC), '{}')
+        FROM (
+            SELECT unnest(u.addition_ids) as id
+            UNION
+            SELECT id FROM (
+                SELECT id FROM playlist_additions WHERE playlist_id = %s ORDER BY id DESC LIMIT %s
+            ) recent
+        ) m
+    )[1:%s], updated_at = now()
+    WHERE u.user_id = %s
+    RETURNING u.user_id
+"""
+
+# The newest `limit` items older than `before`: the user's timeline, filtered
+# to playlists they still follow, merged with the pulled big playlists.
+FEED_QUERY = """
+    WITH timeline AS (
+        SELECT a.id
+        FROM user_feeds u
+        CROSS JOIN LATERAL unnest(u.addition_ids) AS t(id)
+        JOIN playlist_additions a ON a.id = t.id
+        JOIN follows f ON f.user_id = u.user_id AND f.playlist_id = a.playlist_id
+        WHERE u.user_id = %(user_id)s AND t.id < %(before)s
+    ), pulled AS (
+        SELECT a.id
+        FROM follows f
+        JOIN playlist_follower_counts c ON c.playlist_id = f.playlist_id AND c.follower_count >= %(pull_min)s
+        CROSS JOIN LATERAL (
+            SELECT id FROM playlist_additions
+            WHERE playlist_id = f.playlist_id AND id < %(before)s
+            ORDER BY id DESC
+            LIMIT %(limit)s
+        ) a
+        WHERE f.user_id = %(user_id)s
+    ), page AS (
+        SELECT id FROM timeline
+        UNION
+        SELECT id FROM pulled
+        ORDER BY id DESC
+        LIMIT %(limit)s
+    )
+    SELECT a.id, a.added_at, p.id, p.name, p.cover, s.id, s.title, s.duration, s.album_cover, ar.name
+    FROM page
+    JOIN playlist_additions a ON a.id = page.id
+    JOIN playlists p ON p.id = a.playlist_id
+    JOIN songs s ON s.id = a.song_id
+    LEFT JOIN artists ar ON ar.id = s.artist_id
+    ORDER BY a.id DESC
+"""
+
+NO_CURSOR = 2 ** 63 - 1
+
+
+def publish(playlist_id, song_ids):
+    # Called by playlists.add_songs in the transaction that added the songs.
+    if not song_ids:
+        return 0
+    rows = yield RECORD_ADDITIONS_QUERY, (playlist_id, song_ids)
+    newest_first = sorted((row[0] for row in rows), reverse=True)[:FEED_LENGTH]
+    pushed = yield FAN_OUT_QUERY, {'playlist_id': playlist_id, 'ids': newest_first,
+                                   'max_followers': FANOUT_MAX_FOLLOWERS, 'length': FEED_LENGTH}
+    return pushed[0][0]
+
+
+def follow(user_id, playlist_id):
+    yield INSERT_FOLLOW_QUERY, (user_id, playlist_id)
+    yield ADJUST_FOLLOWERS_QUERY, (playlist_id, 1)
+    if FOLLOW_BACKFILL > 0:
+        yield ENSURE_FEED_QUERY, (user_id,)
+        yield BACKFILL_QUERY, (playlist_id, FOLLOW_BACKFILL, FEED_LENGTH, user_id)
+
+
+def unfollow(user_id, playlist_id):
+    # Items of the playlist stay in the timeline but are filtered out on read.
+    rows = yield DELETE_FOLLOW_QUERY, (user_id, playlist_id)
+    if not rows:
+        return False
+    yield ADJUST_FOLLOWERS_QUERY, (playlist_id, -1)
+    return True
+
+
+def feed(user_id, before, limit):
+    # entity_cache loader: a page of the user's feed, or None for an
+    # unknown user.
+    users = yield from entity_cache.load('users', [user_id])
+    if user_id not in users:
+        return None
+    rows = yield FEED_QUERY, {'user_id': user_id, 'before': before or NO_CURSOR, 'limit': limit,
+                              'pull_min': PULL_MIN_FOLLOWERS}
+    return rows
+
+
+FEED_CURSOR = (int,)
+
+
+def feed_cursor_key(row):
+    return (row[0],)
+
+
+def feed_item_from_row(row):
+    return {
+        'id': row[0],
+        'added_at': row[1],
+        'playlist': {'id': row[2], 'name': row[3], 'cover': row[4]},
+        'song': {
+            'id': row[5],
+            'title': row[6],
+            'duration': row[7],
+            'album_cover': row[8],
+            'artist_name': row[9]
+        }
+    }
+
+
+def prune(conn):
+    # Timelines may still hold the ids; the feed query skips them.
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM playlist_additions WHERE added_at <= LOCALTIMESTAMP - %s * INTERVAL '1 day'",
+                    (RETENTION_DAYS,))
+    conn.commit()
+
+
+if __name__ == '__main__':
+    # Run daily from cron, next to `python charts.py prune`.
+    if sys.argv[1:] not in ([], ['prune']):
+        sys.exit("usage: python feeds.py [prune]")
+    print("Pruning playlist additions older than %dd..." % RETENTION_DAYS)
+    with get_connection() as conn:
+        prune(conn)
+    print("Playlist additions pruned!")
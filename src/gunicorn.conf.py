@@ -0,0 +1,19 @@
+import multiprocessing
+import os
+
+# Production launcher for either serving mode:
+#   gunicorn -c gunicorn.conf.py asgi_app:app      (asyncio, one event loop per worker)
+#   gunicorn -c gunicorn.conf.py db_requests:app   (set WORKER_CLASS=gthread)
+# Each worker process owns its own connection pool, so the database sees up
+# to workers * DB_POOL_MAX connections.
+
+bind = os.getenv("BIND", "0.0.0.0:5000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+worker_class = os.getenv("WORKER_CLASS", "uvicorn_worker.UvicornWorker")
+threads = int(os.getenv("WORKER_THREADS", 8))
+timeout = int(os.getenv("WORKER_TIMEOUT", 30))
+graceful_timeout = int(os.getenv("WORKER_GRACEFUL_TIMEOUT", 30))
+keepalive = 5
+max_requests = int(os.getenv("WORKER_MAX_REQUESTS", 10000))
+max_requests_jitter = max_requests // 10
+accesslog = "-"
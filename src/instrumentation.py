@@ -0,0 +1,334 @@
+import logging
+import os
+import re
+import threading
+import time
+from contextvars import ContextVar
+
+import psycopg2.extensions
+
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", 200))
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "true").lower() == "true"
+SERVER_TIMING = os.getenv("SERVER_TIMING", "true").lower() == "true"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Plain EXPLAIN never executes the statement, but it only accepts DML.
+EXPLAINABLE_RE = re.compile(r'^\s*(SELECT|WITH|INSERT|UPDATE|DELETE)\b', re.IGNORECASE)
+
+log = logging.getLogger('slow_queries')
+
+
+class RequestTimings:
+    # Everything one request spent, filled in by the cursor and pool hooks
+    # below through a context variable (per thread under Flask, per task
+    # under asyncio).
+    __slots__ = ('started', 'queries', 'query_time', 'rows', 'checkout_time', 'connects',
+                 'connect_time', 'serialize_time')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.query_time = 0.0
+        self.rows = 0
+        self.checkout_time = 0.0
+        self.connects = 0
+        self.connect_time = 0.0
+        self.serialize_time = 0.0
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def server_timing(self):
+        parts = [
+            'db;dur=%.2f;desc="%d queries, %d rows"' % (self.query_time * 1000, self.queries, self.rows),
+            'pool;dur=%.2f' % (self.checkout_time * 1000)
+        ]
+        if self.connects:
+            parts.append('connect;dur=%.2f' % (self.connect_time * 1000))
+        parts.append('json;dur=%.2f' % (self.serialize_time * 1000))
+        parts.append('total;dur=%.2f' % (self.elapsed() * 1000))
+        return ', '.join(parts)
+
+
+_current = ContextVar('request_timings', default=None)
+
+
+class Metrics:
+    # Minimal Prometheus registry: counters and histograms keyed by
+    # (name, labels). Values are per process, like the pool and cache stats.
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, labels=(), value=1):
+        key = (name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[i] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def render(self, gauges=()):
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+
+        lines = []
+        described = set()
+
+        def header(name, kind):
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP %s %s' % (name, self._help.get(name, (kind, name))[1]))
+                lines.append('# TYPE %s %s' % (name, kind))
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+        for (name, labels), hist in histograms:
+            header(name, 'histogram')
+            for bound, count in zip(self.buckets, hist):
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', repr(bound)),)), count))
+            lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', '+Inf'),)), hist[-1]))
+            lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(hist[-2])))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), hist[-1]))
+        for name, labels, value in gauges:
+            header(name, 'gauge')
+            lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for k, v in labels)
+    return '{%s}' % ','.join(escaped)
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+metrics = Metrics()
+metrics.describe('http_requests_total', 'counter', 'Requests served, by route, method and status.')
+metrics.describe('http_request_duration_seconds', 'histogram', 'Time to produce a response, by route.')
+metrics.describe('http_request_db_seconds', 'histogram', 'Time spent in database statements per request.')
+metrics.describe('http_request_serialize_seconds', 'histogram', 'Time spent encoding JSON per request.')
+metrics.describe('db_statements_total', 'counter', 'Statements executed, by route ("background" outside requests).')
+metrics.describe('db_rows_total', 'counter', 'Rows returned or affected, by route.')
+metrics.describe('db_statement_duration_seconds', 'histogram', 'Execution time of single statements.')
+metrics.describe('db_slow_statements_total', 'counter', 'Statements slower than SLOW_QUERY_MS.')
+metrics.describe('db_pool_checkout_seconds', 'histogram', 'Time to obtain a pooled connection, including connects.')
+metrics.describe('db_connects_total', 'counter', 'New database connections opened.')
+metrics.describe('db_pool_connections', 'gauge', 'Pooled connections by state.')
+
+
+def record_statement(seconds, rows):
+    rows = max(rows or 0, 0)
+    metrics.observe('db_statement_duration_seconds', seconds)
+    timings = _current.get()
+    if timings is None:
+        metrics.inc('db_statements_total', (('endpoint', 'background'),))
+        metrics.inc('db_rows_total', (('endpoint', 'background'),), rows)
+        return
+    timings.queries += 1
+    timings.query_time += seconds
+    timings.rows += rows
+
+
+def record_checkout(seconds):
+    metrics.observe('db_pool_checkout_seconds', seconds)
+    timings = _current.get()
+    if timings is not None:
+        timings.checkout_time += seconds
+
+
+def record_connect(seconds):
+    metrics.inc('db_connects_total')
+    timings = _current.get()
+    if timings is not None:
+        timings.connects += 1
+        timings.connect_time += seconds
+
+
+def record_serialize(seconds):
+    timings = _current.get()
+    if timings is not None:
+        timings.serialize_time += seconds
+
+
+def is_slow(seconds):
+    return SLOW_QUERY_MS >= 0 and seconds * 1000 >= SLOW_QUERY_MS
+
+
+def statement_text(statement):
+    if isinstance(statement, bytes):
+        statement = statement.decode(errors='replace')
+    return str(statement)
+
+
+def log_slow_statement(statement, seconds, plan=None):
+    metrics.inc('db_slow_statements_total')
+    message = "slow statement (%.1f ms): %s" % (seconds * 1000, ' '.join(statement_text(statement).split())[:2000])
+    if plan:
+        message += "\n" + plan
+    log.warning(message)
+
+
+def explain(conn, statement):
+    # Runs EXPLAIN for a statement that just ran on `conn`. Inside a
+    # transaction it is wrapped in a savepoint, so a failing EXPLAIN cannot
+    # abort the caller's work.
+    statement = statement_text(statement)
+    if not SLOW_QUERY_EXPLAIN or not EXPLAINABLE_RE.match(statement):
+        return None
+    in_transaction = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_INTRANS
+    cur = conn.cursor(cursor_factory=psycopg2.extensions.cursor)
+    try:
+        if in_transaction:
+            cur.execute("SAVEPOINT slow_query_explain")
+        try:
+            cur.execute("EXPLAIN " + statement)
+            plan = '\n'.join(row[0] for row in cur.fetchall())
+        except psycopg2.Error as e:
+            plan = "(EXPLAIN failed: %s)" % str(e).strip()
+        if in_transaction:
+            cur.execute("ROLLBACK TO SAVEPOINT slow_query_explain")
+            cur.execute("RELEASE SAVEPOINT slow_query_explain")
+        return plan
+    except psycopg2.Error:
+        return None
+    finally:
+        cur.close()
+
+
+class InstrumentedCursor(psycopg2.extensions.cursor):
+    # Installed as the pool's cursor_factory, so every statement issued
+    # through db_pool (including execute_values and named cursors) is timed.
+    def _timed(self, method, *args):
+        started = time.perf_counter()
+        try:
+            result = method(*args)
+        except Exception:
+            record_statement(time.perf_counter() - started, 0)
+            raise
+        seconds = time.perf_counter() - started
+        record_statement(seconds, self.rowcount)
+        if is_slow(seconds):
+            plan = explain(self.connection, self.query) if self.name is None and self.query else None
+            log_slow_statement(self.query or args[0], seconds, plan)
+        return result
+
+    def execute(self, query, vars=None):
+        return self._timed(super().execute, query, vars)
+
+    def executemany(self, query, vars_list):
+        return self._timed(super().executemany, query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        return self._timed(super().copy_expert, sql, file, size)
+
+
+def record_request(timings, endpoint, method, status):
+    labels = (('endpoint', endpoint),)
+    metrics.inc('http_requests_total', labels + (('method', method), ('status', str(status))))
+    metrics.observe('http_request_duration_seconds', timings.elapsed(), labels)
+    metrics.observe('http_request_db_seconds', timings.query_time, labels)
+    metrics.observe('http_request_serialize_seconds', timings.serialize_time, labels)
+    metrics.inc('db_statements_total', labels, timings.queries)
+    metrics.inc('db_rows_total', labels, timings.rows)
+
+
+def pool_gauges(stats):
+    gauges = []
+    for name, pool in stats.items():
+        for key in ('size', 'idle', 'in_use', 'max'):
+            if key in pool:
+                gauges.append(('db_pool_connections', (('pool', name), ('state', key)), pool[key]))
+    return gauges
+
+
+def init_app(app):
+    # Flask hooks: per-request timings, Server-Timing header, request metrics
+    # and timed JSON encoding.
+    from flask import g, request
+    from serialization import FastJSONProvider
+
+    class TimedJSONProvider(FastJSONProvider):
+        def encode(self, obj):
+            started = time.perf_counter()
+            try:
+                return super().encode(obj)
+            finally:
+                record_serialize(time.perf_counter() - started)
+
+    app.json = TimedJSONProvider(app)
+
+    @app.before_request
+    def start_timings():
+        g.timings_token = _current.set(RequestTimings())
+
+    @app.after_request
+    def finish_timings(response):
+        timings = _current.get()
+        if timings is not None:
+            endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+            record_request(timings, endpoint, request.method, response.status_code)
+            if SERVER_TIMING:
+                response.headers['Server-Timing'] = timings.server_timing()
+        return response
+
+    @app.teardown_request
+    def clear_timings(exc):
+        token = g.pop('timings_token', None)
+        if token is not None:
+            _current.reset(token)
+
+
+class TimingMiddleware:
+    # ASGI counterpart of init_app. The route template is read from the
+    # scope after routing, so labels match the app's declared paths.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        timings = RequestTimings()
+        token = _current.set(timings)
+        status = [500]
+
+        async def send_with_timing(message):
+            if message['type'] == 'http.response.start':
+                status[0] = message['status']
+                if SERVER_TIMING:
+                    headers = list(message.get('headers', []))
+                    headers.append((b'server-timing', timings.server_timing().encode()))
+                    message = dict(message, headers=headers)
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            route = scope.get('route')
+            record_request(timings, getattr(route, 'path', 'unmatched'), scope['method'], status[0])
+            _current.reset(token)
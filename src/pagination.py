@@ -0,0 +1,102 @@
+import base64
+import json
+import os
+from urllib.parse import urlencode
+
+from flask import request
+
+DEFAULT_PER_PAGE = 20
+MAX_PER_PAGE = int(os.getenv("MAX_PER_PAGE", 100))
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+class InvalidIdList(ValueError):
+    pass
+
+
+def encode_cursor(values):
+    raw = json.dumps(list(values), separators=(',', ':'), default=str).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def cursor_value(value, kind):
+    # `kind` is a type (or tuple of types) the value must already have, or
+    # a function that parses it, such as datetime.fromisoformat.
+    if isinstance(kind, (type, tuple)):
+        if isinstance(value, bool) or not isinstance(value, kind):
+            raise ValueError("expected %s" % kind)
+        if isinstance(value, int) and not -2 ** 63 <= value < 2 ** 63:
+            raise ValueError("out of range")
+        return value
+    return kind(value)
+
+
+def decode_cursor(token, types):
+    # `types` has one entry per cursor value (see cursor_value); a cursor
+    # that does not match them never reaches the query.
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw)
+        if not isinstance(values, list) or len(values) != len(types):
+            raise ValueError("wrong length")
+        return [cursor_value(value, kind) for value, kind in zip(values, types)]
+    except (TypeError, ValueError):
+        raise InvalidCursor("Invalid cursor")
+
+
+def parse_id_list(value):
+    try:
+        ids = [int(part) for part in value.split(',') if part.strip()]
+    except ValueError:
+        raise InvalidIdList("ids must be a comma-separated list of integers")
+    if not ids:
+        raise InvalidIdList("ids must not be empty")
+    if len(ids) > MAX_PER_PAGE:
+        raise InvalidIdList("At most %d ids per request" % MAX_PER_PAGE)
+    return list(dict.fromkeys(ids))
+
+
+def int_arg(args, name, default):
+    try:
+        return int(args.get(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def page_size(args, default=DEFAULT_PER_PAGE):
+    return max(1, min(int_arg(args, 'per_page', default), MAX_PER_PAGE))
+
+
+def wants_pagination(args):
+    return 'per_page' in args or 'cursor' in args
+
+
+def split_page(rows, per_page, key):
+    # Callers fetch `per_page + 1` rows; the extra row only signals that
+    # another page exists and is never returned.
+    if len(rows) <= per_page:
+        return rows, None
+    rows = rows[:per_page]
+    return rows, encode_cursor(key(rows[-1]))
+
+
+def next_cursor_headers(base_url, args, next_cursor):
+    # The body stays a plain JSON array for existing clients; the cursor
+    # for the following page travels in headers.
+    if not next_cursor:
+        return {}
+    args = dict(args)
+    args['cursor'] = next_cursor
+    args.pop('page', None)
+    return {
+        'X-Next-Cursor': next_cursor,
+        'Link': '<%s?%s>; rel="next"' % (base_url, urlencode(args))
+    }
+
+
+def with_next_cursor(response, next_cursor):
+    response.headers.update(next_cursor_headers(request.base_url, request.args.to_dict(), next_cursor))
+    return response
@@ -0,0 +1,129 @@
+import argparse
+import os
+import re
+from datetime import date
+
+import psycopg2
+
+from db_pool import get_connection
+
+# Monthly partitions of `plays` (see schema.sql). Run `python partitions.py`
+# daily from cron: it creates the coming months' partitions before any play
+# lands in them and, when a retention is configured, detaches expired months
+# and moves them to the archive schema (or drops them).
+PARTITIONS_AHEAD = int(os.getenv("PLAYS_PARTITIONS_AHEAD", 3))
+RETENTION_MONTHS = int(os.getenv("PLAYS_RETENTION_MONTHS", 0))
+ARCHIVE_SCHEMA = os.getenv("PLAYS_ARCHIVE_SCHEMA", "archive")
+
+PARTITION_RE = re.compile(r'^plays_(\d{4})_(\d{2})$')
+
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def add_months(day, months):
+    index = day.year * 12 + day.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def list_partitions(conn):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = 'plays'::regclass
+            ORDER BY c.relname
+        """)
+        return [row[0] for row in cur.fetchall()]
+
+
+def partition_month(name):
+    match = PARTITION_RE.match(name)
+    return date(int(match.group(1)), int(match.group(2)), 1) if match else None
+
+
+def ensure_partitions(conn, start=None, months_ahead=PARTITIONS_AHEAD):
+    # Creates one partition per month from `start` (default: this month)
+    # through `months_ahead` months from now; existing ones are left alone.
+    today = date.today()
+    month = month_start(start or today)
+    last = add_months(month_start(today), months_ahead)
+    created = []
+    existing = set(list_partitions(conn))
+    with conn.cursor() as cur:
+        while month <= last:
+            name = 'plays_%04d_%02d' % (month.year, month.month)
+            if name not in existing:
+                # create_plays_partition moves the month's rows out of
+                # plays_default; should that still fail, the month is
+                # skipped so the following ones are created anyway.
+                cur.execute("SAVEPOINT create_partition")
+                try:
+                    cur.execute("SELECT create_plays_partition(%s)", (month,))
+                except psycopg2.Error as e:
+                    cur.execute("ROLLBACK TO SAVEPOINT create_partition")
+                    print("Warning: could not create %s (%d plays for that month in plays_default): %s"
+                          % (name, month_default_rows(cur, month), str(e).strip()))
+                else:
+                    created.append(name)
+                cur.execute("RELEASE SAVEPOINT create_partition")
+            month = add_months(month, 1)
+    conn.commit()
+    return created
+
+
+def month_default_rows(cur, month):
+    cur.execute("SELECT COUNT(*) FROM plays_default WHERE played_at >= %s AND played_at < %s",
+                (month, add_months(month, 1)))
+    return cur.fetchone()[0]
+
+
+def detach_expired_partitions(conn, retention_months=RETENTION_MONTHS, drop=False):
+    # Partitions whose whole month is older than the retention are detached;
+    # detached data no longer shows up in queries on `plays`, while the
+    # rollup tables keep the counts it contributed.
+    if retention_months <= 0:
+        return []
+    cutoff = add_months(month_start(date.today()), -retention_months)
+    expired = [name for name in list_partitions(conn)
+               if partition_month(name) is not None and partition_month(name) < cutoff]
+    with conn.cursor() as cur:
+        if expired and not drop:
+            cur.execute('CREATE SCHEMA IF NOT EXISTS "%s"' % ARCHIVE_SCHEMA)
+        for name in expired:
+            cur.execute('ALTER TABLE plays DETACH PARTITION "%s"' % name)
+            if drop:
+                cur.execute('DROP TABLE "%s"' % name)
+            else:
+                cur.execute('ALTER TABLE "%s" SET SCHEMA "%s"' % (name, ARCHIVE_SCHEMA))
+    conn.commit()
+    return expired
+
+
+def default_partition_rows(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT COUNT(*) FROM plays_default")
+        return cur.fetchone()[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Create upcoming and retire expired partitions of plays.")
+    parser.add_argument('--ahead', type=int, default=PARTITIONS_AHEAD,
+                        help="months to create ahead of the current one")
+    parser.add_argument('--retention', type=int, default=RETENTION_MONTHS,
+                        help="months of plays to keep attached (0 keeps everything)")
+    parser.add_argument('--drop', action='store_true',
+                        help="drop expired partitions instead of archiving them")
+    args = parser.parse_args()
+
+    with get_connection() as conn:
+        created = ensure_partitions(conn, months_ahead=args.ahead)
+        print("Created partitions: %s" % (', '.join(created) or 'none'))
+        retired = detach_expired_partitions(conn, args.retention, args.drop)
+        print("%s partitions: %s" % ('Dropped' if args.drop else 'Archived', ', '.join(retired) or 'none'))
+        stray = default_partition_rows(conn)
+        if stray:
+            print("Warning: %d plays sit in plays_default, in months before the current one that have "
+                  "no partition." % stray)
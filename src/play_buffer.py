@@ -0,0 +1,215 @@
+import atexit
+import os
+import threading
+import time
+from datetime import datetime
+
+import psycopg2
+from psycopg2.extras import execute_values
+
+from db_pool import get_connection
+from rollups import record_plays
+from response_cache import invalidate
+import entity_cache
+import sketches
+
+
+MAX_ID = 2 ** 31 - 1
+
+# Errors caused by the rows themselves rather than the connection: retrying
+# the same batch can never succeed.
+DATA_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError)
+
+
+class BufferFull(Exception):
+    pass
+
+
+def parse_play_event(item):
+    user_id, song_id = item['user_id'], item['song_id']
+    if not isinstance(user_id, int) or not isinstance(song_id, int) or \
+            isinstance(user_id, bool) or isinstance(song_id, bool):
+        raise ValueError("user_id and song_id must be integers")
+    if not (1 <= user_id <= MAX_ID and 1 <= song_id <= MAX_ID):
+        raise ValueError("user_id and song_id must be between 1 and %d" % MAX_ID)
+    played_at = item.get('played_at')
+    if played_at is not None:
+        played_at = datetime.fromisoformat(played_at)
+    return (user_id, song_id, played_at)
+
+
+class PlayBuffer:
+    def __init__(self, max_size=10000, flush_size=500, flush_interval=1.0):
+        self.max_size = max_size
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+
+        self._events = []
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._stats = {
+            'accepted': 0,
+            'rejected': 0,
+            'flushed': 0,
+            'dropped': 0,
+            'invalid': 0,
+            'flushes': 0,
+            'failed_flushes': 0
+        }
+
+    def _start(self):
+        # Caller holds the lock.
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='play-buffer', daemon=True)
+            self._thread.start()
+
+    def add(self, events, timeout=0):
+        # `events` are (user_id, song_id, played_at) tuples; played_at may be
+        # None to let the database stamp the flush time.
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            if self._closed:
+                raise BufferFull("play buffer is shut down")
+            if len(events) > self.max_size:
+                raise BufferFull("batch of %d exceeds buffer capacity %d" % (len(events), self.max_size))
+            while len(self._events) + len(events) > self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats['rejected'] += len(events)
+                    raise BufferFull("play buffer full (%d pending)" % len(self._events))
+                self._cond.wait(remaining)
+            self._events.extend(events)
+            self._stats['accepted'] += len(events)
+            self._start()
+            if len(self._events) >= self.flush_size:
+                self._cond.notify_all()
+
+    def _run(self):
+        backoff = False
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                # After a failed flush wait out the full interval even if the
+                # buffer is over the size threshold, so an outage isn't hammered.
+                while not self._closed and (backoff or len(self._events) < self.flush_size):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                closed = self._closed
+                failures = self._stats['failed_flushes']
+            self.flush()
+            if closed:
+                return
+            backoff = self._stats['failed_flushes'] != failures
+
+    def flush(self):
+        with self._flush_lock:
+            with self._cond:
+                batch, self._events = self._events, []
+                self._cond.notify_all()
+            if not batch:
+                return 0
+            try:
+                written, invalid, unwritten = self._write(batch), 0, []
+            except DATA_ERRORS:
+                written, invalid, unwritten = self._write_isolating(batch)
+            except Exception:
+                written, invalid, unwritten = 0, 0, batch
+            with self._cond:
+                if unwritten:
+                    self._stats['failed_flushes'] += 1
+                    # Put the events back in front so a transient outage
+                    # doesn't lose plays; whatever no longer fits is dropped.
+                    room = max(self.max_size - len(self._events), 0)
+                    self._events[:0] = unwritten[:room]
+                    self._stats['dropped'] += len(unwritten) - min(room, len(unwritten))
+                else:
+                    self._stats['flushes'] += 1
+                self._stats['flushed'] += written
+                self._stats['invalid'] += invalid
+                self._stats['dropped'] += len(batch) - len(unwritten) - written - invalid
+            return written
+
+    def _write_isolating(self, batch):
+        # The batch failed on a data error: bisect it, writing the halves
+        # that succeed and dropping the single events that fail on their own,
+        # so one bad row cannot block the buffer forever. A connection error
+        # stops the search; the events not yet written are returned to be
+        # requeued. Returns (written, invalid, unwritten).
+        written, invalid = 0, 0
+        pending = [batch]
+        while pending:
+            piece = pending.pop()
+            try:
+                written += self._write(piece)
+            except DATA_ERRORS:
+                if len(piece) == 1:
+                    invalid += 1
+                    continue
+                middle = len(piece) // 2
+                pending += [piece[middle:], piece[:middle]]
+            except Exception:
+                pending.append(piece)
+                return written, invalid, [event for piece in reversed(pending) for event in piece]
+        return written, invalid, []
+
+    def _write(self, batch):
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                # Events referencing unknown users or songs are filtered out
+                # here instead of failing the whole batch on a foreign key.
+                rows = execute_values(cur, """
+                    INSERT INTO plays (user_id, song_id, played_at)
+                    SELECT v.user_id, v.song_id, COALESCE(v.played_at, CURRENT_TIMESTAMP)
+                    FROM (VALUES %s) AS v(user_id, song_id, played_at)
+                    JOIN users u ON u.id = v.user_id
+                    JOIN songs s ON s.id = v.song_id
+                    RETURNING user_id, song_id, played_at
+                """, batch, template="(%s::integer, %s::integer, %s::timestamp)",
+                    page_size=len(batch), fetch=True)
+                record_plays(cur, rows)
+        sketches.record_plays(rows)
+        # As POST /plays does for a direct write, once the rows are committed.
+        if rows:
+            invalidate('plays')
+            entity_cache.invalidate('song_plays', {row[1] for row in rows})
+            entity_cache.invalidate('user_activity', {row[0] for row in rows})
+        return len(rows)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            thread = self._thread
+            self._cond.notify_all()
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._events)
+            stats['max_size'] = self.max_size
+        return stats
+
+
+_buffer = None
+_buffer_pid = None
+_buffer_lock = threading.Lock()
+
+
+def get_play_buffer():
+    global _buffer, _buffer_pid
+    with _buffer_lock:
+        if _buffer is None or _buffer_pid != os.getpid():
+            _buffer = PlayBuffer(
+                max_size=int(os.getenv("PLAY_BUFFER_MAX", 10000)),
+                flush_size=int(os.getenv("PLAY_BUFFER_FLUSH_SIZE", 500)),
+                flush_interval=float(os.getenv("PLAY_BUFFER_FLUSH_INTERVAL", 1.0))
+            )
+            _buffer_pid = os.getpid()
+            atexit.register(_buffer.close)
+        return _buffer
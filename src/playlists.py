@@ -0,0 +1,292 @@
+import os
+
+import feeds
+
+# Editing a playlist's tracks. Tracks are ordered by playlist_songs.position,
+# a BIGINT spaced POSITION_GAP apart: a song inserted or moved between two
+# others takes the midpoint of their positions, so an edit touches only the
+# rows it adds, removes or moves. Only when repeated inserts at one spot use
+# up a gap (log2(POSITION_GAP) of them) is the playlist renumbered, once.
+#
+# The edits below are generators in the style of the entity_cache loaders:
+# they yield (query, params), are sent the fetched rows back, and run in one
+# transaction through run_transaction (psycopg2) or asgi_app.run_lookup
+# (psycopg 3). Every statement returns rows so both drivers can fetch them.
+POSITION_GAP = 65536
+MAX_PLAYLIST_EDIT = int(os.getenv("MAX_PLAYLIST_EDIT", 1000))
+
+
+class PlaylistNotFound(Exception):
+    pass
+
+
+class InvalidPlaylistEdit(ValueError):
+    pass
+
+
+# Serializes edits of one playlist, so two concurrent inserts cannot pick
+# the same midpoint.
+LOCK_PLAYLIST_QUERY = "SELECT id FROM playlists WHERE id = %s FOR UPDATE"
+
+TRACK_POSITIONS_QUERY = """
+    SELECT song_id, position FROM playlist_songs WHERE playlist_id = %s AND song_id = ANY(%s)
+"""
+
+PREVIOUS_POSITION_QUERY = """
+    SELECT position FROM playlist_songs
+    WHERE playlist_id = %s AND (position, song_id) < (%s, %s)
+    ORDER BY position DESC, song_id DESC
+    LIMIT 1
+"""
+
+NEXT_POSITION_QUERY = """
+    SELECT position FROM playlist_songs
+    WHERE playlist_id = %s AND (position, song_id) > (%s, %s)
+    ORDER BY position, song_id
+    LIMIT 1
+"""
+
+LAST_POSITION_QUERY = """
+    SELECT position FROM playlist_songs WHERE playlist_id = %s ORDER BY position DESC, song_id DESC LIMIT 1
+"""
+
+# Unknown songs and songs already in the playlist are skipped.
+ADD_SONGS_QUERY = """
+    INSERT INTO playlist_songs (playlist_id, song_id, position)
+    SELECT %s, v.song_id, v.position
+    FROM unnest(%s::integer[], %s::bigint[]) AS v(song_id, position)
+    JOIN songs s ON s.id = v.song_id
+    ORDER BY v.song_id
+    ON CONFLICT (playlist_id, song_id) DO NOTHING
+    RETURNING song_id
+"""
+
+REMOVE_SONGS_QUERY = """
+    DELETE FROM playlist_songs WHERE playlist_id = %s AND song_id = ANY(%s)
+    RETURNING song_id
+"""
+
+MOVE_SONG_QUERY = """
+    UPDATE playlist_songs SET position = %s WHERE playlist_id = %s AND song_id = %s
+    RETURNING song_id
+"""
+
+REBALANCE_QUERY = """
+    UPDATE playlist_songs ps SET position = r.rank * %s
+    FROM (
+        SELECT song_id, ROW_NUMBER() OVER (ORDER BY position, song_id) as rank
+        FROM playlist_songs
+        WHERE playlist_id = %s
+    ) r
+    WHERE ps.playlist_id = %s AND ps.song_id = r.song_id
+    RETURNING ps.song_id
+"""
+
+# playlist_play_counts is the plays of the playlist's current songs (see
+# rollups.rebuild_rollups), so songs bring their play counts with them.
+# FOR SHARE waits for plays of those songs that are in flight and holds
+# new ones until the edit commits, so no play is counted twice or missed.
+SONG_PLAY_TOTAL_QUERY = """
+    SELECT COALESCE(SUM(play_count), 0) FROM (
+        SELECT play_count FROM song_play_counts WHERE song_id = ANY(%s) ORDER BY song_id FOR SHARE
+    ) c
+"""
+
+ADJUST_PLAYLIST_PLAYS_QUERY = """
+    INSERT INTO playlist_play_counts (playlist_id, play_count) VALUES (%s, %s)
+    ON CONFLICT (playlist_id) DO UPDATE
+    SET play_count = playlist_play_counts.play_count + EXCLUDED.play_count,
+        updated_at = clock_timestamp()
+    RETURNING play_count
+"""
+
+PLAYLIST_TRACKS_COLUMNS = """
+    SELECT ps.position, s.id, s.title, s.duration, s.album_cover, a.name as artist_name
+    FROM playlist_songs ps
+    JOIN songs s ON s.id = ps.song_id
+    JOIN artists a ON s.artist_id = a.id
+    WHERE ps.playlist_id = %s
+"""
+
+PLAYLIST_EXISTS_QUERY = "SELECT 1 FROM playlists WHERE id = %s"
+
+
+def song_id_list(data, name='song_ids'):
+    ids = data.get(name) if isinstance(data, dict) else None
+    if not isinstance(ids, list) or not ids:
+        raise InvalidPlaylistEdit("Expected a non-empty array of %s" % name)
+    if len(ids) > MAX_PLAYLIST_EDIT:
+        raise InvalidPlaylistEdit("At most %d songs per request" % MAX_PLAYLIST_EDIT)
+    if not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        raise InvalidPlaylistEdit("%s must be integers" % name)
+    return list(dict.fromkeys(ids))
+
+
+def anchor(data):
+    # ('before' | 'after', song_id), or None to append.
+    given = [key for key in ('before', 'after') if isinstance(data, dict) and data.get(key) is not None]
+    if len(given) > 1:
+        raise InvalidPlaylistEdit("Give either before or after, not both")
+    if not given:
+        return None
+    song_id = data[given[0]]
+    if not isinstance(song_id, int) or isinstance(song_id, bool):
+        raise InvalidPlaylistEdit("%s must be a song id" % given[0])
+    return given[0], song_id
+
+
+def spread(low, high, count):
+    # `count` increasing positions strictly between low and high (either
+    # may be None for the start or end of the list), or None if the gap is
+    # too small.
+    if low is None and high is None:
+        low = 0
+    if high is None:
+        high = low + (count + 1) * POSITION_GAP
+    if low is None:
+        low = high - (count + 1) * POSITION_GAP
+    if high - low <= count:
+        return None
+    return [low + (high - low) * i // (count + 1) for i in range(1, count + 1)]
+
+
+def lock_playlist(playlist_id):
+    rows = yield LOCK_PLAYLIST_QUERY, (playlist_id,)
+    if not rows:
+        raise PlaylistNotFound("Playlist not found")
+
+
+def slot(playlist_id, where, count, exclude=None):
+    # Positions for `count` songs at `where` (see anchor), renumbering the
+    # playlist first if the gap there is used up. Returns (positions, rebalanced).
+    for attempt in range(2):
+        if where is None:
+            rows = yield LAST_POSITION_QUERY, (playlist_id,)
+            low, high = (rows[0][0] if rows else None), None
+        else:
+            side, song_id = where
+            if song_id == exclude:
+                raise InvalidPlaylistEdit("Cannot move a song relative to itself")
+            rows = yield TRACK_POSITIONS_QUERY, (playlist_id, [song_id])
+            if not rows:
+                raise InvalidPlaylistEdit("Song %d is not in the playlist" % song_id)
+            position = rows[0][1]
+            neighbour = yield (PREVIOUS_POSITION_QUERY if side == 'before' else NEXT_POSITION_QUERY), \
+                (playlist_id, position, song_id)
+            other = neighbour[0][0] if neighbour else None
+            low, high = (other, position) if side == 'before' else (position, other)
+        positions = spread(low, high, count)
+        if positions is not None:
+            return positions, attempt > 0
+        if attempt > 0:
+            break
+        yield REBALANCE_QUERY, (POSITION_GAP, playlist_id, playlist_id)
+    raise InvalidPlaylistEdit("No room to insert %d songs" % count)
+
+
+def adjust_plays(playlist_id, song_ids, sign):
+    if not song_ids:
+        return
+    rows = yield SONG_PLAY_TOTAL_QUERY, (song_ids,)
+    if rows[0][0]:
+        yield ADJUST_PLAYLIST_PLAYS_QUERY, (playlist_id, sign * rows[0][0])
+
+
+def add_songs(playlist_id, data):
+    song_ids = song_id_list(data)
+    where = anchor(data)
+    yield from lock_playlist(playlist_id)
+    positions, rebalanced = yield from slot(playlist_id, where, len(song_ids))
+    rows = yield ADD_SONGS_QUERY, (playlist_id, song_ids, positions)
+    added = {row[0] for row in rows}
+    yield from adjust_plays(playlist_id, sorted(added), 1)
+    yield from feeds.publish(playlist_id, [song_id for song_id in song_ids if song_id in added])
+    return {
+        'added': [song_id for song_id in song_ids if song_id in added],
+        'skipped': [song_id for song_id in song_ids if song_id not in added],
+        'rebalanced': rebalanced
+    }
+
+
+def remove_songs(playlist_id, data):
+    song_ids = song_id_list(data)
+    yield from lock_playlist(playlist_id)
+    rows = yield REMOVE_SONGS_QUERY, (playlist_id, song_ids)
+    removed = {row[0] for row in rows}
+    yield from adjust_plays(playlist_id, sorted(removed), -1)
+    return {
+        'removed': [song_id for song_id in song_ids if song_id in removed],
+        'skipped': [song_id for song_id in song_ids if song_id not in removed]
+    }
+
+
+def move_songs(playlist_id, data):
+    # {"song_id": 5, "before" | "after": 9}, or {"moves": [...]} of those,
+    # applied in order. Without before/after a song moves to the end.
+    moves = data.get('moves', [data]) if isinstance(data, dict) else data
+    if not isinstance(moves, list) or not moves:
+        raise InvalidPlaylistEdit("Expected a move or a non-empty array of moves")
+    if len(moves) > MAX_PLAYLIST_EDIT:
+        raise InvalidPlaylistEdit("At most %d moves per request" % MAX_PLAYLIST_EDIT)
+    parsed = []
+    for move in moves:
+        song_id = move.get('song_id') if isinstance(move, dict) else None
+        if not isinstance(song_id, int) or isinstance(song_id, bool):
+            raise InvalidPlaylistEdit("Every move needs an integer song_id")
+        parsed.append((song_id, anchor(move)))
+
+    yield from lock_playlist(playlist_id)
+    rebalanced = False
+    for song_id, where in parsed:
+        positions, renumbered = yield from slot(playlist_id, where, 1, exclude=song_id)
+        rebalanced = rebalanced or renumbered
+        rows = yield MOVE_SONG_QUERY, (positions[0], playlist_id, song_id)
+        if not rows:
+            raise InvalidPlaylistEdit("Song %d is not in the playlist" % song_id)
+    return {'moved': [song_id for song_id, _ in parsed], 'rebalanced': rebalanced}
+
+
+def tracks_query(playlist_id, after, limit):
+    query, params = PLAYLIST_TRACKS_COLUMNS, [playlist_id]
+    if after:
+        query += " AND (ps.position, ps.song_id) > (%s, %s)"
+        params += after
+    query += " ORDER BY ps.position, ps.song_id LIMIT %s"
+    params.append(limit)
+    return query, params
+
+
+TRACK_CURSOR = (int, int)
+
+
+def track_cursor_key(row):
+    return (row[0], row[1])
+
+
+def track_from_row(row):
+    return {
+        'id': row[1],
+        'title': row[2],
+        'duration': row[3],
+        'album_cover': row[4],
+        'artist_name': row[5]
+    }
+
+
+def run_transaction(edit, conn):
+    # Drives an edit on a psycopg2 connection: commits if it finishes,
+    # rolls back if it raises.
+    try:
+        with conn.cursor() as cur:
+            query, params = next(edit)
+            while True:
+                cur.execute(query, params)
+                query, params = edit.send(cur.fetchall())
+    except StopIteration as done:
+        conn.commit()
+        return done.value
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
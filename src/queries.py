@@ -0,0 +1,464 @@
+# SQL and row shaping shared by the Flask app (db_requests.py) and the
+# asyncio app (asgi_app.py). Both drivers (psycopg2 and psycopg 3) take the
+# same %s placeholders, so every statement here runs unchanged on either.
+from datetime import datetime
+
+SONG_COLUMNS = """
+    SELECT s.id, s.title, s.artist_id, s.duration, s.album_cover, a.name as artist_name
+    FROM songs s
+    JOIN artists a ON s.artist_id = a.id
+"""
+
+# Playtime comes from the user_playtime rollup (one row per user, kept in
+# step with plays by rollups.py) and is read in leaderboard-index order.
+TOP_USERS_QUERY = """
+    SELECT u.id, u.username, u.email, u.profile_image, u.created_at, t.total_playtime
+    FROM (
+        SELECT user_id, total_playtime
+        FROM user_playtime
+        ORDER BY total_playtime DESC, user_id
+        LIMIT 3
+    ) t
+    JOIN users u ON u.id = t.user_id
+    ORDER BY t.total_playtime DESC, u.id
+"""
+
+USER_PLAYTIME_COLUMNS = """
+    SELECT u.id, u.username, u.email, u.profile_image, u.created_at, t.total_playtime
+    FROM user_playtime t
+    JOIN users u ON u.id = t.user_id
+"""
+
+# Rank in the (total_playtime DESC, user_id) order: both counts are range
+# scans on the leaderboard index.
+USER_RANK_QUERY = """
+    SELECT t.user_id, t.total_playtime, t.play_count,
+           1 + (SELECT COUNT(*) FROM user_playtime o WHERE o.total_playtime > t.total_playtime)
+             + (SELECT COUNT(*) FROM user_playtime o
+                WHERE o.total_playtime = t.total_playtime AND o.user_id < t.user_id) as rank
+    FROM user_playtime t
+    WHERE t.user_id = %s
+"""
+
+TOP_PLAYLISTS_QUERY = """
+    SELECT p.id, p.name, p.cover, c.play_count
+    FROM playlist_play_counts c
+    JOIN playlists p ON c.playlist_id = p.id
+    ORDER BY c.play_count DESC, p.created_at DESC
+    LIMIT 5
+"""
+
+PLAYLIST_COLUMNS = """
+    SELECT p.id, p.name, p.is_curated, p.created_by, p.created_at, p.cover,
+           u.username as creator_username, COALESCE(c.play_count, 0) as play_count
+    FROM playlists p
+    LEFT JOIN users u ON p.created_by = u.id
+    LEFT JOIN playlist_play_counts c ON p.id = c.playlist_id
+"""
+
+USER_COLUMNS = "SELECT id, username, email, profile_image, created_at FROM users"
+
+SONG_DETAILS_QUERY = """
+    SELECT s.id, s.title, s.artist_id, s.duration, s.album_cover,
+           a.name as artist_name, a.country, a.profile_image as artist_image,
+           COALESCE(c.play_count, 0) as play_count
+    FROM songs s
+    JOIN artists a ON s.artist_id = a.id
+    LEFT JOIN song_play_counts c ON c.song_id = s.id
+    WHERE s.id = ANY(%s)
+"""
+
+PLAYLIST_DETAILS_QUERY = """
+    SELECT p.id, p.name, p.is_curated, p.created_by, p.created_at, p.cover,
+           u.username as creator_username, u.profile_image as creator_image,
+           COALESCE(c.play_count, 0) as total_plays,
+           COALESCE((
+               SELECT json_agg(json_build_object(
+                          'id', s.id,
+                          'title', s.title,
+                          'duration', s.duration,
+                          'album_cover', s.album_cover,
+                          'artist_name', a.name
+                      ) ORDER BY ps.position, ps.song_id)
+               FROM playlist_songs ps
+               JOIN songs s ON ps.song_id = s.id
+               JOIN artists a ON s.artist_id = a.id
+               WHERE ps.playlist_id = p.id
+           ), '[]') as songs
+    FROM playlists p
+    LEFT JOIN users u ON p.created_by = u.id
+    LEFT JOIN playlist_play_counts c ON c.playlist_id = p.id
+    WHERE p.id = ANY(%s)
+"""
+
+# A user's playlists, total playtime and five most played songs; the
+# per-play counts come from the rollups (see rollups.py), not from plays.
+USER_ACTIVITY_COLUMNS = """
+           COALESCE((
+               SELECT json_agg(json_build_object(
+                          'id', pl.id,
+                          'name', pl.name,
+                          'cover', pl.cover,
+                          'created_at', pl.created_at
+                      ) ORDER BY pl.created_at DESC)
+               FROM playlists pl
+               WHERE pl.created_by = u.id
+           ), '[]') as playlists,
+           COALESCE((
+               SELECT total_playtime FROM user_playtime WHERE user_id = u.id
+           ), 0) as total_playtime,
+           COALESCE((
+               SELECT json_agg(json_build_object(
+                          'id', s.id,
+                          'title', s.title,
+                          'artist_name', a.name,
+                          'play_count', t.play_count
+                      ) ORDER BY t.play_count DESC, t.song_id)
+               FROM (
+                   SELECT song_id, play_count
+                   FROM user_song_plays
+                   WHERE user_id = u.id AND play_count > 0
+                   ORDER BY play_count DESC, song_id
+                   LIMIT 5
+               ) t
+               JOIN songs s ON s.id = t.song_id
+               JOIN artists a ON s.artist_id = a.id
+           ), '[]') as top_songs"""
+
+USER_DETAILS_QUERY = """
+    SELECT u.id, u.username, u.email, u.profile_image, u.created_at,{columns}
+    FROM users u
+    WHERE u.id = ANY(%s)
+""".format(columns=USER_ACTIVITY_COLUMNS)
+
+# Version tokens for conditional GETs (conditional.py), each one index
+# lookup: (token, last_modified). Catalog tables bump a per-table counter in
+# table_versions on every write statement (see schema.sql), and play-count
+# rollup rows carry their own updated_at.
+SONG_VERSION_QUERY = """
+    SELECT concat_ws('.', v.version, c.play_count), GREATEST(v.updated_at, c.updated_at)
+    FROM songs s
+    CROSS JOIN (
+        SELECT SUM(version) as version, MAX(updated_at) as updated_at
+        FROM table_versions
+        WHERE table_name IN ('songs', 'artists')
+    ) v
+    LEFT JOIN song_play_counts c ON c.song_id = s.id
+    WHERE s.id = %s
+"""
+
+PLAYLIST_VERSION_QUERY = """
+    SELECT concat_ws('.', v.version, c.play_count), GREATEST(v.updated_at, c.updated_at)
+    FROM playlists p
+    CROSS JOIN (
+        SELECT SUM(version) as version, MAX(updated_at) as updated_at
+        FROM table_versions
+        WHERE table_name IN ('playlists', 'playlist_songs', 'songs', 'artists', 'users')
+    ) v
+    LEFT JOIN playlist_play_counts c ON c.playlist_id = p.id
+    WHERE p.id = %s
+"""
+
+# The list shows every playlist's play count, so its watermark is the most
+# recent play-count change (a backward scan of the updated_at index).
+PLAYLISTS_VERSION_QUERY = """
+    SELECT concat_ws('.', v.version, EXTRACT(EPOCH FROM c.updated_at)), GREATEST(v.updated_at, c.updated_at)
+    FROM (
+        SELECT SUM(version) as version, MAX(updated_at) as updated_at
+        FROM table_versions
+        WHERE table_name IN ('playlists', 'users')
+    ) v
+    CROSS JOIN (SELECT MAX(updated_at) as updated_at FROM playlist_play_counts) c
+"""
+
+# Entity cache (entity_cache.py) lookups: the static columns of each record
+# by id array, the per-play counters kept for a few seconds, and the
+# popular sets loaded at warm-up.
+SONG_RECORDS_QUERY = "SELECT id, title, artist_id, duration, album_cover FROM songs WHERE id = ANY(%s)"
+
+ARTIST_RECORDS_QUERY = "SELECT id, name, country, profile_image FROM artists WHERE id = ANY(%s)"
+
+USER_RECORDS_QUERY = "SELECT id, username, email, profile_image, created_at FROM users WHERE id = ANY(%s)"
+
+PLAYLIST_RECORDS_COLUMNS = """
+    SELECT p.id, p.name, p.is_curated, p.created_by, p.created_at, p.cover,
+           ARRAY(
+               SELECT ps.song_id FROM playlist_songs ps WHERE ps.playlist_id = p.id ORDER BY ps.position, ps.song_id
+           ) as song_ids
+    FROM playlists p
+"""
+
+PLAYLIST_RECORDS_QUERY = PLAYLIST_RECORDS_COLUMNS + " WHERE p.id = ANY(%s)"
+
+SONG_COUNTS_QUERY = "SELECT song_id, play_count FROM song_play_counts WHERE song_id = ANY(%s)"
+
+PLAYLIST_COUNTS_QUERY = "SELECT playlist_id, play_count FROM playlist_play_counts WHERE playlist_id = ANY(%s)"
+
+# The per-user part of USER_DETAILS_QUERY, for users whose profile is cached.
+USER_ACTIVITY_QUERY = """
+    SELECT u.id,{columns}
+    FROM users u
+    WHERE u.id = ANY(%s)
+""".format(columns=USER_ACTIVITY_COLUMNS)
+
+WARM_SONGS_QUERY = """
+    SELECT s.id, s.title, s.artist_id, s.duration, s.album_cover
+    FROM (SELECT song_id FROM song_play_counts ORDER BY play_count DESC LIMIT %s) c
+    JOIN songs s ON s.id = c.song_id
+"""
+
+WARM_PLAYLISTS_QUERY = PLAYLIST_RECORDS_COLUMNS + """
+    JOIN (SELECT playlist_id FROM playlist_play_counts ORDER BY play_count DESC LIMIT %s) c
+      ON c.playlist_id = p.id
+"""
+
+WARM_USERS_QUERY = """
+    SELECT u.id, u.username, u.email, u.profile_image, u.created_at
+    FROM (SELECT user_id FROM user_playtime ORDER BY total_playtime DESC, user_id LIMIT %s) t
+    JOIN users u ON u.id = t.user_id
+"""
+
+RANDOM_USER_QUERY = "SELECT id, username FROM users ORDER BY RANDOM() LIMIT 1"
+
+CREATE_PLAYLIST_QUERY = """
+    INSERT INTO playlists (name, created_by, is_curated, cover, description)
+    VALUES (%s, %s, %s, %s, %s)
+    RETURNING id, name, is_curated, created_by, created_at, cover, description
+"""
+
+INSERT_PLAY_QUERY = "INSERT INTO plays (user_id, song_id) VALUES (%s, %s) RETURNING id, user_id, song_id, played_at"
+
+# Whole-list bodies built by Postgres (serialization.JSON_FROM_DB): the
+# unpaged lists come back as one text value with the same keys, in the same
+# order, as the Python row mappers produce.
+PLAYLISTS_JSON_QUERY = """
+    SELECT COALESCE(json_agg(json_build_object(
+               'cover', p.cover,
+               'created_at', p.created_at,
+               'created_by', p.created_by,
+               'creator_username', p.creator_username,
+               'id', p.id,
+               'is_curated', p.is_curated,
+               'name', p.name,
+               'play_count', p.play_count
+           ) ORDER BY p.created_at DESC, p.id DESC), '[]')::text
+    FROM ({columns}) p
+""".format(columns=PLAYLIST_COLUMNS)
+
+USER_PLAYTIME_JSON_QUERY = """
+    SELECT COALESCE(json_agg(json_build_object(
+               'total_playtime', t.total_playtime,
+               'user', json_build_object(
+                   'created_at', t.created_at,
+                   'email', t.email,
+                   'id', t.id,
+                   'profile_image', t.profile_image,
+                   'username', t.username
+               )
+           ) ORDER BY t.total_playtime DESC, t.id), '[]')::text
+    FROM ({columns}) t
+""".format(columns=USER_PLAYTIME_COLUMNS)
+
+
+def songs_query(after, limit, offset=0):
+    query, params = SONG_COLUMNS, []
+    if after:
+        query += " WHERE (s.title, s.id) > (%s, %s)"
+        params += after
+    query += " ORDER BY s.title, s.id LIMIT %s"
+    params.append(limit)
+    if offset:
+        query += " OFFSET %s"
+        params.append(offset)
+    return query, params
+
+
+def user_playtime_query(after, limit=None):
+    query, params = USER_PLAYTIME_COLUMNS, []
+    if after:
+        # The leading <= gives the leaderboard index a range to seek into.
+        query += " WHERE t.total_playtime <= %s AND (t.total_playtime < %s OR t.user_id > %s)"
+        params += [after[0], after[0], after[1]]
+    query += " ORDER BY t.total_playtime DESC, t.user_id"
+    if limit:
+        query += " LIMIT %s"
+        params.append(limit)
+    return query, params
+
+
+def playlists_query(after, limit=None):
+    query, params = PLAYLIST_COLUMNS, []
+    if after:
+        query += " WHERE (p.created_at, p.id) < (%s, %s)"
+        params += after
+    query += " ORDER BY p.created_at DESC, p.id DESC"
+    if limit:
+        query += " LIMIT %s"
+        params.append(limit)
+    return query, params
+
+
+def users_query(after, limit=None):
+    query, params = USER_COLUMNS, []
+    if after:
+        query += " WHERE id > %s"
+        params += after
+    query += " ORDER BY id"
+    if limit:
+        query += " LIMIT %s"
+        params.append(limit)
+    return query, params
+
+
+# What pagination.decode_cursor accepts back for each of the keys below.
+SONG_CURSOR = (str, int)
+SEARCH_CURSOR = ((float, int), int)
+USER_PLAYTIME_CURSOR = (int, int)
+PLAYLIST_CURSOR = (datetime.fromisoformat, int)
+USER_CURSOR = (int,)
+
+
+def song_cursor_key(row):
+    return (row[1], row[0])
+
+
+def search_cursor_key(row):
+    return (row[6], row[0])
+
+
+def user_playtime_cursor_key(row):
+    return (row[5], row[0])
+
+
+def playlist_cursor_key(row):
+    return (row[4].isoformat(), row[0])
+
+
+def user_cursor_key(row):
+    return (row[0],)
+
+
+def rows_as_dicts(description, rows):
+    columns = [desc[0] for desc in description]
+    return [dict(zip(columns, row)) for row in rows]
+
+
+def song_from_row(row):
+    return {
+        'id': row[0],
+        'title': row[1],
+        'artist_id': row[2],
+        'duration': row[3],
+        'album_cover': row[4],
+        'artist_name': row[5]
+    }
+
+
+def user_from_row(row):
+    return {
+        'id': row[0],
+        'username': row[1],
+        'email': row[2],
+        'profile_image': row[3],
+        'created_at': row[4]
+    }
+
+
+def user_playtime_from_row(row):
+    return {
+        'user': user_from_row(row),
+        'total_playtime': row[5]
+    }
+
+
+def top_playlist_from_row(row):
+    return {
+        'id': row[0],
+        'name': row[1],
+        'cover': row[2],
+        'play_count': row[3]
+    }
+
+
+def playlist_from_row(row):
+    return {
+        'id': row[0],
+        'name': row[1],
+        'is_curated': row[2],
+        'created_by': row[3],
+        'created_at': row[4],
+        'cover': row[5],
+        'creator_username': row[6],
+        'play_count': row[7]
+    }
+
+
+def created_playlist_from_row(row, creator_username):
+    return {
+        'id': row[0],
+        'name': row[1],
+        'is_curated': row[2],
+        'created_by': row[3],
+        'created_at': row[4],
+        'cover': row[5],
+        'creator_username': creator_username,
+        'play_count': 0
+    }
+
+
+def song_details_from_row(row):
+    return {
+        'id': row[0],
+        'title': row[1],
+        'artist_id': row[2],
+        'duration': row[3],
+        'album_cover': row[4],
+        'artist_name': row[5],
+        'artist_country': row[6],
+        'artist_image': row[7],
+        'play_count': row[8]
+    }
+
+
+def playlist_details_from_row(row):
+    return {
+        'id': row[0],
+        'name': row[1],
+        'is_curated': row[2],
+        'created_by': row[3],
+        'created_at': row[4],
+        'cover': row[5],
+        'creator_username': row[6],
+        'creator_image': row[7],
+        'songs': row[9],
+        'song_count': len(row[9]),
+        'total_plays': row[8]
+    }
+
+
+def user_rank_from_row(row):
+    return {
+        'user_id': row[0],
+        'total_playtime': row[1],
+        'play_count': row[2],
+        'rank': row[3]
+    }
+
+
+def user_details_from_row(row):
+    return {
+        'id': row[0],
+        'username': row[1],
+        'email': row[2],
+        'profile_image': row[3],
+        'created_at': row[4],
+        'playlists': row[5],
+        'playlist_count': len(row[5]),
+        'total_playtime': row[6],
+        'top_songs': row[7]
+    }
+
+
+def details_in_order(rows, ids, from_row):
+    found = {row[0]: from_row(row) for row in rows}
+    return [found[entity_id] for entity_id in ids if entity_id in found]
@@ -0,0 +1,233 @@
+import argparse
+import os
+import time
+
+import numpy as np
+from scipy import sparse
+
+from db_pool import get_connection
+from pagination import int_arg
+from response_cache import invalidate
+
+# Item-item collaborative filtering. The offline job below (run it from
+# cron) reads the user x song listening matrix from the user_song_plays
+# rollup, scores song pairs by the cosine similarity of their listener
+# vectors and keeps the RECS_NEIGHBORS best neighbors of every song in
+# song_neighbors. Online, a user's recommendations are the neighbors of
+# their recently played songs, weighted by how often they played them:
+# a few thousand index rows per request, summed in Postgres.
+#
+# Play counts are dampened with log1p so a song on repeat does not dominate
+# a listener's vector, and RECS_SHRINK pulls down similarities that only a
+# handful of listeners support.
+NEIGHBORS = int(os.getenv("RECS_NEIGHBORS", 50))
+SHRINK = float(os.getenv("RECS_SHRINK", 10))
+MIN_SCORE = float(os.getenv("RECS_MIN_SCORE", 0.01))
+# Songs scored per sparse product; bounds the memory of one block.
+BLOCK_SIZE = int(os.getenv("RECS_BLOCK_SIZE", 1000))
+# An incremental refresh re-reads rows updated this long before the previous
+# refresh started, so plays committed by transactions in flight at the time
+# are not missed.
+REFRESH_OVERLAP = int(os.getenv("RECS_REFRESH_OVERLAP", 60))
+
+HISTORY = int(os.getenv("RECS_HISTORY", 50))
+DEFAULT_LIMIT = 20
+MAX_LIMIT = int(os.getenv("RECS_MAX_LIMIT", 100))
+
+# Candidates are the neighbors of the user's HISTORY most recently played
+# songs, minus everything they have already played. Users with little or
+# no history are topped up with the most played songs (score 0).
+RECOMMENDATIONS_QUERY = """
+    WITH history AS (
+        SELECT song_id, play_count
+        FROM user_song_plays
+        WHERE user_id = %(user_id)s
+        ORDER BY last_played_at DESC
+        LIMIT %(history)s
+    ), scored AS (
+        SELECT n.neighbor_id as song_id, SUM(n.score * LN(1 + h.play_count)) as score, 0 as popularity
+        FROM history h
+        JOIN song_neighbors n ON n.song_id = h.song_id
+        GROUP BY n.neighbor_id
+    ), candidates AS (
+        SELECT song_id, score, popularity FROM scored
+        UNION ALL
+        SELECT song_id, 0, popularity
+        FROM (
+            SELECT song_id, ROW_NUMBER() OVER (ORDER BY play_count DESC, song_id) as popularity
+            FROM song_play_counts
+            ORDER BY play_count DESC, song_id
+            LIMIT %(fallback)s
+        ) p
+        WHERE NOT EXISTS (SELECT 1 FROM scored WHERE scored.song_id = p.song_id)
+    )
+    SELECT s.id, s.title, a.name as artist, s.album_cover, c.score
+    FROM (
+        SELECT song_id, score, popularity
+        FROM candidates c
+        WHERE NOT EXISTS (
+            SELECT 1 FROM user_song_plays u WHERE u.user_id = %(user_id)s AND u.song_id = c.song_id
+        )
+        ORDER BY score DESC, popularity, song_id
+        LIMIT %(limit)s
+    ) c
+    JOIN songs s ON s.id = c.song_id
+    LEFT JOIN artists a ON s.artist_id = a.id
+    ORDER BY c.score DESC, c.popularity, s.id
+"""
+
+SIMILAR_SONGS_QUERY = """
+    SELECT s.id, s.title, a.name as artist, s.album_cover, n.score
+    FROM (
+        SELECT neighbor_id, score
+        FROM song_neighbors
+        WHERE song_id = %s
+        ORDER BY score DESC, neighbor_id
+        LIMIT %s
+    ) n
+    JOIN songs s ON s.id = n.neighbor_id
+    LEFT JOIN artists a ON s.artist_id = a.id
+    ORDER BY n.score DESC, s.id
+"""
+
+
+def recommendation_limit(args):
+    return max(1, min(int_arg(args, 'limit', DEFAULT_LIMIT), MAX_LIMIT))
+
+
+def recommendations_query(user_id, args):
+    limit = recommendation_limit(args)
+    return RECOMMENDATIONS_QUERY, {'user_id': user_id, 'history': HISTORY,
+                                   'fallback': limit + HISTORY, 'limit': limit}
+
+
+def similar_songs_query(song_id, args):
+    return SIMILAR_SONGS_QUERY, (song_id, recommendation_limit(args))
+
+
+def load_matrix(conn, fetch_size=100000):
+    # Returns the user x song matrix (CSR, log1p of play counts) and the
+    # song id of every column.
+    users, songs, counts = [], [], []
+    with conn.cursor(name='recommender_matrix') as cur:
+        cur.itersize = fetch_size
+        cur.execute("SELECT user_id, song_id, play_count FROM user_song_plays WHERE play_count > 0")
+        while True:
+            rows = cur.fetchmany(fetch_size)
+            if not rows:
+                break
+            chunk = np.array(rows, dtype=np.int64)
+            users.append(chunk[:, 0])
+            songs.append(chunk[:, 1])
+            counts.append(chunk[:, 2])
+    conn.commit()
+    if not users:
+        return sparse.csr_matrix((0, 0)), np.empty(0, dtype=np.int64)
+    user_ids, user_index = np.unique(np.concatenate(users), return_inverse=True)
+    song_ids, song_index = np.unique(np.concatenate(songs), return_inverse=True)
+    weights = np.log1p(np.concatenate(counts).astype(np.float32))
+    matrix = sparse.csr_matrix((weights, (user_index, song_index)), shape=(len(user_ids), len(song_ids)))
+    return matrix, song_ids
+
+
+def top_neighbors(matrix, by_song, norms, block, k=NEIGHBORS):
+    # Scores the songs in `block` (column indices) against every song with
+    # one sparse product and keeps the k best neighbors of each, without a
+    # Python loop over songs. Returns (song, neighbor, score) index arrays.
+    dots = (by_song[block] @ matrix).tocsr()
+    rows = np.repeat(np.arange(len(block)), np.diff(dots.indptr))
+    cols = dots.indices
+    scores = dots.data / (norms[block][rows] * norms[cols] + SHRINK)
+    keep = (cols != block[rows]) & (scores >= MIN_SCORE)
+    rows, cols, scores = rows[keep], cols[keep], scores[keep]
+    order = np.lexsort((cols, -scores, rows))
+    rows, cols, scores = rows[order], cols[order], scores[order]
+    rank = np.arange(len(rows)) - np.searchsorted(rows, rows)
+    top = rank < k
+    return block[rows[top]], cols[top], scores[top]
+
+
+def store_neighbors(conn, song_ids, songs, neighbors, scores):
+    # Replaces the neighbor lists of `song_ids` in one transaction, so
+    # readers see either the old or the new list of a song.
+    with conn.cursor() as cur:
+        cur.execute("DELETE FROM song_neighbors WHERE song_id = ANY(%s)", (song_ids.tolist(),))
+        cur.execute("""
+            INSERT INTO song_neighbors (song_id, neighbor_id, score)
+            SELECT * FROM unnest(%s::integer[], %s::integer[], %s::real[])
+        """, (songs.tolist(), neighbors.tolist(), scores.tolist()))
+    conn.commit()
+
+
+def refresh_songs(conn, matrix, song_ids, columns):
+    by_song = matrix.T.tocsr()
+    norms = np.sqrt(np.asarray(by_song.multiply(by_song).sum(axis=1)).ravel())
+    stored = 0
+    for start in range(0, len(columns), BLOCK_SIZE):
+        block = columns[start:start + BLOCK_SIZE]
+        songs, neighbors, scores = top_neighbors(matrix, by_song, norms, block)
+        store_neighbors(conn, song_ids[block], song_ids[songs], song_ids[neighbors], scores)
+        stored += len(scores)
+    return stored
+
+
+def database_now(conn):
+    with conn.cursor() as cur:
+        cur.execute("SELECT now()")
+        return cur.fetchone()[0]
+
+
+def changed_songs(conn, since):
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT DISTINCT song_id FROM user_song_plays
+            WHERE updated_at > %s - %s * INTERVAL '1 second'
+        """, (since, REFRESH_OVERLAP))
+        return np.array([row[0] for row in cur.fetchall()], dtype=np.int64)
+
+
+def refresh(conn, full=False):
+    # Incremental by default: only songs whose listeners changed since the
+    # last run get new neighbor lists. Their old neighbors' lists (which
+    # mention them) are left as they are until the next full build.
+    started = database_now(conn)
+    with conn.cursor() as cur:
+        cur.execute("SELECT refreshed_at FROM recommender_state")
+        state = cur.fetchone()
+    full = full or state is None or state[0] is None
+
+    matrix, song_ids = load_matrix(conn)
+    if full:
+        columns = np.arange(len(song_ids))
+    else:
+        changed = changed_songs(conn, state[0])
+        columns = np.flatnonzero(np.isin(song_ids, changed))
+    stored = refresh_songs(conn, matrix, song_ids, columns)
+
+    with conn.cursor() as cur:
+        if full:
+            cur.execute("DELETE FROM song_neighbors WHERE NOT (song_id = ANY(%s))", (song_ids.tolist(),))
+        cur.execute("""
+            INSERT INTO recommender_state (id, built_at, refreshed_at) VALUES (TRUE, %s, %s)
+            ON CONFLICT (id) DO UPDATE
+            SET built_at = COALESCE(EXCLUDED.built_at, recommender_state.built_at),
+                refreshed_at = EXCLUDED.refreshed_at
+        """, (started if full else None, started))
+    conn.commit()
+    invalidate('recommendations')
+    return {'full': full, 'users': matrix.shape[0], 'songs': len(song_ids),
+            'refreshed_songs': len(columns), 'neighbors': stored}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build or refresh the song neighbor lists behind recommendations.")
+    parser.add_argument('--full', action='store_true',
+                        help="rescore every song (default: only songs with new plays since the last run)")
+    args = parser.parse_args()
+
+    started = time.monotonic()
+    with get_connection() as conn:
+        result = refresh(conn, full=args.full)
+    print("%s: %d users x %d songs, %d songs rescored, %d neighbors stored in %.1fs" % (
+        'Full build' if result['full'] else 'Refresh', result['users'], result['songs'],
+        result['refreshed_songs'], result['neighbors'], time.monotonic() - started))
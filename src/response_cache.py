@@ -0,0 +1,244 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from functools import wraps
+
+from flask import Response, request
+
+DEFAULT_TTL = int(os.getenv("CACHE_TTL", 300))
+PLAYS_INVALIDATE_INTERVAL = float(os.getenv("CACHE_PLAYS_INVALIDATE_INTERVAL", 5))
+CACHED_HEADERS = ('X-Next-Cursor', 'Link')
+
+
+class MemoryBackend:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def get_counters(self, keys):
+        with self._lock:
+            return [self._counters.get(key, 0) for key in keys]
+
+    def size(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class RedisBackend:
+    # Shares cached responses and invalidation generations across worker
+    # processes. Size bounding is left to Redis' own maxmemory-policy
+    # (configure allkeys-lru).
+
+    def __init__(self, url, prefix='music:'):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.evictions = 0
+
+    def get(self, key):
+        raw = self.client.get(self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, json.dumps(value), ex=max(int(ttl), 1))
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+    def get_counters(self, keys):
+        values = self.client.mget([self.prefix + key for key in keys])
+        return [int(value) if value is not None else 0 for value in values]
+
+    def size(self):
+        return None
+
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+
+
+class ResponseCache:
+    def __init__(self, backend, wait_timeout=10.0):
+        self.backend = backend
+        self.wait_timeout = wait_timeout
+        self._flights = {}
+        self._last_invalidated = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {'hits': 0, 'misses': 0, 'coalesced': 0})
+        self._invalidations = defaultdict(int)
+
+    def count(self, name, field):
+        with self._lock:
+            self._stats[name][field] += 1
+
+    def key_for(self, name, tags, variant):
+        generations = self.backend.get_counters(['gen:' + tag for tag in tags])
+        return '%s:%s:%s' % (name, '.'.join(str(g) for g in generations), variant)
+
+    def get_or_compute(self, name, key, ttl, compute):
+        value = self.backend.get(key)
+        if value is not None:
+            self.count(name, 'hits')
+            return value, True
+
+        # Single flight: concurrent misses on the same key wait for the first
+        # caller's result instead of all recomputing the aggregate.
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+
+        if not leader:
+            self.count(name, 'coalesced')
+            if flight.event.wait(self.wait_timeout) and flight.value is not None:
+                return flight.value, True
+            return compute(), False
+
+        self.count(name, 'misses')
+        try:
+            value = compute()
+            if value is not None:
+                self.backend.set(key, value, ttl)
+                flight.value = value
+            return value, False
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.event.set()
+
+    def invalidate(self, tag, min_interval=0):
+        # `min_interval` debounces tags that are touched on every write (plays),
+        # bounding how often they can flush the cache. The first call bumps the
+        # generation at once; calls within the interval are folded into one
+        # more bump when it ends, so the last write of a burst is not lost.
+        now = time.monotonic()
+        with self._lock:
+            if min_interval:
+                wait = self._last_invalidated.get(tag, float('-inf')) + min_interval - now
+                if wait > 0:
+                    if tag not in self._pending:
+                        timer = self._pending[tag] = threading.Timer(wait, self._invalidate_pending, (tag,))
+                        timer.daemon = True
+                        timer.start()
+                    return False
+            self._last_invalidated[tag] = now
+            self._invalidations[tag] += 1
+        self.backend.incr('gen:' + tag)
+        return True
+
+    def _invalidate_pending(self, tag):
+        with self._lock:
+            del self._pending[tag]
+            self._last_invalidated[tag] = time.monotonic()
+            self._invalidations[tag] += 1
+        self.backend.incr('gen:' + tag)
+
+    def stats(self):
+        with self._lock:
+            endpoints = {name: dict(stats) for name, stats in self._stats.items()}
+            invalidations = dict(self._invalidations)
+        for stats in endpoints.values():
+            lookups = stats['hits'] + stats['misses']
+            stats['hit_ratio'] = stats['hits'] / lookups if lookups else 0.0
+        return {
+            'backend': type(self.backend).__name__,
+            'entries': self.backend.size(),
+            'evictions': self.backend.evictions,
+            'invalidations': invalidations,
+            'endpoints': endpoints
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_response_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            if os.getenv("CACHE_BACKEND", "memory") == "redis":
+                backend = RedisBackend(os.getenv("CACHE_REDIS_URL", "redis://localhost:6379/0"))
+            else:
+                backend = MemoryBackend(int(os.getenv("CACHE_MAX_ENTRIES", 1024)))
+            _cache = ResponseCache(backend)
+        return _cache
+
+
+def invalidate(tag):
+    min_interval = PLAYS_INVALIDATE_INTERVAL if tag == 'plays' else 0
+    return get_response_cache().invalidate(tag, min_interval)
+
+
+def endpoint_ttl(name, default):
+    return int(os.getenv("CACHE_TTL_" + name.upper().replace('-', '_'), default))
+
+
+def cached_response(name, ttl=DEFAULT_TTL, tags=(), unless=None):
+    ttl = endpoint_ttl(name, ttl)
+
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if unless is not None and unless():
+                return view(*args, **kwargs)
+            cache = get_response_cache()
+            variant = request.full_path
+            key = cache.key_for(name, tags, variant)
+
+            def compute():
+                response = view(*args, **kwargs)
+                if not isinstance(response, Response) or response.status_code != 200:
+                    compute.uncached = response
+                    return None
+                return {
+                    'body': response.get_data(as_text=True),
+                    'mimetype': response.mimetype,
+                    'headers': {h: response.headers[h] for h in CACHED_HEADERS if h in response.headers}
+                }
+            compute.uncached = None
+
+            value, hit = cache.get_or_compute(name, key, ttl, compute)
+            if value is None:
+                return compute.uncached
+
+            response = Response(value['body'], mimetype=value['mimetype'])
+            response.headers.update(value['headers'])
+            response.headers['X-Cache'] = 'HIT' if hit else 'MISS'
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,233 @@
+from collections import Counter
+
+from db_pool import get_connection
+from charts import HOURLY_RETENTION_HOURS
+
+
+def rollup_statements(plays):
+    # `plays` is an iterable of (user_id, song_id, played_at) for rows that were just
+    # inserted into `plays` in the current transaction, so the counters commit
+    # or roll back together with the events themselves. Statements are built
+    # on array parameters so both the psycopg2 and the psycopg 3 (async) paths
+    # can run them unchanged.
+    song_counts = Counter()
+    daily_counts = Counter()
+    hourly_counts = Counter()
+    user_song_counts = Counter()
+    user_song_last = {}
+    for user_id, song_id, played_at in plays:
+        song_counts[song_id] += 1
+        listen = (user_id, song_id)
+        user_song_counts[listen] += 1
+        user_song_last[listen] = max(played_at, user_song_last.get(listen, played_at))
+        daily_counts[(song_id, played_at.date())] += 1
+        hourly_counts[(song_id, played_at.replace(minute=0, second=0, microsecond=0))] += 1
+
+    if not song_counts:
+        return []
+
+    # Sorted keys keep the row-lock order stable across concurrent writers.
+    song_ids, song_totals = zip(*sorted(song_counts.items()))
+    days = sorted(daily_counts.items())
+    day_songs = [song_id for (song_id, _), _ in days]
+    day_dates = [day for (_, day), _ in days]
+    day_totals = [count for _, count in days]
+    hours = sorted(hourly_counts.items())
+    hour_songs = [song_id for (song_id, _), _ in hours]
+    hour_starts = [hour for (_, hour), _ in hours]
+    hour_totals = [count for _, count in hours]
+    listens = sorted(user_song_counts.items())
+    listen_users = [user_id for (user_id, _), _ in listens]
+    listen_songs = [song_id for (_, song_id), _ in listens]
+    listen_totals = [count for _, count in listens]
+    listen_last = [user_song_last[key] for key, _ in listens]
+
+    return [
+        ("""
+            INSERT INTO song_play_counts (song_id, play_count)
+            SELECT * FROM unnest(%s::integer[], %s::bigint[])
+            ON CONFLICT (song_id) DO UPDATE
+            SET play_count = song_play_counts.play_count + EXCLUDED.play_count,
+                updated_at = clock_timestamp()
+        """, (list(song_ids), list(song_totals))),
+        ("""
+            INSERT INTO song_daily_plays (song_id, day, play_count)
+            SELECT * FROM unnest(%s::integer[], %s::date[], %s::integer[])
+            ON CONFLICT (song_id, day) DO UPDATE
+            SET play_count = song_daily_plays.play_count + EXCLUDED.play_count
+        """, (day_songs, day_dates, day_totals)),
+        ("""
+            INSERT INTO song_hourly_plays (song_id, hour, play_count)
+            SELECT * FROM unnest(%s::integer[], %s::timestamp[], %s::integer[])
+            ON CONFLICT (song_id, hour) DO UPDATE
+            SET play_count = song_hourly_plays.play_count + EXCLUDED.play_count
+        """, (hour_songs, hour_starts, hour_totals)),
+        ("""
+            INSERT INTO user_playtime (user_id, total_playtime, play_count)
+            SELECT v.user_id, COALESCE(SUM(s.duration * v.play_count), 0), SUM(v.play_count)
+            FROM unnest(%s::integer[], %s::integer[], %s::bigint[]) AS v(user_id, song_id, play_count)
+            LEFT JOIN songs s ON s.id = v.song_id
+            GROUP BY v.user_id
+            ORDER BY v.user_id
+            ON CONFLICT (user_id) DO UPDATE
+            SET total_playtime = user_playtime.total_playtime + EXCLUDED.total_playtime,
+                play_count = user_playtime.play_count + EXCLUDED.play_count
+        """, (listen_users, listen_songs, listen_totals)),
+        ("""
+            INSERT INTO user_song_plays (user_id, song_id, play_count, last_played_at)
+            SELECT * FROM unnest(%s::integer[], %s::integer[], %s::bigint[], %s::timestamp[])
+            ON CONFLICT (user_id, song_id) DO UPDATE
+            SET play_count = user_song_plays.play_count + EXCLUDED.play_count,
+                last_played_at = GREATEST(user_song_plays.last_played_at, EXCLUDED.last_played_at),
+                updated_at = clock_timestamp()
+        """, (listen_users, listen_songs, listen_totals, listen_last)),
+        ("""
+            INSERT INTO artist_play_counts (artist_id, play_count)
+            SELECT s.artist_id, SUM(v.play_count)
+            FROM unnest(%s::integer[], %s::bigint[]) AS v(song_id, play_count)
+            JOIN songs s ON s.id = v.song_id
+            WHERE s.artist_id IS NOT NULL
+            GROUP BY s.artist_id
+            ORDER BY s.artist_id
+            ON CONFLICT (artist_id) DO UPDATE
+            SET play_count = artist_play_counts.play_count + EXCLUDED.play_count
+        """, (list(song_ids), list(song_totals))),
+        ("""
+            INSERT INTO artist_daily_plays (artist_id, day, play_count)
+            SELECT s.artist_id, v.day, SUM(v.play_count)
+            FROM unnest(%s::integer[], %s::date[], %s::integer[]) AS v(song_id, day, play_count)
+            JOIN songs s ON s.id = v.song_id
+            WHERE s.artist_id IS NOT NULL
+            GROUP BY s.artist_id, v.day
+            ORDER BY s.artist_id, v.day
+            ON CONFLICT (artist_id, day) DO UPDATE
+            SET play_count = artist_daily_plays.play_count + EXCLUDED.play_count
+        """, (day_songs, day_dates, day_totals)),
+        ("""
+            INSERT INTO artist_hourly_plays (artist_id, hour, play_count)
+            SELECT s.artist_id, v.hour, SUM(v.play_count)
+            FROM unnest(%s::integer[], %s::timestamp[], %s::integer[]) AS v(song_id, hour, play_count)
+            JOIN songs s ON s.id = v.song_id
+            WHERE s.artist_id IS NOT NULL
+            GROUP BY s.artist_id, v.hour
+            ORDER BY s.artist_id, v.hour
+            ON CONFLICT (artist_id, hour) DO UPDATE
+            SET play_count = artist_hourly_plays.play_count + EXCLUDED.play_count
+        """, (hour_songs, hour_starts, hour_totals)),
+        ("""
+            INSERT INTO playlist_play_counts (playlist_id, play_count)
+            SELECT ps.playlist_id, SUM(v.play_count)
+            FROM unnest(%s::integer[], %s::bigint[]) AS v(song_id, play_count)
+            JOIN playlist_songs ps ON ps.song_id = v.song_id
+            GROUP BY ps.playlist_id
+            ORDER BY ps.playlist_id
+            ON CONFLICT (playlist_id) DO UPDATE
+            SET play_count = playlist_play_counts.play_count + EXCLUDED.play_count,
+                updated_at = clock_timestamp()
+        """, (list(song_ids), list(song_totals)))
+    ]
+
+
+def record_plays(cur, plays):
+    for query, params in rollup_statements(plays):
+        cur.execute(query, params)
+
+
+INIT_PLAYLIST_COUNTS_QUERY = """
+    INSERT INTO playlist_play_counts (playlist_id, play_count) VALUES (%s, 0)
+    ON CONFLICT (playlist_id) DO NOTHING
+"""
+
+
+def init_playlist_counts(cur, playlist_id):
+    cur.execute(INIT_PLAYLIST_COUNTS_QUERY, (playlist_id,))
+
+
+def rebuild_rollups(conn):
+    with conn.cursor() as cur:
+        cur.execute("""
+            TRUNCATE song_play_counts, song_daily_plays, song_hourly_plays, playlist_play_counts,
+                     artist_play_counts, artist_daily_plays, artist_hourly_plays, user_playtime,
+                     user_song_plays, playlist_follower_counts
+        """)
+        cur.execute("""
+            INSERT INTO song_play_counts (song_id, play_count)
+            SELECT song_id, COUNT(*)
+            FROM plays
+            GROUP BY song_id
+        """)
+        cur.execute("""
+            INSERT INTO song_daily_plays (song_id, day, play_count)
+            SELECT song_id, played_at::date, COUNT(*)
+            FROM plays
+            GROUP BY song_id, played_at::date
+        """)
+        cur.execute("""
+            INSERT INTO song_hourly_plays (song_id, hour, play_count)
+            SELECT song_id, date_trunc('hour', played_at), COUNT(*)
+            FROM plays
+            WHERE played_at > date_trunc('hour', LOCALTIMESTAMP) - %s * INTERVAL '1 hour'
+            GROUP BY song_id, date_trunc('hour', played_at)
+        """, (HOURLY_RETENTION_HOURS,))
+        cur.execute("""
+            INSERT INTO artist_play_counts (artist_id, play_count)
+            SELECT s.artist_id, SUM(c.play_count)
+            FROM song_play_counts c
+            JOIN songs s ON s.id = c.song_id
+            WHERE s.artist_id IS NOT NULL
+            GROUP BY s.artist_id
+        """)
+        cur.execute("""
+            INSERT INTO artist_daily_plays (artist_id, day, play_count)
+            SELECT s.artist_id, d.day, SUM(d.play_count)
+            FROM song_daily_plays d
+            JOIN songs s ON s.id = d.song_id
+            WHERE s.artist_id IS NOT NULL
+            GROUP BY s.artist_id, d.day
+        """)
+        cur.execute("""
+            INSERT INTO artist_hourly_plays (artist_id, hour, play_count)
+            SELECT s.artist_id, h.hour, SUM(h.play_count)
+            FROM song_hourly_plays h
+            JOIN songs s ON s.id = h.song_id
+            WHERE s.artist_id IS NOT NULL
+            GROUP BY s.artist_id, h.hour
+        """)
+        cur.execute("""
+            INSERT INTO playlist_play_counts (playlist_id, play_count)
+            SELECT p.id, COALESCE(SUM(c.play_count), 0)
+            FROM playlists p
+            LEFT JOIN playlist_songs ps ON ps.playlist_id = p.id
+            LEFT JOIN song_play_counts c ON c.song_id = ps.song_id
+            GROUP BY p.id
+        """)
+        cur.execute("""
+            INSERT INTO user_playtime (user_id, total_playtime, play_count)
+            SELECT u.id, COALESCE(SUM(s.duration), 0), COUNT(p.user_id)
+            FROM users u
+            LEFT JOIN plays p ON p.user_id = u.id
+            LEFT JOIN songs s ON s.id = p.song_id
+            GROUP BY u.id
+        """)
+        cur.execute("""
+            INSERT INTO user_song_plays (user_id, song_id, play_count, last_played_at)
+            SELECT user_id, song_id, COUNT(*), MAX(played_at)
+            FROM plays
+            WHERE user_id IS NOT NULL AND song_id IS NOT NULL
+            GROUP BY user_id, song_id
+        """)
+        cur.execute("""
+            INSERT INTO playlist_follower_counts (playlist_id, follower_count)
+            SELECT p.id, COUNT(f.user_id)
+            FROM playlists p
+            LEFT JOIN follows f ON f.playlist_id = p.id
+            GROUP BY p.id
+        """)
+    conn.commit()
+
+
+if __name__ == '__main__':
+    print("Rebuilding play-count rollups from plays...")
+    with get_connection() as conn:
+        rebuild_rollups(conn)
+    print("Rollups rebuilt successfully!")
@@ -0,0 +1,80 @@
+import re
+
+from db_pool import get_connection
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+# Songs carry a denormalized `search_text` (lower-cased title + artist name)
+# and a weighted `search_vector`, both kept current by triggers (see
+# schema.sql). Matches come from three index-backed predicates:
+#   * prefix full-text match on every token ("mid dre" -> mid:* & dre:*)
+#   * trigram word similarity, which tolerates typos ("midnite dreams")
+#   * plain substring match, served by the same trigram index
+# and are ranked by full-text rank plus trigram similarity.
+SEARCH_QUERY = """
+    SELECT * FROM (
+        SELECT s.id, s.title, s.artist_id, s.duration, s.album_cover, a.name as artist_name,
+               (ts_rank_cd(s.search_vector, to_tsquery('simple', %(tsquery)s))
+                + word_similarity(%(term)s, s.search_text))::float8 as rank
+        FROM songs s
+        JOIN artists a ON s.artist_id = a.id
+        WHERE {match}
+    ) ranked
+    {after}
+    ORDER BY rank DESC, id
+    LIMIT %(limit)s
+"""
+
+
+def prefix_tsquery(term):
+    tokens = TOKEN_RE.findall(term.lower())
+    return ' & '.join(token + ':*' for token in tokens)
+
+
+def search_query(term, limit, after=None, offset=0):
+    term = term.strip().lower()
+    tsquery = prefix_tsquery(term)
+
+    match = ["s.search_text LIKE %(pattern)s"]
+    if tsquery:
+        match.append("s.search_vector @@ to_tsquery('simple', %(tsquery)s)")
+    if len(term) >= 3:
+        match.append("%(term)s <%% s.search_text")
+
+    query = SEARCH_QUERY.format(
+        match=" OR ".join(match),
+        after="WHERE rank < %(rank)s OR (rank = %(rank)s AND id > %(id)s)" if after else ""
+    )
+    if offset:
+        query += " OFFSET %(offset)s"
+
+    params = {
+        'tsquery': tsquery,
+        'term': term,
+        'pattern': '%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%',
+        'limit': limit,
+        'offset': offset
+    }
+    if after:
+        params['rank'], params['id'] = after
+    return query, params
+
+
+def search_songs(cur, term, limit, after=None, offset=0):
+    cur.execute(*search_query(term, limit, after, offset))
+    return cur.fetchall()
+
+
+def rebuild_search_index(conn):
+    with conn.cursor() as cur:
+        # Touching the title fires the songs trigger, which recomputes both
+        # search columns from the current artist name.
+        cur.execute("UPDATE songs SET title = title")
+    conn.commit()
+
+
+if __name__ == '__main__':
+    print("Rebuilding song search columns...")
+    with get_connection() as conn:
+        rebuild_search_index(conn)
+    print("Search index rebuilt successfully!")
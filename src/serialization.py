@@ -0,0 +1,237 @@
+import argparse
+import gzip
+import json
+import os
+import time
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+
+import orjson
+from flask.json.provider import JSONProvider
+from starlette.datastructures import Headers, MutableHeaders
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# One JSON path for both apps: orjson encodes datetimes natively (ISO 8601,
+# the same text isoformat() gave), so row mappers hand over raw values and
+# a whole list is encoded in a single call. JSON_ENCODER=stdlib switches
+# back to the json module, e.g. to benchmark against it.
+JSON_ENCODER = os.getenv("JSON_ENCODER", "orjson")
+# Let Postgres build the whole body of the unpaged /playlists and
+# /user-playtime lists (json_agg) instead of mapping rows in Python.
+JSON_FROM_DB = os.getenv("JSON_FROM_DB", "false").lower() == "true"
+
+COMPRESSION = [e.strip() for e in os.getenv("COMPRESSION", "br,gzip").split(',') if e.strip()]
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", 5))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", 4))
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/')
+
+ORJSON_OPTIONS = orjson.OPT_SORT_KEYS
+
+
+def json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError("Object of type %s is not JSON serializable" % type(value).__name__)
+
+
+def orjson_default(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    raise TypeError
+
+
+def dumps(obj):
+    # Always bytes, compact, keys sorted like Flask's default provider.
+    if JSON_ENCODER == 'stdlib':
+        return json.dumps(obj, default=json_default, separators=(',', ':'), sort_keys=True).encode()
+    return orjson.dumps(obj, default=orjson_default, option=ORJSON_OPTIONS)
+
+
+class FastJSONProvider(JSONProvider):
+    mimetype = 'application/json'
+
+    def encode(self, obj):
+        return dumps(obj)
+
+    def dumps(self, obj, **kwargs):
+        return self.encode(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.encode(obj) + b'\n', mimetype=self.mimetype)
+
+
+def available_encodings():
+    return [e for e in COMPRESSION if e == 'gzip' or (e == 'br' and brotli is not None)]
+
+
+def negotiate(accept_encoding):
+    # Best encoding the client accepts, by q-value; ties go to the order of
+    # COMPRESSION (brotli first by default).
+    if not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        weights[name.strip().lower()] = q
+    best, best_q = None, 0.0
+    for encoding in available_encodings():
+        q = weights.get(encoding, weights.get('*', 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compressible(mimetype):
+    return bool(mimetype) and mimetype.startswith(COMPRESSIBLE_TYPES)
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL)
+
+
+def init_app(app):
+    # Flask: compresses buffered responses after the view has run. Streamed
+    # bodies go out as they are, chunk by chunk.
+    from flask import request
+
+    @app.after_request
+    def compress_response(response):
+        if not compressible(response.mimetype):
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers:
+            return response
+        if response.status_code < 200 or response.status_code in (204, 304):
+            return response
+        body = response.get_data()
+        encoding = negotiate(request.headers.get('Accept-Encoding'))
+        if encoding is None or len(body) < COMPRESS_MIN_SIZE:
+            return response
+        response.set_data(compress(body, encoding))
+        response.headers['Content-Encoding'] = encoding
+        return response
+
+
+class CompressionMiddleware:
+    # ASGI counterpart of init_app. Only single-message bodies (every
+    # non-streaming Response) are compressed.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate(Headers(scope=scope).get('accept-encoding'))
+        pending = None
+
+        async def send_compressed(message):
+            nonlocal pending
+            if message['type'] == 'http.response.start':
+                pending = message
+                return
+            if message['type'] == 'http.response.body' and pending is not None:
+                start, pending = pending, None
+                headers = MutableHeaders(scope=start)
+                if compressible(headers.get('content-type')):
+                    headers.add_vary_header('Accept-Encoding')
+                    body = message.get('body', b'')
+                    if encoding and not message.get('more_body') and 'content-encoding' not in headers \
+                            and start['status'] not in (204, 304) and len(body) >= COMPRESS_MIN_SIZE:
+                        body = compress(body, encoding)
+                        headers['Content-Encoding'] = encoding
+                        headers['Content-Length'] = str(len(body))
+                        message = dict(message, body=body)
+                await send(start)
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
+
+
+def sample_rows(count):
+    # Rows shaped like PLAYLIST_COLUMNS and USER_PLAYTIME_COLUMNS.
+    now = datetime(2024, 6, 1, 12, 0, 0)
+    playlists = [(i, 'Playlist %d' % i, i % 7 == 0, i % 500 + 1, now - timedelta(minutes=i),
+                  'https://picsum.photos/300/300?random=%d' % (i % 20), 'user%d' % (i % 500), i * 37 % 10007)
+                 for i in range(1, count + 1)]
+    users = [(i, 'user%d' % i, 'user%d@example.com' % i, 'https://picsum.photos/200/200?random=%d' % (i % 20),
+              now - timedelta(hours=i), (count - i) * 211) for i in range(1, count + 1)]
+    return playlists, users
+
+
+def legacy_playlist(row):
+    # The mapping as it was before this module: isoformat() per row.
+    return {'id': row[0], 'name': row[1], 'is_curated': row[2], 'created_by': row[3],
+            'created_at': row[4].isoformat() if row[4] else None, 'cover': row[5],
+            'creator_username': row[6], 'play_count': row[7]}
+
+
+def legacy_user_playtime(row):
+    return {'user': {'id': row[0], 'username': row[1], 'email': row[2], 'profile_image': row[3],
+                     'created_at': row[4].isoformat() if row[4] else None},
+            'total_playtime': row[5]}
+
+
+def time_call(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+if __name__ == '__main__':
+    # Micro-benchmark of the serialization path alone (no database, no HTTP):
+    #   python serialization.py --rows 10000
+    # For end-to-end numbers run benchmark.py --only 'full' against servers
+    # started with JSON_ENCODER=stdlib COMPRESSION= and with the defaults.
+    import queries
+
+    parser = argparse.ArgumentParser(description="Compare the stdlib and orjson JSON paths and compression.")
+    parser.add_argument('--rows', type=int, default=10000, help="rows per list")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per measurement (best is kept)")
+    args = parser.parse_args()
+
+    playlists, users = sample_rows(args.rows)
+    cases = [
+        ('/playlists', playlists, legacy_playlist, queries.playlist_from_row),
+        ('/user-playtime', users, legacy_user_playtime, queries.user_playtime_from_row)
+    ]
+    print("%-16s %-8s %10s %10s" % ('list', 'path', 'ms', 'bytes'))
+    for name, rows, legacy, from_row in cases:
+        legacy_dumps = lambda: json.dumps([legacy(r) for r in rows], separators=(',', ':'), sort_keys=True).encode()
+        fast_dumps = lambda: orjson.dumps([from_row(r) for r in rows], default=orjson_default, option=ORJSON_OPTIONS)
+        legacy_time, body = time_call(legacy_dumps, args.repeat)
+        fast_time, fast_body = time_call(fast_dumps, args.repeat)
+        if orjson.loads(body) != orjson.loads(fast_body):
+            raise SystemExit("%s: orjson output differs from the stdlib output" % name)
+        print("%-16s %-8s %10.2f %10d" % (name, 'stdlib', legacy_time * 1000, len(body)))
+        print("%-16s %-8s %10.2f %10d" % (name, 'orjson', fast_time * 1000, len(fast_body)))
+        for encoding in ('gzip', 'br'):
+            if encoding == 'br' and brotli is None:
+                print("%-16s %-8s %10s %10s" % (name, 'br', '-', 'not installed'))
+                continue
+            seconds, compressed = time_call(lambda: compress(fast_body, encoding), args.repeat)
+            print("%-16s %-8s %10.2f %10d" % (name, encoding, seconds * 1000, len(compressed)))
@@ -0,0 +1,581 @@
+import atexit
+import heapq
+import math
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+
+import entity_cache
+from charts import HOURLY_RETENTION_HOURS
+from db_pool import get_connection
+from pagination import int_arg
+
+# Approximate listener analytics, fed by every committed play (POST /plays,
+# /plays/batch and the play buffer) instead of COUNT(DISTINCT user_id) over
+# plays:
+#
+#   unique listeners  HyperLogLog per song per day and per playlist per day
+#                     (a play counts for every playlist holding the song, like
+#                     playlist_play_counts). 2^SKETCH_HLL_PRECISION one-byte
+#                     registers, relative standard error 1.04 / sqrt(registers):
+#                     1.6% at the default precision of 12. Sketches of a few
+#                     listeners are stored sparse, so quiet songs cost bytes.
+#   trending          count-min sketch per hour (SKETCH_CMS_DEPTH rows of
+#                     SKETCH_CMS_WIDTH counters) plus the TRENDING_CANDIDATES
+#                     songs with the highest estimates. An estimate never
+#                     undercounts and overcounts by more than e / width of the
+#                     hour's plays (0.03% at the default width) with
+#                     probability 1 - e^-depth (98% at depth 4).
+#
+# Each worker records into its own in-memory sketches and merges them into
+# Postgres every SKETCH_FLUSH_INTERVAL seconds (or once SKETCH_MAX_PENDING
+# song-days are pending): HyperLogLogs merge by register-wise max and
+# count-min sketches by addition, so the stored sketch is the same whichever
+# workers saw the plays. Readers see plays after at most one flush interval.
+SKETCHES_ENABLED = os.getenv("SKETCHES_ENABLED", "true").lower() == "true"
+HLL_PRECISION = int(os.getenv("SKETCH_HLL_PRECISION", 12))
+CMS_WIDTH = int(os.getenv("SKETCH_CMS_WIDTH", 8192))
+CMS_DEPTH = int(os.getenv("SKETCH_CMS_DEPTH", 4))
+TRENDING_CANDIDATES = int(os.getenv("TRENDING_CANDIDATES", 200))
+FLUSH_INTERVAL = float(os.getenv("SKETCH_FLUSH_INTERVAL", 10))
+MAX_PENDING = int(os.getenv("SKETCH_MAX_PENDING", 50000))
+RETENTION_DAYS = int(os.getenv("SKETCH_RETENTION_DAYS", 90))
+
+DEFAULT_DAYS = 7
+DEFAULT_HOURS = 24
+DEFAULT_LIMIT = 10
+
+MASK64 = (1 << 64) - 1
+
+SPARSE, DENSE = 0, 1
+
+# kind -> (sketch table, id column)
+LISTENER_TABLES = {
+    'songs': ('song_listener_sketches', 'song_id'),
+    'playlists': ('playlist_listener_sketches', 'playlist_id')
+}
+
+LISTENER_SKETCHES_QUERY = """
+    SELECT day, registers
+    FROM {table}
+    WHERE {column} = %s AND day > CURRENT_DATE - %s
+    ORDER BY day
+"""
+
+SONG_WINDOW_PLAYS_QUERY = """
+    SELECT COALESCE(SUM(play_count), 0)
+    FROM song_daily_plays
+    WHERE song_id = %s AND day > CURRENT_DATE - %s
+"""
+
+# Buckets of the requested window plus the window before it.
+TREND_SKETCHES_QUERY = """
+    SELECT bucket > date_trunc('hour', LOCALTIMESTAMP) - %s * INTERVAL '1 hour' as recent, counters, candidates
+    FROM trend_sketches
+    WHERE bucket > date_trunc('hour', LOCALTIMESTAMP) - %s * INTERVAL '1 hour'
+"""
+
+
+def mix64(value):
+    # splitmix64 finalizer: a fixed hash, so every worker (and every run)
+    # puts the same id in the same register and counter.
+    value = (value + 0x9E3779B97F4A7C15) & MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
+
+
+class HyperLogLog:
+    # Registers live in a dict {index: rank} while fewer than a quarter are
+    # set (the sparse encoding is 4 bytes a register) and in a uint8 array
+    # after that.
+    __slots__ = ('precision', 'sparse', 'registers')
+
+    def __init__(self, precision=HLL_PRECISION):
+        self.precision = precision
+        self.sparse = {}
+        self.registers = None
+
+    @property
+    def size(self):
+        return 1 << self.precision
+
+    def add(self, value):
+        h = mix64(value)
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if self.registers is not None:
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+        elif rank > self.sparse.get(index, 0):
+            self.sparse[index] = rank
+            if len(self.sparse) * 4 >= self.size:
+                self._densify()
+
+    def _densify(self):
+        self.registers = np.zeros(self.size, dtype=np.uint8)
+        if self.sparse:
+            self.registers[np.fromiter(self.sparse, dtype=np.int64)] = np.fromiter(self.sparse.values(), dtype=np.uint8)
+        self.sparse = None
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("cannot merge HyperLogLogs of precision %d and %d" % (self.precision, other.precision))
+        if self.registers is None and other.registers is None:
+            for index, rank in other.sparse.items():
+                if rank > self.sparse.get(index, 0):
+                    self.sparse[index] = rank
+            if len(self.sparse) * 4 >= self.size:
+                self._densify()
+            return self
+        if self.registers is None:
+            self._densify()
+        if other.registers is None:
+            for index, rank in other.sparse.items():
+                if rank > self.registers[index]:
+                    self.registers[index] = rank
+        else:
+            np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def estimate(self):
+        m = self.size
+        if self.registers is None:
+            ranks = np.fromiter(self.sparse.values(), dtype=np.float64, count=len(self.sparse))
+            zeros = m - len(ranks)
+            harmonic = zeros + np.exp2(-ranks).sum()
+        else:
+            zeros = int(np.count_nonzero(self.registers == 0))
+            harmonic = np.exp2(-self.registers.astype(np.float64)).sum()
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / harmonic
+        # Linear counting is more accurate while many registers are empty.
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_bytes(self):
+        if self.registers is not None:
+            return bytes((DENSE, self.precision)) + self.registers.tobytes()
+        entries = np.array(sorted((index << 8) | rank for index, rank in self.sparse.items()), dtype='<u4')
+        return bytes((SPARSE, self.precision)) + entries.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        data = bytes(data)
+        sketch = cls(data[1])
+        if data[0] == DENSE:
+            sketch.sparse = None
+            sketch.registers = np.frombuffer(data, dtype=np.uint8, offset=2).copy()
+            if len(sketch.registers) != sketch.size:
+                raise ValueError("corrupt HyperLogLog: %d registers" % len(sketch.registers))
+        else:
+            entries = np.frombuffer(data, dtype='<u4', offset=2)
+            sketch.sparse = dict(zip((entries >> 8).tolist(), (entries & 0xFF).tolist()))
+        return sketch
+
+
+class CountMinSketch:
+    __slots__ = ('counters', 'rows')
+
+    def __init__(self, depth=CMS_DEPTH, width=CMS_WIDTH, counters=None):
+        if width & (width - 1):
+            raise ValueError("count-min width must be a power of two")
+        self.counters = np.zeros((depth, width), dtype=np.uint64) if counters is None else counters
+        self.rows = np.arange(depth)
+
+    def _slots(self, value):
+        # Kirsch-Mitzenmacher: the two halves of one hash give every row's slot.
+        h = mix64(value)
+        low, high = h & 0xFFFFFFFF, h >> 32
+        width = self.counters.shape[1]
+        return [(low + row * high) & (width - 1) for row in range(self.counters.shape[0])]
+
+    def add(self, value, count=1):
+        slots = self._slots(value)
+        self.counters[self.rows, slots] += count
+        return int(self.counters[self.rows, slots].min())
+
+    def estimate(self, value):
+        return int(self.counters[self.rows, self._slots(value)].min())
+
+    def total(self):
+        return int(self.counters[0].sum())
+
+    def error_bound(self):
+        # Overcount bound that holds with probability 1 - e^-depth.
+        return int(math.ceil(math.e / self.counters.shape[1] * self.total()))
+
+    def merge(self, other):
+        if other.counters.shape != self.counters.shape:
+            raise ValueError("cannot merge count-min sketches of shape %s and %s"
+                             % (self.counters.shape, other.counters.shape))
+        self.counters += other.counters
+        return self
+
+    def to_bytes(self):
+        return self.counters.astype('<u4').tobytes()
+
+    @classmethod
+    def from_bytes(cls, data, depth=CMS_DEPTH, width=CMS_WIDTH):
+        counters = np.frombuffer(bytes(data), dtype='<u4')
+        if len(counters) != depth * width:
+            # SKETCH_CMS_DEPTH / SKETCH_CMS_WIDTH changed: prune or truncate
+            # trend_sketches before serving the new shape.
+            raise ValueError("stored count-min sketch has %d counters, expected %d" % (len(counters), depth * width))
+        return cls(depth, width, counters.reshape(depth, width).astype(np.uint64))
+
+
+class TopK:
+    # The `capacity` keys with the highest count-min estimates seen so far.
+    # Estimates only grow within a bucket, so a min-heap with lazily
+    # discarded stale entries is enough.
+    __slots__ = ('capacity', 'estimates', '_heap')
+
+    def __init__(self, capacity=TRENDING_CANDIDATES):
+        self.capacity = capacity
+        self.estimates = {}
+        self._heap = []
+
+    def offer(self, key, estimate):
+        if key in self.estimates:
+            self.estimates[key] = estimate
+            heapq.heappush(self._heap, (estimate, key))
+            if len(self._heap) > 2 * self.capacity + 64:
+                self._heap = [(count, k) for k, count in self.estimates.items()]
+                heapq.heapify(self._heap)
+            return
+        if len(self.estimates) >= self.capacity:
+            while self._heap[0][0] != self.estimates.get(self._heap[0][1]):
+                heapq.heappop(self._heap)
+            if estimate <= self._heap[0][0]:
+                return
+            del self.estimates[heapq.heappop(self._heap)[1]]
+        self.estimates[key] = estimate
+        heapq.heappush(self._heap, (estimate, key))
+
+
+def heavy_hitters(sketch, candidates, limit):
+    # [(song_id, estimate)] for the `limit` candidates estimated highest.
+    ranked = sorted(((key, sketch.estimate(key)) for key in candidates), key=lambda item: (-item[1], item[0]))
+    return [item for item in ranked[:limit] if item[1] > 0]
+
+
+class SketchBatch:
+    # What one worker saw since its last flush.
+    def __init__(self):
+        self.listeners = {}
+        self.trends = {}
+
+    def record(self, user_id, song_id, played_at):
+        key = (song_id, played_at.date())
+        sketch = self.listeners.get(key)
+        if sketch is None:
+            sketch = self.listeners[key] = HyperLogLog()
+        sketch.add(user_id)
+        bucket = played_at.replace(minute=0, second=0, microsecond=0)
+        trend = self.trends.get(bucket)
+        if trend is None:
+            trend = self.trends[bucket] = (CountMinSketch(), TopK())
+        trend[1].offer(song_id, trend[0].add(song_id))
+
+    def merge(self, other):
+        for key, sketch in other.listeners.items():
+            if key in self.listeners:
+                self.listeners[key].merge(sketch)
+            else:
+                self.listeners[key] = sketch
+        for bucket, (counts, top) in other.trends.items():
+            if bucket in self.trends:
+                mine = self.trends[bucket]
+                mine[0].merge(counts)
+                for song_id in top.estimates:
+                    mine[1].offer(song_id, mine[0].estimate(song_id))
+            else:
+                self.trends[bucket] = (counts, top)
+
+    def __len__(self):
+        return len(self.listeners)
+
+
+def merge_listener_sketches(cur, table, column, sketches):
+    # Register-wise max into `table`. New rows are inserted as they are;
+    # existing ones are locked (in key order, like the rollups) and merged,
+    # so concurrent flushes from other workers are never overwritten.
+    keys = sorted(sketches)
+    if not keys:
+        return
+    ids, days = [k[0] for k in keys], [k[1] for k in keys]
+    cur.execute("""
+        INSERT INTO {table} ({column}, day, registers)
+        SELECT * FROM unnest(%s::integer[], %s::date[], %s::bytea[])
+        ON CONFLICT ({column}, day) DO NOTHING
+        RETURNING {column}, day
+    """.format(table=table, column=column), (ids, days, [sketches[k].to_bytes() for k in keys]))
+    inserted = set(map(tuple, cur.fetchall()))
+    existing = [k for k in keys if k not in inserted]
+    if not existing:
+        return
+    cur.execute("""
+        SELECT t.{column}, t.day, t.registers
+        FROM {table} t
+        JOIN unnest(%s::integer[], %s::date[]) AS v(id, day) ON t.{column} = v.id AND t.day = v.day
+        ORDER BY t.{column}, t.day
+        FOR UPDATE OF t
+    """.format(table=table, column=column), ([k[0] for k in existing], [k[1] for k in existing]))
+    rows = cur.fetchall()
+    merged = [HyperLogLog.from_bytes(registers).merge(sketches[(entity_id, day)]).to_bytes()
+              for entity_id, day, registers in rows]
+    cur.execute("""
+        UPDATE {table} t SET registers = v.registers
+        FROM unnest(%s::integer[], %s::date[], %s::bytea[]) AS v(id, day, registers)
+        WHERE t.{column} = v.id AND t.day = v.day
+    """.format(table=table, column=column), ([row[0] for row in rows], [row[1] for row in rows], merged))
+
+
+def playlist_sketches(cur, listeners):
+    # A song's listeners are listeners of every playlist that holds it.
+    sketches = {}
+    cur.execute("SELECT playlist_id, song_id FROM playlist_songs WHERE song_id = ANY(%s)",
+                (sorted({song_id for song_id, _ in listeners}),))
+    playlists = {}
+    for playlist_id, song_id in cur.fetchall():
+        playlists.setdefault(song_id, []).append(playlist_id)
+    for (song_id, day), sketch in listeners.items():
+        for playlist_id in playlists.get(song_id, ()):
+            key = (playlist_id, day)
+            if key in sketches:
+                sketches[key].merge(sketch)
+            else:
+                sketches[key] = HyperLogLog(sketch.precision).merge(sketch)
+    return sketches
+
+
+def merge_trend_sketches(cur, trends):
+    for bucket in sorted(trends):
+        counts, top = trends[bucket]
+        candidates = heavy_hitters(counts, top.estimates, TRENDING_CANDIDATES)
+        cur.execute("""
+            INSERT INTO trend_sketches (bucket, counters, candidates) VALUES (%s, %s, %s)
+            ON CONFLICT (bucket) DO NOTHING
+            RETURNING bucket
+        """, (bucket, counts.to_bytes(), [song_id for song_id, _ in candidates]))
+        if cur.fetchone():
+            continue
+        cur.execute("SELECT counters, candidates FROM trend_sketches WHERE bucket = %s FOR UPDATE", (bucket,))
+        stored, stored_candidates = cur.fetchone()
+        merged = CountMinSketch.from_bytes(stored).merge(counts)
+        candidates = heavy_hitters(merged, set(stored_candidates) | set(top.estimates), TRENDING_CANDIDATES)
+        cur.execute("UPDATE trend_sketches SET counters = %s, candidates = %s WHERE bucket = %s",
+                    (merged.to_bytes(), [song_id for song_id, _ in candidates], bucket))
+
+
+def write_batch(conn, batch):
+    with conn.cursor() as cur:
+        merge_listener_sketches(cur, *LISTENER_TABLES['songs'], batch.listeners)
+        merge_listener_sketches(cur, *LISTENER_TABLES['playlists'], playlist_sketches(cur, batch.listeners))
+        merge_trend_sketches(cur, batch.trends)
+
+
+class SketchRecorder:
+    # Per-process collector with a background flush thread, shaped like
+    # play_buffer.PlayBuffer.
+    def __init__(self, flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._batch = SketchBatch()
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._closed = False
+        self._stats = {'recorded': 0, 'flushes': 0, 'failed_flushes': 0, 'dropped': 0}
+
+    def record(self, plays):
+        # `plays` are committed (user_id, song_id, played_at) rows.
+        with self._cond:
+            for user_id, song_id, played_at in plays:
+                self._batch.record(user_id, song_id, played_at)
+                self._stats['recorded'] += 1
+            closed = self._closed
+            if not closed and self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='sketch-flush', daemon=True)
+                self._thread.start()
+            if len(self._batch) >= self.max_pending:
+                self._cond.notify_all()
+        # Plays flushed by the play buffer at exit may arrive after close().
+        if closed:
+            self.flush()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = time.monotonic() + self.flush_interval
+                while not self._closed and len(self._batch) < self.max_pending:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                closed = self._closed
+            self.flush()
+            if closed:
+                return
+
+    def flush(self):
+        with self._flush_lock:
+            with self._cond:
+                batch, self._batch = self._batch, SketchBatch()
+            if not batch.listeners:
+                return 0
+            try:
+                with get_connection() as conn:
+                    write_batch(conn, batch)
+            except Exception:
+                with self._cond:
+                    self._stats['failed_flushes'] += 1
+                    # Merging is idempotent for listeners and additive for
+                    # counts, so a failed batch is folded back into the next
+                    # one unless that would exceed the memory bound.
+                    if len(batch) + len(self._batch) <= 2 * self.max_pending:
+                        batch.merge(self._batch)
+                        self._batch = batch
+                    else:
+                        self._stats['dropped'] += len(batch)
+                return 0
+            with self._cond:
+                self._stats['flushes'] += 1
+            return len(batch)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            thread = self._thread
+            self._cond.notify_all()
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def stats(self):
+        with self._cond:
+            return dict(self._stats, pending=len(self._batch), max_pending=self.max_pending)
+
+
+_recorder = None
+_recorder_pid = None
+_recorder_lock = threading.Lock()
+
+
+def get_recorder():
+    global _recorder, _recorder_pid
+    with _recorder_lock:
+        if _recorder is None or _recorder_pid != os.getpid():
+            _recorder = SketchRecorder()
+            _recorder_pid = os.getpid()
+            atexit.register(_recorder.close)
+        return _recorder
+
+
+def record_plays(plays):
+    # Call after the transaction that inserted `plays` has committed.
+    if SKETCHES_ENABLED:
+        get_recorder().record(plays)
+
+
+def stats_days(args):
+    return max(1, min(int_arg(args, 'days', DEFAULT_DAYS), RETENTION_DAYS))
+
+
+def listener_stats(kind, entity_id, args):
+    # entity_cache loader (see entity_cache.run_sync): unique listeners of a
+    # song or playlist per day and over the last `days` days, next to the
+    # exact play count from the daily rollup. None if there is no such entity.
+    days = stats_days(args)
+    found = yield from entity_cache.load(kind, [entity_id])
+    if entity_id not in found:
+        return None
+    rows = yield LISTENER_SKETCHES_QUERY.format(table=LISTENER_TABLES[kind][0], column=LISTENER_TABLES[kind][1]), \
+        (entity_id, days)
+    total = HyperLogLog()
+    daily = []
+    for day, registers in rows:
+        sketch = HyperLogLog.from_bytes(registers)
+        daily.append({'day': day.isoformat(), 'unique_listeners': sketch.estimate()})
+        total.merge(sketch)
+    result = {
+        'id': entity_id,
+        'days': days,
+        'unique_listeners': total.estimate(),
+        'daily': daily,
+        'relative_error': round(1.04 / math.sqrt(total.size), 4)
+    }
+    if kind == 'songs':
+        plays = yield SONG_WINDOW_PLAYS_QUERY, (entity_id, days)
+        result['plays'] = int(plays[0][0])
+    return result
+
+
+def trending_hours(args):
+    return max(1, min(int_arg(args, 'hours', DEFAULT_HOURS), HOURLY_RETENTION_HOURS))
+
+
+def trending_limit(args):
+    return max(1, min(int_arg(args, 'limit', DEFAULT_LIMIT), TRENDING_CANDIDATES))
+
+
+def trending(args):
+    # entity_cache loader: the heavy hitters of the last `hours` hours (current
+    # hour included) with their estimated plays, next to the estimate for the
+    # `hours` before that so clients can tell rising songs from steady ones.
+    hours, limit = trending_hours(args), trending_limit(args)
+    rows = yield TREND_SKETCHES_QUERY, (hours, 2 * hours)
+    current, previous = CountMinSketch(), CountMinSketch()
+    candidates = set()
+    for recent, counters, bucket_candidates in rows:
+        if recent:
+            current.merge(CountMinSketch.from_bytes(counters))
+            candidates.update(bucket_candidates)
+        else:
+            previous.merge(CountMinSketch.from_bytes(counters))
+    top = heavy_hitters(current, candidates, limit)
+    songs = yield from entity_cache.load('songs', [song_id for song_id, _ in top])
+    artists = yield from entity_cache.load('artists', {s.artist_id for s in songs.values() if s.artist_id is not None})
+    results = []
+    for song_id, plays in top:
+        song = songs.get(song_id)
+        if song is None:
+            continue
+        artist = artists.get(song.artist_id)
+        results.append({
+            'id': song.id,
+            'title': song.title,
+            'artist': artist.name if artist else None,
+            'album_cover': song.album_cover,
+            'plays': plays,
+            'previous_plays': previous.estimate(song_id)
+        })
+    return {'hours': hours, 'songs': results, 'max_overcount': current.error_bound()}
+
+
+def prune(conn):
+    with conn.cursor() as cur:
+        for table, _ in LISTENER_TABLES.values():
+            cur.execute("DELETE FROM %s WHERE day <= CURRENT_DATE - %%s" % table, (RETENTION_DAYS,))
+        cur.execute(
+            "DELETE FROM trend_sketches WHERE bucket <= date_trunc('hour', LOCALTIMESTAMP) - %s * INTERVAL '1 hour'",
+            (2 * HOURLY_RETENTION_HOURS,)
+        )
+    conn.commit()
+
+
+if __name__ == '__main__':
+    # Run daily from cron, next to `python charts.py prune`.
+    if sys.argv[1:] not in ([], ['prune']):
+        sys.exit("usage: python sketches.py [prune]")
+    print("Pruning listener sketches older than %dd and trend sketches older than %dh..."
+          % (RETENTION_DAYS, 2 * HOURLY_RETENTION_HOURS))
+    with get_connection() as conn:
+        prune(conn)
+    print("Sketches pruned!")
@@ -0,0 +1,102 @@
+import os
+import uuid
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+STREAM_ITERSIZE = int(os.getenv("STREAM_ITERSIZE", 2000))
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", 65536))
+
+
+def stream_format(args, accept):
+    # Only full (unpaged) lists stream: a page's next cursor must be known
+    # before the headers go out. NDJSON is chosen by the Accept header, a
+    # streamed JSON array (same body as the buffered one) by ?stream=1.
+    if 'per_page' in args or 'cursor' in args:
+        return None
+    if NDJSON_MIMETYPE in (accept or ''):
+        return 'ndjson'
+    if args.get('stream') in ('1', 'true'):
+        return 'json'
+    return None
+
+
+def stream_mimetype(fmt):
+    return NDJSON_MIMETYPE if fmt == 'ndjson' else 'application/json'
+
+
+def cursor_name():
+    return 'stream_%s' % uuid.uuid4().hex
+
+
+class StreamEncoder:
+    # Turns items into body chunks of roughly STREAM_CHUNK_SIZE bytes. The
+    # first item is flushed on its own so the client sees bytes as soon as
+    # the first rows arrive from the server-side cursor. `dumps` returns bytes.
+    def __init__(self, fmt, dumps, chunk_size=STREAM_CHUNK_SIZE):
+        self.fmt = fmt
+        self.dumps = dumps
+        self.chunk_size = chunk_size
+        self._parts = [] if fmt == 'ndjson' else [b'[']
+        self._size = 0
+        self._count = 0
+
+    def feed(self, item):
+        if self.fmt == 'ndjson':
+            part = self.dumps(item) + b'\n'
+        else:
+            part = (b',' if self._count else b'') + self.dumps(item)
+        self._count += 1
+        self._parts.append(part)
+        self._size += len(part)
+        if self._count == 1 or self._size >= self.chunk_size:
+            return self._drain()
+        return None
+
+    def finish(self):
+        if self.fmt != 'ndjson':
+            self._parts.append(b']\n')
+        return self._drain()
+
+    def _drain(self):
+        chunk = b''.join(self._parts)
+        self._parts = []
+        self._size = 0
+        return chunk
+
+
+class RowStream:
+    # Server-side (named) cursor over a pooled psycopg2 connection. Postgres
+    # keeps the result set and hands it over `itersize` rows per round trip,
+    # so memory stays flat however many rows the query returns. The query is
+    # declared up front so planning errors still surface before the response
+    # starts; close() returns the connection to the pool.
+    def __init__(self, conn, query, params=None, itersize=STREAM_ITERSIZE):
+        self.conn = conn
+        try:
+            self.cur = conn.cursor(name=cursor_name())
+            self.cur.itersize = itersize
+            self.cur.execute(query, params)
+        except Exception:
+            self.close()
+            raise
+
+    def __iter__(self):
+        return iter(self.cur)
+
+    def close(self):
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        try:
+            if getattr(self, 'cur', None) is not None:
+                self.cur.close()
+        finally:
+            conn.close()
+
+
+def encode_rows(rows, from_row, fmt, dumps):
+    encoder = StreamEncoder(fmt, dumps)
+    for row in rows:
+        chunk = encoder.feed(from_row(row))
+        if chunk:
+            yield chunk
+    yield encoder.finish()
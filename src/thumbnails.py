@@ -0,0 +1,459 @@
+import argparse
+import hashlib
+import http.client
+import io
+import ipaddress
+import os
+import socket
+import threading
+import urllib.parse
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+
+from PIL import Image
+
+import entity_cache
+
+# Thumbnails for /images/<kind>/<id>?size=N. The source image behind a row's
+# URL is fetched once, resized to every size in IMAGE_SIZES on a worker pool
+# (Pillow releases the GIL while decoding, resizing and encoding, so threads
+# run in parallel) and stored under the SHA-256 of the original bytes:
+#
+#   IMAGE_CACHE_DIR/urls/ab/<sha256 of url>     -> digest of the original
+#   IMAGE_CACHE_DIR/blobs/cd/<digest>-<size>.jpg -> thumbnail
+#
+# Identical images behind different URLs share their files. Every hit
+# touches the file's mtime, and once the blobs exceed IMAGE_CACHE_MAX_MB the
+# least recently served ones are deleted. The directory may be shared by all
+# workers of a host.
+IMAGE_CACHE_DIR = Path(os.getenv("IMAGE_CACHE_DIR", Path(__file__).resolve().parent / "image_cache"))
+IMAGE_CACHE_MAX_BYTES = int(float(os.getenv("IMAGE_CACHE_MAX_MB", 512)) * 1024 * 1024)
+IMAGE_SIZES = tuple(sorted(int(s) for s in os.getenv("IMAGE_SIZES", "64,128,256,512").split(',') if s.strip()))
+IMAGE_DEFAULT_SIZE = int(os.getenv("IMAGE_DEFAULT_SIZE", 128))
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", 80))
+IMAGE_MAX_AGE = int(os.getenv("IMAGE_MAX_AGE", 86400))
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", os.cpu_count() or 2))
+# http fetches the row's URL; local reads IMAGE_LOCAL_DIR/<sha256 of url>
+# instead (fill it with `python thumbnails.py mirror`), for offline
+# development and load tests that should not hit the image host.
+IMAGE_FETCHER = os.getenv("IMAGE_FETCHER", "http")
+IMAGE_LOCAL_DIR = Path(os.getenv("IMAGE_LOCAL_DIR", IMAGE_CACHE_DIR / "originals"))
+IMAGE_FETCH_TIMEOUT = float(os.getenv("IMAGE_FETCH_TIMEOUT", 5))
+# Row URLs come partly from clients (POST /playlists takes a cover), so the
+# http fetcher only talks to these hosts: a name matches itself, ".name"
+# its subdomains and "*" any host. Whatever the host, an address that is not
+# globally routable (loopback, private, link-local such as 169.254.169.254)
+# is refused, for every redirect hop and at connect time, so DNS cannot
+# point an allowed name at the internal network.
+IMAGE_ALLOWED_HOSTS = tuple(h.strip().lower() for h in
+                            os.getenv("IMAGE_ALLOWED_HOSTS", "picsum.photos,.picsum.photos").split(',') if h.strip())
+IMAGE_MAX_SOURCE_BYTES = int(float(os.getenv("IMAGE_MAX_SOURCE_MB", 10)) * 1024 * 1024)
+
+MIMETYPE = 'image/jpeg'
+
+# kind in the URL -> image attribute of its entity_cache record
+IMAGE_FIELDS = {
+    'songs': 'album_cover',
+    'playlists': 'cover',
+    'artists': 'profile_image',
+    'users': 'profile_image'
+}
+
+
+class InvalidImageRequest(ValueError):
+    pass
+
+
+class ImageNotFound(Exception):
+    pass
+
+
+class ImageUnavailable(Exception):
+    pass
+
+
+def parse_size(args):
+    try:
+        size = int(args.get('size', IMAGE_DEFAULT_SIZE))
+    except (TypeError, ValueError):
+        size = None
+    if size not in IMAGE_SIZES:
+        raise InvalidImageRequest("size must be one of %s" % ', '.join(map(str, IMAGE_SIZES)))
+    return size
+
+
+def image_url_lookup(kind, entity_id):
+    # entity_cache loader (run it with run_sync / run_lookup): the image URL
+    # of one row, read through the entity cache when it is enabled.
+    if kind not in IMAGE_FIELDS:
+        raise ImageNotFound("unknown image kind: %s" % kind)
+    if entity_cache.ENABLED:
+        records = yield from entity_cache.load(kind, [entity_id])
+    else:
+        rows = yield entity_cache.KINDS[kind][1], ([entity_id],)
+        records = {row[0]: entity_cache.make_record(kind, row, 0) for row in rows}
+    record = records.get(entity_id)
+    url = getattr(record, IMAGE_FIELDS[kind]) if record is not None else None
+    if not url:
+        raise ImageNotFound("%s %d has no image" % (kind[:-1].capitalize(), entity_id))
+    return url
+
+
+def etag_token(digest, size):
+    # Unquoted; the thumbnail files are immutable, so this is a strong ETag.
+    return '%s-%d' % (digest[:24], size)
+
+
+def sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def host_allowed(host, allowed=IMAGE_ALLOWED_HOSTS):
+    host = (host or '').lower().rstrip('.')
+    return bool(host) and any(entry == '*' or host == entry or (entry.startswith('.') and host.endswith(entry))
+                              for entry in allowed)
+
+
+def check_url(url, allowed=IMAGE_ALLOWED_HOSTS):
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https'):
+        raise ImageUnavailable("not an http(s) image URL: %s" % url)
+    if not host_allowed(parts.hostname, allowed):
+        raise ImageUnavailable("image host not allowed: %s" % url)
+    return url
+
+
+def allowed_image_url(url):
+    # For writers that store an image URL, e.g. a playlist's cover.
+    try:
+        check_url(url)
+    except (ImageUnavailable, TypeError, AttributeError):
+        return False
+    return True
+
+
+def is_public(address):
+    ip = ipaddress.ip_address(address.split('%', 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped is not None:
+        ip = ip.ipv4_mapped
+    return ip.is_global and not ip.is_multicast
+
+
+def public_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    # socket.create_connection, but only to the globally routable addresses
+    # the name resolves to; the address connected to is the one checked.
+    host, port = address
+    try:
+        infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise OSError("cannot resolve %s: %s" % (host, e))
+    infos = [info for info in infos if is_public(info[4][0])]
+    if not infos:
+        raise OSError("%s resolves to a non-public address" % host)
+    error = None
+    for family, kind, proto, _, sockaddr in infos:
+        sock = socket.socket(family, kind, proto)
+        try:
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            sock.close()
+            error = e
+    raise error
+
+
+class PublicHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = public_connection
+
+
+class PublicHTTPSConnection(http.client.HTTPSConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = public_connection
+
+
+class PublicHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(PublicHTTPConnection, req)
+
+
+class PublicHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(PublicHTTPSConnection, req, context=self._context)
+
+
+class AllowedRedirectHandler(urllib.request.HTTPRedirectHandler):
+    def __init__(self, allowed):
+        self.allowed = allowed
+
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        newurl = check_url(urllib.parse.urljoin(req.full_url, newurl), self.allowed)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+class HttpFetcher:
+    def __init__(self, timeout=IMAGE_FETCH_TIMEOUT, max_bytes=IMAGE_MAX_SOURCE_BYTES, allowed=IMAGE_ALLOWED_HOSTS):
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.allowed = allowed
+        # No proxy: the connection must go to the address that was checked.
+        self.opener = urllib.request.build_opener(urllib.request.ProxyHandler({}), PublicHTTPHandler,
+                                                  PublicHTTPSHandler, AllowedRedirectHandler(allowed))
+
+    def fetch(self, url):
+        check_url(url, self.allowed)
+        request = urllib.request.Request(url, headers={'User-Agent': 'music-streaming-thumbnails'})
+        try:
+            with self.opener.open(request, timeout=self.timeout) as response:
+                data = response.read(self.max_bytes + 1)
+        except (OSError, ValueError) as e:
+            raise ImageUnavailable("could not fetch %s: %s" % (url, e))
+        if len(data) > self.max_bytes:
+            raise ImageUnavailable("%s is larger than %d bytes" % (url, self.max_bytes))
+        return data
+
+
+class LocalFileFetcher:
+    def __init__(self, directory=IMAGE_LOCAL_DIR):
+        self.directory = Path(directory)
+
+    def path_for(self, url):
+        return self.directory / sha256(url.encode())
+
+    def fetch(self, url):
+        try:
+            return self.path_for(url).read_bytes()
+        except OSError as e:
+            raise ImageUnavailable("no local copy of %s: %s" % (url, e))
+
+
+FETCHERS = {
+    'http': HttpFetcher,
+    'local': LocalFileFetcher
+}
+
+
+def write_atomic(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name('.%s.%d.%d' % (path.name, os.getpid(), threading.get_ident()))
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+
+
+class ThumbnailStore:
+    def __init__(self, root=IMAGE_CACHE_DIR, sizes=IMAGE_SIZES, max_bytes=IMAGE_CACHE_MAX_BYTES,
+                 fetcher=None, workers=IMAGE_WORKERS):
+        self.root = Path(root)
+        self.sizes = sizes
+        self.max_bytes = max_bytes
+        self.fetcher = fetcher if fetcher is not None else FETCHERS[IMAGE_FETCHER]()
+        self._workers = ThreadPoolExecutor(max(workers, 1), thread_name_prefix='thumbnails')
+        self._lock = threading.Lock()
+        self._sweep_lock = threading.Lock()
+        self._flights = {}
+        self._bytes = None
+        self._stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'fetches': 0, 'failures': 0,
+                       'evictions': 0, 'evicted_bytes': 0}
+
+    def index_path(self, key):
+        return self.root / 'urls' / key[:2] / key
+
+    def blob_path(self, digest, size):
+        return self.root / 'blobs' / digest[:2] / ('%s-%d.jpg' % (digest, size))
+
+    def _count(self, stat, n=1):
+        with self._lock:
+            self._stats[stat] += n
+
+    def get(self, url, size):
+        # Returns (path, digest) of the `size` thumbnail of `url`, fetching
+        # and resizing it first if needed. Concurrent misses for the same
+        # URL wait for a single fetch.
+        key = sha256(url.encode())
+        path, digest = self._cached(key, size)
+        if path is not None:
+            self._count('hits')
+            return path, digest
+
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Future()
+        if not leader:
+            self._count('coalesced')
+            digest = flight.result()
+            return self.blob_path(digest, size), digest
+
+        self._count('misses')
+        try:
+            digest = self._generate(url, key)
+            flight.set_result(digest)
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+        return self.blob_path(digest, size), digest
+
+    def _cached(self, key, size):
+        try:
+            digest = self.index_path(key).read_text().strip()
+        except OSError:
+            return None, None
+        path = self.blob_path(digest, size)
+        try:
+            os.utime(path)
+        except OSError:
+            # Evicted since; regenerate.
+            return None, None
+        return path, digest
+
+    def _generate(self, url, key):
+        self._count('fetches')
+        try:
+            data = self.fetcher.fetch(url)
+        except ImageUnavailable:
+            self._count('failures')
+            raise
+        digest = sha256(data)
+        missing = [size for size in self.sizes if not self.blob_path(digest, size).exists()]
+        if missing:
+            try:
+                image = Image.open(io.BytesIO(data))
+                # Lets JPEG decode straight to a reduced scale.
+                image.draft('RGB', (max(missing), max(missing)))
+                image = image.convert('RGB')
+            except (OSError, ValueError, Image.DecompressionBombError) as e:
+                self._count('failures')
+                raise ImageUnavailable("%s is not a readable image: %s" % (url, e))
+            written = sum(self._workers.map(lambda size: self._resize(image, digest, size), missing))
+            self._add_bytes(written)
+        write_atomic(self.index_path(key), digest.encode())
+        return digest
+
+    def _resize(self, image, digest, size):
+        thumb = image.copy()
+        thumb.thumbnail((size, size), Image.LANCZOS)
+        out = io.BytesIO()
+        thumb.save(out, 'JPEG', quality=IMAGE_QUALITY, optimize=True, progressive=True)
+        write_atomic(self.blob_path(digest, size), out.getvalue())
+        return out.tell()
+
+    def _scan(self):
+        entries = []
+        for parent, _, files in os.walk(self.root / 'blobs'):
+            for name in files:
+                path = os.path.join(parent, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+        return entries
+
+    def _add_bytes(self, written):
+        with self._lock:
+            if self._bytes is None:
+                self._bytes = sum(size for _, size, _ in self._scan())
+            else:
+                self._bytes += written
+            over = self._bytes > self.max_bytes
+        if over:
+            self.sweep()
+
+    def sweep(self):
+        # Deletes the least recently served thumbnails until the cache is
+        # back under 90% of its cap. One sweep at a time per process.
+        if not self._sweep_lock.acquire(blocking=False):
+            return 0
+        try:
+            entries = sorted(self._scan())
+            total = sum(size for _, size, _ in entries)
+            target = self.max_bytes * 0.9
+            evicted = freed = 0
+            for _, size, path in entries:
+                if total - freed <= target:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                evicted += 1
+                freed += size
+            with self._lock:
+                self._bytes = total - freed
+                self._stats['evictions'] += evicted
+                self._stats['evicted_bytes'] += freed
+            return evicted
+        finally:
+            self._sweep_lock.release()
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats, bytes=self._bytes, max_bytes=self.max_bytes, sizes=list(self.sizes),
+                        fetcher=type(self.fetcher).__name__)
+
+
+_store = None
+_store_pid = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    # One store (and resize pool) per process; workers forked after first
+    # use build their own.
+    global _store, _store_pid
+    with _store_lock:
+        if _store is None or _store_pid != os.getpid():
+            _store, _store_pid = ThumbnailStore(), os.getpid()
+        return _store
+
+
+def thumbnail(url, size):
+    return get_store().get(url, size)
+
+
+IMAGE_URLS_QUERY = """
+    SELECT album_cover FROM songs WHERE album_cover IS NOT NULL
+    UNION SELECT cover FROM playlists WHERE cover IS NOT NULL
+    UNION SELECT profile_image FROM artists WHERE profile_image IS NOT NULL
+    UNION SELECT profile_image FROM users WHERE profile_image IS NOT NULL
+"""
+
+
+if __name__ == '__main__':
+    from db_pool import get_connection
+
+    parser = argparse.ArgumentParser(description="Maintain the thumbnail cache.")
+    parser.add_argument('command', choices=('mirror', 'sweep'),
+                        help="mirror: download every image URL in the database into IMAGE_LOCAL_DIR "
+                             "for IMAGE_FETCHER=local; sweep: trim the cache to IMAGE_CACHE_MAX_MB")
+    args = parser.parse_args()
+
+    if args.command == 'sweep':
+        print("Evicted %d thumbnails" % ThumbnailStore(fetcher=LocalFileFetcher()).sweep())
+    else:
+        with get_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute(IMAGE_URLS_QUERY)
+                urls = [row[0] for row in cur.fetchall()]
+        http, local = HttpFetcher(), LocalFileFetcher()
+        saved = 0
+        for url in urls:
+            if local.path_for(url).exists():
+                continue
+            try:
+                write_atomic(local.path_for(url), http.fetch(url))
+                saved += 1
+            except ImageUnavailable as e:
+                print(e)
+        print("Mirrored %d of %d image URLs into %s" % (saved, len(urls), local.directory))
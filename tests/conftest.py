@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The modules under src/ import each other by bare name, as they do when the
+# apps run from that directory.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
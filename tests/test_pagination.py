@@ -0,0 +1,77 @@
+import base64
+import json
+from datetime import datetime
+
+import pytest
+
+import feeds
+import playlists
+import queries
+from pagination import InvalidCursor, decode_cursor, encode_cursor
+
+
+def token(raw):
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def test_round_trip():
+    cursor = encode_cursor(('Song title', 42))
+    assert '=' not in cursor
+    assert decode_cursor(cursor, queries.SONG_CURSOR) == ['Song title', 42]
+
+
+def test_search_rank_may_be_int_or_float():
+    assert decode_cursor(encode_cursor([0.25, 3]), queries.SEARCH_CURSOR) == [0.25, 3]
+    assert decode_cursor(encode_cursor([1, 3]), queries.SEARCH_CURSOR) == [1, 3]
+
+
+def test_playlist_cursor_parses_timestamp():
+    created_at = datetime(2024, 1, 2, 3, 4, 5, 678000)
+    row = (7, 'Mix', None, None, created_at)
+    cursor = encode_cursor(queries.playlist_cursor_key(row))
+    assert decode_cursor(cursor, queries.PLAYLIST_CURSOR) == [created_at, 7]
+
+
+@pytest.mark.parametrize('cursor', [
+    'not a cursor!',
+    token(b'{"truncated": '),
+    token(b'\xff\xfe'),
+    encode_cursor([5, 6])[:-3]
+])
+def test_tampered_cursor(cursor):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(cursor, playlists.TRACK_CURSOR)
+
+
+@pytest.mark.parametrize('values', [[1], [1, 2, 3], []])
+def test_wrong_arity(values):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(encode_cursor(values), queries.USER_PLAYTIME_CURSOR)
+
+
+@pytest.mark.parametrize('raw', [b'{"a": 1}', b'"text"', b'12', b'null'])
+def test_not_a_list(raw):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(token(raw), queries.USER_CURSOR)
+
+
+@pytest.mark.parametrize('types, values', [
+    (queries.USER_CURSOR, ['x']),
+    (queries.USER_CURSOR, [None]),
+    (queries.USER_CURSOR, [True]),
+    (queries.USER_CURSOR, [1.5]),
+    (queries.USER_CURSOR, [2 ** 63]),
+    (feeds.FEED_CURSOR, ['1']),
+    (queries.USER_PLAYTIME_CURSOR, [100, 'x']),
+    (queries.USER_PLAYTIME_CURSOR, ['100', 1]),
+    (queries.SONG_CURSOR, [12, 3]),
+    (queries.SONG_CURSOR, ['title', '3']),
+    (queries.SEARCH_CURSOR, ['0.5', 3]),
+    (queries.PLAYLIST_CURSOR, ['yesterday', 1]),
+    (queries.PLAYLIST_CURSOR, [12, 1]),
+    (queries.PLAYLIST_CURSOR, ['2024-01-02T03:04:05', 'x']),
+    (playlists.TRACK_CURSOR, [[1], 2])
+])
+def test_mistyped_values(types, values):
+    with pytest.raises(InvalidCursor):
+        decode_cursor(token(json.dumps(values).encode()), types)
@@ -0,0 +1,184 @@
+import pytest
+
+import feeds
+import playlists
+from playlists import POSITION_GAP, InvalidPlaylistEdit, PlaylistNotFound, spread
+
+
+class FakePlaylist:
+    # Answers the queries of the playlist edits from an in-memory
+    # {song_id: position}, as Postgres would for one playlist.
+    def __init__(self, playlist_id=1, song_ids=(), songs=range(1, 1001)):
+        self.playlist_id = playlist_id
+        self.positions = {song_id: (i + 1) * POSITION_GAP for i, song_id in enumerate(song_ids)}
+        self.songs = set(songs)
+        self.queries = []
+
+    def order(self):
+        return sorted(self.positions, key=lambda song_id: (self.positions[song_id], song_id))
+
+    def rows(self, query, params):
+        self.queries.append(query)
+        if query == playlists.LOCK_PLAYLIST_QUERY:
+            return [(self.playlist_id,)] if params[0] == self.playlist_id else []
+        if query == playlists.TRACK_POSITIONS_QUERY:
+            return [(song_id, self.positions[song_id]) for song_id in params[1] if song_id in self.positions]
+        if query == playlists.LAST_POSITION_QUERY:
+            return [(max(self.positions.values()),)] if self.positions else []
+        if query in (playlists.PREVIOUS_POSITION_QUERY, playlists.NEXT_POSITION_QUERY):
+            key = params[1], params[2]
+            keys = sorted((position, song_id) for song_id, position in self.positions.items())
+            if query == playlists.PREVIOUS_POSITION_QUERY:
+                found = [k for k in keys if k < key][-1:]
+            else:
+                found = [k for k in keys if k > key][:1]
+            return [(k[0],) for k in found]
+        if query == playlists.ADD_SONGS_QUERY:
+            added = []
+            for song_id, position in sorted(zip(params[1], params[2])):
+                if song_id in self.songs and song_id not in self.positions:
+                    self.positions[song_id] = position
+                    added.append((song_id,))
+            return added
+        if query == playlists.REMOVE_SONGS_QUERY:
+            return [(song_id,) for song_id in params[1] if self.positions.pop(song_id, None) is not None]
+        if query == playlists.MOVE_SONG_QUERY:
+            if params[2] not in self.positions:
+                return []
+            self.positions[params[2]] = params[0]
+            return [(params[2],)]
+        if query == playlists.REBALANCE_QUERY:
+            order = self.order()
+            self.positions = {song_id: (i + 1) * params[0] for i, song_id in enumerate(order)}
+            return [(song_id,) for song_id in order]
+        if query == playlists.SONG_PLAY_TOTAL_QUERY:
+            return [(0,)]
+        if query == feeds.RECORD_ADDITIONS_QUERY:
+            return [(i,) for i, _ in enumerate(params[1], 1)]
+        if query == feeds.FAN_OUT_QUERY:
+            return [(0,)]
+        raise AssertionError("unexpected query: %s" % query)
+
+    def run(self, edit):
+        try:
+            step = next(edit)
+            while True:
+                step = edit.send(self.rows(*step))
+        except StopIteration as stop:
+            return stop.value
+
+
+def test_spread_open_ends():
+    assert spread(None, None, 1) == [POSITION_GAP]
+    assert spread(None, None, 3) == [POSITION_GAP, 2 * POSITION_GAP, 3 * POSITION_GAP]
+    assert spread(10, None, 2) == [10 + POSITION_GAP, 10 + 2 * POSITION_GAP]
+    assert spread(None, 10, 2) == [10 - 2 * POSITION_GAP, 10 - POSITION_GAP]
+
+
+def test_spread_between():
+    assert spread(0, 4, 1) == [2]
+    assert spread(0, 3, 2) == [1, 2]
+    assert spread(0, 2, 2) is None
+    assert spread(5, 6, 1) is None
+    positions = spread(100, 1000, 7)
+    assert positions == sorted(set(positions))
+    assert 100 < positions[0] and positions[-1] < 1000
+
+
+def test_gap_halves_log2_times():
+    # Inserting before the same song again and again halves the gap each
+    # time; it lasts log2(POSITION_GAP) inserts.
+    low, high, inserts = 0, POSITION_GAP, 0
+    while True:
+        positions = spread(low, high, 1)
+        if positions is None:
+            break
+        high = positions[0]
+        inserts += 1
+    assert inserts == POSITION_GAP.bit_length() - 1
+
+
+def test_slot_appends():
+    fake = FakePlaylist(song_ids=[1, 2])
+    assert fake.run(playlists.slot(1, None, 2)) == ([3 * POSITION_GAP, 4 * POSITION_GAP], False)
+    assert fake.run(playlists.slot(1, ('after', 1), 1)) == ([POSITION_GAP + POSITION_GAP // 2], False)
+    assert fake.run(playlists.slot(1, ('before', 1), 1)) == ([0], False)
+
+
+def test_slot_empty_playlist():
+    assert FakePlaylist().run(playlists.slot(1, None, 1)) == ([POSITION_GAP], False)
+
+
+def test_slot_rebalances_exhausted_gap():
+    fake = FakePlaylist(song_ids=[1, 2])
+    fake.positions = {1: 100, 2: 101}
+    positions, rebalanced = fake.run(playlists.slot(1, ('after', 1), 3))
+    assert rebalanced
+    assert fake.queries.count(playlists.REBALANCE_QUERY) == 1
+    assert fake.positions == {1: POSITION_GAP, 2: 2 * POSITION_GAP}
+    assert POSITION_GAP < positions[0] < positions[-1] < 2 * POSITION_GAP
+
+
+def test_slot_no_room_after_rebalance():
+    fake = FakePlaylist(song_ids=[1, 2])
+    with pytest.raises(InvalidPlaylistEdit, match="No room"):
+        fake.run(playlists.slot(1, ('before', 2), POSITION_GAP))
+    assert fake.queries.count(playlists.REBALANCE_QUERY) == 1
+
+
+def test_slot_unknown_anchor():
+    with pytest.raises(InvalidPlaylistEdit, match="Song 9 is not in the playlist"):
+        FakePlaylist(song_ids=[1]).run(playlists.slot(1, ('after', 9), 1))
+
+
+def test_slot_relative_to_itself():
+    with pytest.raises(InvalidPlaylistEdit):
+        FakePlaylist(song_ids=[1, 2]).run(playlists.slot(1, ('after', 2), 1, exclude=2))
+
+
+def test_repeated_inserts_at_one_spot():
+    fake = FakePlaylist(song_ids=[1, 2])
+    rebalances = []
+    for song_id in range(3, 40):
+        result = fake.run(playlists.add_songs(1, {'song_ids': [song_id], 'after': 1}))
+        assert result['added'] == [song_id]
+        rebalances.append(result['rebalanced'])
+    # Each insert lands right after song 1, so the newest comes first.
+    assert fake.order() == [1] + list(range(39, 2, -1)) + [2]
+    assert rebalances.index(True) == POSITION_GAP.bit_length() - 1
+    assert 1 <= rebalances.count(True) <= 3
+
+
+def test_add_songs_skips_duplicates_and_unknown():
+    fake = FakePlaylist(song_ids=[1, 2], songs=range(1, 10))
+    result = fake.run(playlists.add_songs(1, {'song_ids': [2, 3, 3, 50, 4], 'before': 2}))
+    assert result == {'added': [3, 4], 'skipped': [2, 50], 'rebalanced': False}
+    assert fake.order() == [1, 3, 4, 2]
+
+
+def test_add_songs_unknown_playlist():
+    with pytest.raises(PlaylistNotFound):
+        FakePlaylist().run(playlists.add_songs(2, {'song_ids': [1]}))
+
+
+def test_remove_and_move():
+    fake = FakePlaylist(song_ids=[1, 2, 3, 4])
+    assert fake.run(playlists.remove_songs(1, {'song_ids': [2, 7]})) == {'removed': [2], 'skipped': [7]}
+    result = fake.run(playlists.move_songs(1, {'moves': [{'song_id': 4, 'before': 1}, {'song_id': 1}]}))
+    assert result == {'moved': [4, 1], 'rebalanced': False}
+    assert fake.order() == [4, 3, 1]
+
+
+@pytest.mark.parametrize('data', [
+    None,
+    {},
+    {'song_ids': []},
+    {'song_ids': [1, '2']},
+    {'song_ids': [True]},
+    {'song_ids': [1], 'before': 2, 'after': 3},
+    {'song_ids': [1], 'after': 'x'},
+    {'song_ids': list(range(playlists.MAX_PLAYLIST_EDIT + 1))}
+])
+def test_add_songs_rejects_bad_input(data):
+    with pytest.raises(InvalidPlaylistEdit):
+        next(playlists.add_songs(1, data))
@@ -0,0 +1,159 @@
+import random
+
+import pytest
+
+from sketches import DENSE, SPARSE, CountMinSketch, HyperLogLog, TopK, heavy_hitters
+
+
+def hll(values, precision=12):
+    sketch = HyperLogLog(precision)
+    for value in values:
+        sketch.add(value)
+    return sketch
+
+
+@pytest.mark.parametrize('count', [10, 500, 5000, 100000])
+def test_hll_estimate(count):
+    # 1.04 / sqrt(4096) is a 1.6% standard error; allow three of them.
+    assert abs(hll(range(1, count + 1)).estimate() - count) <= max(2, 0.05 * count)
+
+
+def test_hll_ignores_repeats():
+    assert hll(list(range(1, 301)) * 5).estimate() == hll(range(1, 301)).estimate()
+
+
+def test_hll_sparse_to_dense():
+    sketch = HyperLogLog(8)
+    value = 0
+    while sketch.registers is None:
+        value += 1
+        sketch.add(value)
+        if sketch.registers is None:
+            assert len(sketch.sparse) * 4 < sketch.size
+    assert sketch.sparse is None
+    assert len(sketch.registers) == sketch.size
+    assert int((sketch.registers > 0).sum()) * 4 >= sketch.size
+    # Every register set while sparse survives the switch.
+    assert hll(range(1, value + 1), 8).registers.tolist() == sketch.registers.tolist()
+
+
+@pytest.mark.parametrize('count', [0, 50, 5000])
+def test_hll_bytes_round_trip(count):
+    sketch = hll(range(1, count + 1))
+    data = sketch.to_bytes()
+    assert data[0] == (DENSE if sketch.registers is not None else SPARSE)
+    assert data[1] == 12
+    copy = HyperLogLog.from_bytes(memoryview(data))
+    assert copy.precision == 12
+    assert copy.estimate() == sketch.estimate()
+    assert copy.to_bytes() == data
+
+
+def test_hll_sparse_bytes_are_smaller():
+    assert len(hll(range(1, 51)).to_bytes()) < len(hll(range(1, 5001)).to_bytes())
+
+
+def test_hll_corrupt_dense_bytes():
+    with pytest.raises(ValueError):
+        HyperLogLog.from_bytes(hll(range(1, 5001)).to_bytes()[:-1])
+
+
+@pytest.mark.parametrize('left, right', [(100, 200), (100, 5000), (5000, 100), (5000, 8000)])
+def test_hll_merge(left, right):
+    a = hll(range(1, left + 1))
+    b = hll(range(left + 1, left + right + 1))
+    merged = HyperLogLog.from_bytes(a.to_bytes()).merge(b)
+    # Register-wise max: the same sketch as adding both sets to one.
+    assert merged.to_bytes() == hll(range(1, left + right + 1)).to_bytes()
+    assert abs(merged.estimate() - (left + right)) <= 0.05 * (left + right)
+
+
+def test_hll_merge_precision_mismatch():
+    with pytest.raises(ValueError):
+        HyperLogLog(10).merge(HyperLogLog(12))
+
+
+def plays(seed=1, count=20000, keys=2000):
+    rng = random.Random(seed)
+    return [int(rng.paretovariate(1.1)) % keys + 1 for _ in range(count)]
+
+
+def test_cms_never_undercounts():
+    stream = plays()
+    sketch = CountMinSketch(4, 256)
+    exact = {}
+    for key in stream:
+        sketch.add(key)
+        exact[key] = exact.get(key, 0) + 1
+    assert sketch.total() == len(stream)
+    assert all(sketch.estimate(key) >= count for key, count in exact.items())
+    within = sum(sketch.estimate(key) - count <= sketch.error_bound() for key, count in exact.items())
+    assert within >= 0.95 * len(exact)
+
+
+def test_cms_add_returns_estimate():
+    sketch = CountMinSketch(4, 64)
+    assert sketch.add(7, 3) == 3
+    assert sketch.add(7) == sketch.estimate(7) == 4
+    assert sketch.estimate(8) <= sketch.total()
+
+
+def test_cms_width_must_be_power_of_two():
+    with pytest.raises(ValueError):
+        CountMinSketch(4, 100)
+
+
+def test_cms_bytes_round_trip_and_merge():
+    a, b = CountMinSketch(4, 128), CountMinSketch(4, 128)
+    for key in plays(1, 2000):
+        a.add(key)
+    for key in plays(2, 2000):
+        b.add(key)
+    copy = CountMinSketch.from_bytes(a.to_bytes(), 4, 128)
+    assert copy.counters.tolist() == a.counters.tolist()
+    copy.merge(b)
+    assert copy.total() == 4000
+    assert copy.counters.tolist() == (a.counters + b.counters).tolist()
+    with pytest.raises(ValueError):
+        CountMinSketch.from_bytes(a.to_bytes(), 4, 256)
+    with pytest.raises(ValueError):
+        copy.merge(CountMinSketch(2, 128))
+
+
+def test_topk_keeps_highest():
+    top = TopK(3)
+    for key, estimate in [(1, 5), (2, 1), (3, 7), (4, 2), (5, 9), (6, 1)]:
+        top.offer(key, estimate)
+    assert top.estimates == {1: 5, 3: 7, 5: 9}
+
+
+def test_topk_updates_grow_estimates():
+    top = TopK(2)
+    top.offer(1, 1)
+    top.offer(2, 2)
+    top.offer(1, 10)
+    top.offer(3, 3)
+    # 2 was the smallest once 1 grew, so 3 replaces it, not 1.
+    assert top.estimates == {1: 10, 3: 3}
+
+
+def test_topk_matches_exact_counts():
+    sketch = CountMinSketch(4, 4096)
+    top = TopK(10)
+    exact = {}
+    for key in plays(3, 50000, 5000):
+        top.offer(key, sketch.add(key))
+        exact[key] = exact.get(key, 0) + 1
+    # Repeated offers of existing keys compact the heap instead of growing it.
+    assert len(top._heap) <= 2 * top.capacity + 64
+    expected = sorted(exact, key=lambda key: -exact[key])[:5]
+    assert [key for key, _ in heavy_hitters(sketch, top.estimates, 5)] == expected
+
+
+def test_heavy_hitters_order_and_zeros():
+    sketch = CountMinSketch(4, 1024)
+    sketch.add(3, 2)
+    sketch.add(1, 2)
+    sketch.add(2, 5)
+    assert heavy_hitters(sketch, [1, 2, 3, 99], 10) == [(2, 5), (1, 2), (3, 2)]
+    assert heavy_hitters(sketch, [1, 2, 3], 1) == [(2, 5)]
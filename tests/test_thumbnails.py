@@ -0,0 +1,87 @@
+import threading
+import urllib.request
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from thumbnails import AllowedRedirectHandler, HttpFetcher, ImageUnavailable, check_url, host_allowed, is_public
+
+
+@pytest.mark.parametrize('host, allowed, expected', [
+    ('picsum.photos', ('picsum.photos',), True),
+    ('PICSUM.photos.', ('picsum.photos',), True),
+    ('fastly.picsum.photos', ('.picsum.photos',), True),
+    ('fastly.picsum.photos', ('picsum.photos',), False),
+    ('evilpicsum.photos', ('.picsum.photos',), False),
+    ('picsum.photos.evil.com', ('picsum.photos', '.picsum.photos'), False),
+    ('anything.example', ('*',), True),
+    (None, ('*',), False),
+    ('picsum.photos', (), False)
+])
+def test_host_allowed(host, allowed, expected):
+    assert host_allowed(host, allowed) is expected
+
+
+@pytest.mark.parametrize('url', [
+    'file:///etc/passwd',
+    'ftp://picsum.photos/a.jpg',
+    'http://169.254.169.254/latest/meta-data/',
+    'http://picsum.photos@127.0.0.1/',
+    'https:///no-host'
+])
+def test_check_url_rejects(url):
+    with pytest.raises(ImageUnavailable):
+        check_url(url, ('picsum.photos',))
+
+
+@pytest.mark.parametrize('address, expected', [
+    ('93.184.216.34', True),
+    ('2606:4700::6810:84e5', True),
+    ('127.0.0.1', False),
+    ('10.1.2.3', False),
+    ('172.16.0.1', False),
+    ('192.168.1.1', False),
+    ('169.254.169.254', False),
+    ('100.64.0.1', False),
+    ('0.0.0.0', False),
+    ('::1', False),
+    ('fe80::1%eth0', False),
+    ('fd00::1', False),
+    ('::ffff:127.0.0.1', False),
+    ('224.0.0.1', False)
+])
+def test_is_public(address, expected):
+    assert is_public(address) is expected
+
+
+@pytest.fixture
+def local_server():
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            self.send_response(200)
+            self.end_headers()
+            self.wfile.write(b'secret')
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[1]
+    server.shutdown()
+
+
+@pytest.mark.parametrize('host', ['127.0.0.1', 'localhost'])
+def test_fetch_refuses_loopback_even_if_allowed(local_server, host):
+    with pytest.raises(ImageUnavailable, match='non-public'):
+        HttpFetcher(timeout=2, allowed=('*',)).fetch('http://%s:%d/image.jpg' % (host, local_server))
+
+
+def test_redirects_are_checked():
+    handler = AllowedRedirectHandler(('picsum.photos',))
+    request = urllib.request.Request('https://picsum.photos/300/300')
+    with pytest.raises(ImageUnavailable):
+        handler.redirect_request(request, None, 302, 'Found', {}, 'http://169.254.169.254/latest/')
+    follow = handler.redirect_request(request, None, 302, 'Found', {}, '/id/1/300/300.jpg')
+    assert follow.full_url == 'https://picsum.photos/id/1/300/300.jpg'